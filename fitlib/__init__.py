@@ -1,15 +1,23 @@
 from subprocess import Popen as popen, PIPE
 from os import stat, path, chdir, getcwd, close as osclose, remove, mkdir, devnull
 from tempfile import mkstemp
-from json import load, dump
-from paths import fitMapToTree, fitTreeToMap
-import re
+from json import load
 import platform
 from threading import Thread as thread
 from sys import stdout
 from gzip import GzipFile as gz
 from StringIO import StringIO
-from skipExtensions import downstreamSkipExtensionsCaseInsensitive, downstreamSkipExtensionsCaseSensitive
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from statdb import StatStore
+from hashing import iterBlobHashes
+from binary import classifyFiles
+from skipExtensions import isSkippedExtension
+from config import gitConfig
+from gitobjects import BatchReader
+from manifest import isManifestData, encodeManifest, decodeManifest
+from locking import newTempFile, publish, discard
 
 # Below two lines prevents Python raising an exception
 # when piping output to commands like less, head that
@@ -21,31 +29,68 @@ if platform.system() != "Windows":
     signal.signal(signal.SIGPIPE, signal.SIG_DFL) 
 
 
-# Get the repo root directory if inside one, otherwise exit
-_p = popen('git rev-parse --show-toplevel'.split(), stdout=PIPE)
-repoDir = _p.communicate()[0].strip()
-if _p.returncode != 0:
-    raise Exception('Could not determine git working tree.')
-
-# Get some more directory/file paths we're interested in
 selfDir = path.dirname(path.realpath(__file__))
 workingDir = getcwd()
-gitDir = popen('git rev-parse --git-dir'.split(), stdout=PIPE).communicate()[0].strip()
-fitDir = path.join(gitDir,'fit')
-fitFile = path.join(repoDir, '.fit')
-cacheDir = path.join(fitDir, 'cache')
-objectsDir = path.join(cacheDir, 'objects')
-savesDir = path.join(cacheDir, 'saves')
-commitsDir = path.join(cacheDir, 'commits')
-lruFile = path.join(cacheDir, 'lru')
-statFile = path.join(fitDir, 'stat')
-addedStatFile = path.join(fitDir, 'stat.added')
-mergeMineFitFile = path.join(fitDir, 'merge-mine')
-mergeOtherFitFile = path.join(fitDir, 'merge-other')
-tempDir = path.join(fitDir, 'temp')
-fitManifestItemsTempDir = path.join(fitDir, 'manifest_items_tmp')
-
-_fitFileItemRgx = re.compile('([^:]+):\[([^,]+),(\d+)\],?')
+
+def _contextPath(parent, name):
+    return property(lambda self: path.join(getattr(self, parent), name))
+
+# The directory/file paths we're interested in. Nothing is resolved on import;
+# the first time any of them is needed, both the working tree root and the
+# git directory are determined with a single git call, so that commands that
+# never touch the repository (like the diff textconv) don't pay for it.
+class RepoContext(object):
+    def __init__(self):
+        self._dirs = None
+
+    def _resolve(self):
+        if self._dirs == None:
+            p = popen('git rev-parse --show-toplevel --git-dir'.split(), stdout=PIPE)
+            out = p.communicate()[0].split('\n')
+            if p.returncode != 0:
+                raise Exception('Could not determine git working tree.')
+            # --git-dir may be relative to the current directory, which
+            # operations on the repo are free to change afterwards
+            self._dirs = out[0], path.abspath(out[1])
+        return self._dirs
+
+    def _getCacheDir(self):
+        sharedDir = gitConfig('fit.cache.dir')
+        return path.join(self.repoDir, path.expanduser(sharedDir)) if sharedDir else self.repoCacheDir
+
+    repoDir = property(lambda self: self._resolve()[0])
+    gitDir = property(lambda self: self._resolve()[1])
+    fitDir = _contextPath('gitDir', 'fit')
+    fitFile = _contextPath('repoDir', '.fit')
+    # The object cache may be shared with other repositories (see cache.py),
+    # the saves and commits bookkeeping is always this repository's own
+    repoCacheDir = _contextPath('fitDir', 'cache')
+    cacheDir = property(lambda self: self._getCacheDir())
+    isCacheShared = property(lambda self: self.cacheDir != self.repoCacheDir)
+    objectsDir = _contextPath('cacheDir', 'objects')
+    savesDir = _contextPath('repoCacheDir', 'saves')
+    commitsDir = _contextPath('repoCacheDir', 'commits')
+    lruFile = _contextPath('cacheDir', 'lru')
+    cacheIndexFile = _contextPath('cacheDir', 'index')
+    cacheTempDir = _contextPath('cacheDir', 'tmp')
+    repoIdFile = _contextPath('fitDir', 'repo-id')
+    statFile = _contextPath('fitDir', 'stat')
+    addedStatFile = _contextPath('fitDir', 'stat.added')
+    mergeMineFitFile = _contextPath('fitDir', 'merge-mine')
+    mergeOtherFitFile = _contextPath('fitDir', 'merge-other')
+    tempDir = _contextPath('fitDir', 'temp')
+    binaryMemoFile = _contextPath('fitDir', 'binary')
+    watcherSocket = _contextPath('fitDir', 'watcher.sock')
+    watcherPidFile = _contextPath('fitDir', 'watcher.pid')
+    # Guards the .fit file and the state in fitDir (see locking.py). Setup
+    # replaces fitDir as a whole, so its lock is kept outside of it.
+    lockFile = _contextPath('fitDir', 'lock')
+    setupLockFile = _contextPath('gitDir', 'fit-setup.lock')
+    fitManifestItemsTempDir = _contextPath('fitDir', 'manifest_items_tmp')
+
+context = RepoContext()
+
+_gzipMagic = '\x1f\x8b'
 zeroByteSha1 = 'e69de29bb2d1d6434b8b29ae775ad8c2e48c5391'
 
 # Parameterized decorator that will wrap the decoratee with a cd into the git directory
@@ -84,84 +129,234 @@ def gitDirOperation(arg):
 
     return wrapper if isParameterized else decorator
 
+# Decorator that wraps the decoratee with a cd into the root of the working
+# tree (resolved when the decoratee is first called, not when decorated)
+def repoDirOperation(func):
+    def decorator(*args, **kwargs):
+        return gitDirOperation(context.repoDir)(func)(*args, **kwargs)
+    return decorator
+
+# Nanosecond timestamps are used where the interpreter provides them, since
+# float seconds can make two writes in quick succession look identical
 def fitStats(filename):
     stats = stat(filename)
-    return stats.st_size, stats.st_mtime, stats.st_ctime, stats.st_ino
-
-def readFitFile(filePath=fitFile, rev=None):
+    return (
+        stats.st_size,
+        getattr(stats, 'st_mtime_ns', stats.st_mtime),
+        getattr(stats, 'st_ctime_ns', stats.st_ctime),
+        stats.st_ino
+    )
+
+def _fitStatsBatch(batch):
+    return [(i, fitStats(i)) for i in batch]
+
+# Batches items by directory, so that each worker stats entries of the same
+# directory back-to-back while its metadata is hot, and the batches of many
+# directories are stat'ed concurrently. This hides most of the per-call
+# latency of stat on network file systems. Below _statThreadingThreshold
+# items a plain loop is cheaper than starting the threads.
+_statThreadingThreshold = 256
+_statBatchSize = 256
+
+def _getStatBatches(items):
+    byDir = {}
+    for i in items:
+        byDir.setdefault(path.dirname(i), []).append(i)
+    for d in sorted(byDir):
+        dirItems = byDir[d]
+        for j in xrange(0, len(dirItems), _statBatchSize):
+            yield dirItems[j:j+_statBatchSize]
+
+def getStatJobs():
+    jobs = gitConfig('fit.stat.jobs')
+    return int(jobs) if jobs else 16
+
+# Returns {item: fitStats(item)} for all the given items
+def collectStats(items, jobs=None):
+    jobs = getStatJobs() if jobs == None else jobs
+    if jobs <= 1 or len(items) < _statThreadingThreshold:
+        return {i:fitStats(i) for i in items}
+
+    pool = ThreadPool(jobs)
+    try:
+        stats = {}
+        for batch in pool.imap_unordered(_fitStatsBatch, _getStatBatches(items)):
+            stats.update(batch)
+        return stats
+    finally:
+        pool.terminate()
+        pool.join()
+
+def readFitFile(filePath=None, rev=None):
     if rev:
-        fitDataString = _getFitDataStringForRev(rev=rev)
-        try:
-            return load(gz(None,None,None,StringIO(fitDataString)))
-        except:
-            return fitTreeToMap(_readFitFileRec(StringIO(fitDataString)))
-    elif not (path.exists(filePath) and path.getsize(filePath) > 0):
+        return readFitBlob('%s:.fit'%rev)
+
+    filePath = filePath or context.fitFile
+    if not (path.exists(filePath) and path.getsize(filePath) > 0):
         return {}
-    else:
-        try:
-            return load(gz(filePath))
-        except:
-            fitFileIn = open(filePath)
-            fitData = fitTreeToMap(_readFitFileRec(fitFileIn))
-            fitFileIn.close()
-            return fitData
-    
-def _readFitFileRec(fitFileIn):
-    items = {}
+    fitFileIn = open(filePath, 'rb')
+    try:
+        return _parseFitData(fitFileIn)
+    finally:
+        fitFileIn.close()
+
+# Sniff the format (gzipped JSON, v2 or text) once up front instead of
+# attempting a gunzip and falling back to the text parser on whatever
+# exception that raises
+def _parseFitData(fitFileIn):
+    header = fitFileIn.read(8)
+    fitFileIn.seek(0)
+    if header.startswith(_gzipMagic):
+        return load(gz(None,None,None,fitFileIn))
+    if isManifestData(header):
+        return decodeManifest(fitFileIn.read())
+    return {p:[h,s] for p,h,s in iterFitItems(fitFileIn)}
+
+_objectReader = []
+
+# The one git cat-file --batch process of this process, see gitobjects.py
+def getObjectReader():
+    if not _objectReader:
+        _objectReader.append(BatchReader(context.repoDir))
+    return _objectReader[0]
+
+# The last few parsed .fit blobs, by blob id
+_fitBlobCache = OrderedDict()
+_fitBlobCacheSize = 8
+
+# Returns the fit data of the given .fit blob, named by anything git rev-parse
+# accepts (e.g. "HEAD:.fit" or a blob id). Blobs that were read before are not
+# parsed again. Callers get a copy of the dict, but its [hash, size] values
+# are shared between callers and must not be modified in place.
+def readFitBlob(name):
+    blobId, data = getObjectReader().read(name)
+    if blobId == None:
+        return {}
+
+    fitData = _fitBlobCache.pop(blobId, None)
+    if fitData == None:
+        fitData = _parseFitData(StringIO(data))
+        if len(_fitBlobCache) >= _fitBlobCacheSize:
+            _fitBlobCache.popitem(last=False)
+    _fitBlobCache[blobId] = fitData
+    return dict(fitData)
+
+# Yields a flat (path, hash, size) record for every item of a text-format .fit
+# file. The format nests a "name:{" ... "}" block per directory level, so the
+# currently open directories are kept on a stack of path prefixes rather than
+# being recursed into, and no intermediate tree is ever built.
+def iterFitItems(fitFileIn):
+    prefixes = ['']
     for l in fitFileIn:
         l = l.strip()
-        if l.endswith('{'):
-            items[l.split(':')[0]] = _readFitFileRec(fitFileIn)
-        elif l in ('}', '},') :
-            break
+        if not l:
+            continue
+        if l[-1] == '{':
+            prefixes.append('%s%s/'%(prefixes[-1], l[:l.index(':')]))
+        elif l in ('}', '},'):
+            # Only a line of its own closes a block, file names may start with }
+            prefixes.pop()
         else:
-            parts = list(_fitFileItemRgx.match(l).groups())
-            items[parts[0]] = [parts[1], int(parts[2])]
-    return items
-
-def writeFitFile(fitData, filePath=fitFile):
-    fitFileOut = open(filePath, 'wb')
-    _writeFitFileRec(fitFileOut, fitMapToTree(fitData))
+            sepIdx = l.index(':')
+            item = l[sepIdx+2:l.rindex(']')]
+            objHash, size = item.split(',')
+            yield prefixes[-1]+l[:sepIdx], objHash, int(size)
+
+# Items are written in the order the original recursive writer produced: at
+# every directory level, files before subdirectories, each group sorted by
+# name. Sorting the flat paths once by a key that prefixes directory
+# components with \x02 (and terminates them with \x00) and the file name
+# with \x01 yields exactly that order, so the file can be streamed out.
+def _fitPathSortKey(p):
+    sepIdx = p.rfind('/')
+    if sepIdx < 0:
+        return '\x01'+p
+    return '\x02%s\x00\x01%s'%(p[:sepIdx].replace('/', '\x00\x02'), p[sepIdx+1:])
+
+# The binary v2 format (see manifest.py) is written instead of the text format
+# if the fit.manifest.format config is set to v2. The file is written next to
+# filePath and then renamed over it, so that it's never seen half-written.
+def writeFitFile(fitData, filePath=None):
+    filePath = filePath or context.fitFile
+    tempPath = newTempFile(filePath)
+    try:
+        _writeFitData(fitData, tempPath)
+        publish(tempPath, filePath)
+    except:
+        discard(tempPath)
+        raise
+
+def _writeFitData(fitData, filePath):
+    if gitConfig('fit.manifest.format') == 'v2':
+        try:
+            data = encodeManifest(fitData)
+        except ValueError:
+            # Only SHA-1 hashes fit into v2, anything else stays readable as text
+            data = None
+        if data != None:
+            fitFileOut = open(filePath, 'wb')
+            fitFileOut.write(data)
+            fitFileOut.close()
+            return
+
+    fitFileOut = open(filePath, 'wb', 1 << 20)
+    write = fitFileOut.write
+
+    currentDir = ''
+    openDirs = []
+    # Whether the last written line is still missing its terminator, which
+    # is either ",\n" or "\n" depending on whether a sibling follows it
+    pending = False
+    for p in sorted(fitData, key=_fitPathSortKey):
+        sepIdx = p.rfind('/')
+        fileDir = p[:sepIdx] if sepIdx >= 0 else ''
+
+        if fileDir != currentDir:
+            dirs = fileDir.split('/') if fileDir else []
+            common = 0
+            for a,b in zip(openDirs, dirs):
+                if a != b:
+                    break
+                common += 1
+
+            for d in openDirs[common:]:
+                write('\n}' if pending else '}')
+                pending = True
+            for d in dirs[common:]:
+                write(',\n%s:{\n'%d if pending else '%s:{\n'%d)
+                pending = False
+            openDirs = dirs
+            currentDir = fileDir
+
+        objHash, size = fitData[p]
+        write((',\n%s:[%s,%s]' if pending else '%s:[%s,%s]')%(p[sepIdx+1:], objHash, size))
+        pending = True
+
+    for d in openDirs:
+        write('\n}')
+    if pending:
+        write('\n')
     fitFileOut.close()
 
-def _dictItemComparator(a,b):
-    if type(a[1]) == type(b[1]):
-        return -1 if a[0] < b[0] else (1 if a[0] > b[0] else 0)
-    if type(a[1]) == type({}):
-        return 1
-    return -1
-
-def _writeFitFileRec(fitFileOut, fitData):
-    if len(fitData) == 0:
-        return
-
-    items = sorted(fitData.iteritems(), cmp=_dictItemComparator)
-    for k,v in items[:-1]:
-        _writeFitFileItem(fitFileOut, k, v)
-    k,v = items[-1]
-    _writeFitFileItem(fitFileOut, k, v, sep='')
-
-def _writeFitFileItem(fitFileOut, k,v, sep=','):
-    if type(v) == type({}):
-        print >>fitFileOut, '%s:{'%k
-        _writeFitFileRec(fitFileOut, v)
-        print >>fitFileOut, '}'+sep
-    else:
-        print >>fitFileOut, ('%s:[%s,%s]'+sep)%(k,v[0],v[1])
-
 def printAsText(fitData):
     items = sorted([(b[:7],a) for a,(b,c) in  fitData.iteritems()], key=lambda i:i[1])
     print '\n'.join(['%s %s'%(h,p) for h,p in items])
 
-# The stat file is a Python-pickled dictionary of the following form:
-#   {filename --> (st_size, st_mtime, st_ctime, st_ino, checksum_hash)}
-def readStatFile(filePath=statFile):
-    return load(open(filePath)) if path.exists(filePath) else {}
-
-def writeStatFile(stats, filePath=statFile):
-    statOut = open(filePath, 'wb')
-    dump(stats, statOut)
-    statOut.close()
+# The stat file is an sqlite database (see statdb.StatStore) of the form:
+#   {filename --> (checksum_hash, (st_size, st_mtime, st_ctime, st_ino))}
+def readStatFile(filePath=None):
+    filePath = filePath or context.statFile
+    store = StatStore(filePath)
+    stats = store.items()
+    store.close()
+    return stats
+
+def writeStatFile(stats, filePath=None):
+    filePath = filePath or context.statFile
+    store = StatStore(filePath)
+    store.clear()
+    store.update(stats.iteritems())
+    store.close()
 
 def _gitHashInputProducer(stream, items):
     for j in items:
@@ -169,47 +364,126 @@ def _gitHashInputProducer(stream, items):
         stream.flush()
     stream.close()
 
-@gitDirOperation(repoDir)
-def computeHashes(items):
+# Returns the number of processes to hash objects with, as configured by
+# fit.hash.jobs (defaulting to one per CPU). Zero means hashing is left to a
+# "git hash-object" subprocess, which is also what is used when git could
+# apply eol conversions that the in-process hashing engine does not do.
+def getHashJobs():
+    if gitConfig('core.autocrlf').lower() in ('true', 'input'):
+        return 0
+    jobs = gitConfig('fit.hash.jobs')
+    return int(jobs) if jobs else cpu_count()
+
+# The attributes that make git convert or filter a file as it hashes it
+_conversionAttributes = ['text', 'eol', 'filter', 'ident']
+
+# Returns those of the given paths whose object ids git computes from their
+# converted or filtered contents (as core.autocrlf or their text, eol, filter
+# or ident attributes have it), which only git can hash
+def getConvertedPaths(paths):
+    paths = list(paths)
+    if not paths:
+        return set()
+    if gitConfig('core.autocrlf').lower() in ('true', 'input'):
+        return set(paths)
+    p = popen(['git', 'check-attr', '-z', '--stdin'] + _conversionAttributes, stdin=PIPE, stdout=PIPE, cwd=context.repoDir)
+    fields = p.communicate(''.join(f + '\0' for f in paths))[0].split('\0')
+    if p.returncode != 0:
+        raise Exception('error: Could not read the git attributes of fit items.')
+    # <path> NUL <attribute> NUL <value> NUL for each path and attribute
+    return {fields[i] for i in xrange(0, len(fields) - 2, 3) if fields[i+2] not in ('unspecified', 'unset')}
+
+# Returns the object id git gives data (an iterable of strings) as the
+# contents of a file at path, i.e. after converting or filtering it as it
+# would there
+def gitHashData(data, path):
+    p = popen(['git', 'hash-object', '--stdin', '--path', path], stdin=PIPE, stdout=PIPE, cwd=context.repoDir)
+    for d in data:
+        p.stdin.write(d)
+    p.stdin.close()
+    objHash = p.stdout.read().strip()
+    p.wait()
+    return objHash
+
+@repoDirOperation
+def computeHashes(items, sizes=None):
     if not items:
         return []
 
-    hashes = []
     numItems = len(items)
     numDigits = str(len(str(numItems)+''))
     progress_fmt = ('\rComputing hashes for new objects...%6.2f%%  '+'%'+numDigits+'s/%'+numDigits+'s')
     print progress_fmt%(0, 0, numItems),
+
+    jobs = min(getHashJobs(), numItems)
+    # Files that git converts or filters are left to it
+    converted = getConvertedPaths(items) if jobs > 0 else set(items)
+    ownItems = [i for i in items if i not in converted]
+    pool = None
+    if jobs > 1 and len(ownItems) > 1:
+        try:
+            pool = Pool(min(jobs, len(ownItems)))
+        except OSError:
+            converted, ownItems = set(items), []
+    hashes = {}
+    try:
+        for n,(i,h) in enumerate(iterBlobHashes(ownItems, sizes=sizes, pool=pool)):
+            hashes[ownItems[i]] = h
+            print progress_fmt%((n+1)*100./numItems, n+1, numItems),
+            stdout.flush()
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    gitItems = [i for i in items if i in converted]
+    if gitItems:
+        hashes.update(zip(gitItems, _gitComputeHashes(gitItems, progress_fmt, len(ownItems), numItems)))
+    hashes = [hashes[i] for i in items]
+
+    print '\r'+(' '*(45+int(numDigits)*2))+'\r',
+    return hashes
+
+def _gitComputeHashes(items, progress_fmt, i=0, numItems=None):
+    hashes = []
+    numItems = numItems or len(items)
     p = popen('git hash-object --stdin-paths'.split(), stdin=PIPE, stdout=PIPE)
     thread(target=_gitHashInputProducer, args=(p.stdin,items)).start()
-    i = 0
     for l in p.stdout:
         hashes.append(l.strip())
         i += 1
         print progress_fmt%(i*100./numItems, i, numItems),
         stdout.flush()
-    print '\r'+(' '*(45+int(numDigits)*2))+'\r',
     return hashes
 
-@gitDirOperation(repoDir)
-def refreshStats(items, filePath=statFile):
-    stats = readStatFile(filePath=filePath)
-    for i in items:
-        stats[i] = (items[i], fitStats(i))
-    writeStatFile(stats, filePath=filePath)
-
-@gitDirOperation(repoDir)
-def updateStats(items, filePath=statFile):
-    oldStats = readStatFile(filePath=filePath)
+@repoDirOperation
+def refreshStats(items, filePath=None):
+    filePath = filePath or context.statFile
+    stats = collectStats(items)
+    store = StatStore(filePath)
+    store.update((i, (items[i], stats[i])) for i in items)
+    store.close()
+
+# Only the stored stats of the given items are read and written back, stats of
+# any other items in the stat file are left untouched. Items in unchanged are
+# known not to have changed since their stats were stored (see watcher.py),
+# so those that have stored stats are not stat'ed again.
+@repoDirOperation
+def updateStats(items, filePath=None, unchanged=None):
+    filePath = filePath or context.statFile
+    store = StatStore(filePath)
+    oldStats = store.get(items)
     newStats = {}
     stubs = []
     skippedFiles = []
-    for i in items:
-        stats = fitStats(i)
+    if unchanged:
+        newStats.update((i,tuple(oldStats[i][1])) for i in unchanged if i in oldStats)
+        items = [i for i in items if i not in newStats]
+    for i,stats in collectStats(items).iteritems():
         if stats[0] > 0:
             newStats[i] = stats
         else:
             # compare the extension with the skipExtensions list, and add to stubs only if required.
-            if path.splitext(i)[-1].lower() in map(str.lower, downstreamSkipExtensionsCaseInsensitive) or path.splitext(i)[-1] in downstreamSkipExtensionsCaseSensitive:
+            if isSkippedExtension(i):
                 skippedFiles.append(i)
             else:
                 stubs.append(i)
@@ -219,76 +493,100 @@ def updateStats(items, filePath=statFile):
     # be considered "modified". Modified items are those that are touched
     # AND whose checksums are different, so we do checksum comparisons next
     touched = [i for i,s in newStats.iteritems() if i not in oldStats or tuple(oldStats[i][1]) != s]
-    touched = dict(zip(touched, computeHashes(touched)))
-
-    statsUpdated = False
-    if len(touched) > 0:
-        statsUpdated = True
-        for i,h in touched.iteritems():
-            oldStats[i] = (h,newStats[i])
-    if len(newStats) != len(oldStats):
-        statsUpdated = True
-        for s in set(oldStats) - set(newStats):
-            del oldStats[s]
-    if statsUpdated:
-        writeStatFile(oldStats, filePath=filePath)
-
-    return oldStats, stubs
+    touched = dict(zip(touched, computeHashes(touched, sizes={i:newStats[i][0] for i in touched})))
+
+    stats = {i:oldStats[i] for i in newStats if i not in touched}
+    stats.update((i,(h,newStats[i])) for i,h in touched.iteritems())
+
+    store.update((i,stats[i]) for i in touched)
+    store.delete(i for i in oldStats if i not in newStats)
+    store.close()
+
+    return stats, stubs
+
+# Drops the stored stats of items that are no longer around, which updateStats
+# leaves behind as it only looks at the items it is given. For runs that
+# looked at all items.
+def pruneStats(items, filePath=None):
+    store = StatStore(filePath or context.statFile)
+    store.prune(items)
+    store.close()
 
 def getFitSize(fitTrackedData):
     return sum(int(s) for p,(h,s) in fitTrackedData.iteritems())
 
 def getCommitFile(rev=None):
-    if not path.exists(commitsDir):
-        mkdir(commitsDir)
-    return path.join(commitsDir, rev or getHashForRevision() or '---')
+    if not path.exists(context.commitsDir):
+        mkdir(context.commitsDir)
+    return path.join(context.commitsDir, rev or getHashForRevision() or '---')
 
 def getHashForRevision(rev='HEAD'):
     return popen(('git rev-parse %s'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
 
-@gitDirOperation(repoDir)
 def _getFitDataStringForRev(rev):
-    return popen(('git show %s:.fit'%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0]
+    return getObjectReader().read('%s:.fit'%rev)[1] or ''
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def getFitManifestChanges(rev='HEAD@{1}'):
     lines = popen(("git diff-tree -r --name-only %s HEAD -- *.gitattributes .fit"%rev).split(), stdout=PIPE, stderr=open(devnull, 'wb')).communicate()[0].strip()
     return lines.split('\n') if lines else []
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def dirtyGitItemsFilter(items):
     lines = popen('git status --porcelain -u --ignored'.split() + list(items), stdout=PIPE).communicate()[0].rstrip()
     return [l.split(None, 1)[1] for l in lines.split('\n')] if lines else []
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def getStagedFitFileHash():
     return popen('git ls-files -s .fit'.split(), stdout=PIPE).communicate()[0].strip().split()[1]
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def getFitFileStatus():
     return popen('git status --porcelain -u --ignored .fit'.split(), stdout=PIPE).communicate()[0].rstrip()
 
-@gitDirOperation(repoDir)
-def filterBinaryFiles(files):
-    binaryFiles = []
-
-    p = popen('file -f -'.split(), stdout=PIPE, stdin=PIPE)
-    fileTypes = p.communicate('\n'.join(files))[0].strip().split('\n')
-
-    for f in fileTypes:
-        sepIdx = f.find(':')
-        filepath = f[:sepIdx]
-        if f.find('text', sepIdx) < 0:
-            binaryFiles.append(filepath)
-
-    return binaryFiles
-
+# Returns those of the given files that are binary. Passing the blob ids of the
+# files ({path: blob id}) lets their classification be memoised across runs,
+# it is then the blobs that are classified.
+@repoDirOperation
+def filterBinaryFiles(files, blobIds=None):
+    readBlob = lambda blobId, size: getObjectReader().read(blobId, size)[1]
+    classes = classifyFiles(files, blobIds=blobIds, memoFile=context.binaryMemoFile, readBlob=readBlob if blobIds else None)
+    return [f for f in files if classes[f]]
+
+# Stores are used from several threads at once (see objects.py), those that
+# can't be set threadSafe to False, and are used from one thread only.
+#
+# Stores may also provide batch versions of check, get and put, to answer for
+# and transfer many objects per call:
+#
+#   checkMany(keys)   returns {key: location} for those of the keys it has
+#   getMany(items)    gets [(location, dst, size)], returns the set of dsts
+#                     gotten
+#   putMany(items)    puts [(src, key, size)], returns the set of keys put
+#
+# Any of them that a store doesn't provide is done with a call per object.
+# Objects are only gotten and put in batches by stores that provide checkMany
+# too, so that it's known up front which ones there are to transfer.
+#
+# The size get is given is None for files that aren't known the size of until
+# they've been gotten (the recipes of chunked objects, see objects.py).
+#
+# Downloads are written to a partial file that is kept if they fail. Stores
+# that can continue a download set resumable to True, and get is then called
+# with the offset to continue from: dst holds that many bytes of the object
+# already, and only the rest of it is to be appended.
+#
+# Stores for network services can be asynchronous instead, see asyncstore.py.
 class DataStore:
+    threadSafe = True
+    resumable = False
+    asynchronous = False
+
     def __init__(self, progress):
         pass
     def check(self, dst):
         return None
-    def get(self, src, dst, size):
+    def get(self, src, dst, size, offset=0):
         return False
     def put(self, src, dst, size):
         return False
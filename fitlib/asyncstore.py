@@ -0,0 +1,97 @@
+from threading import BoundedSemaphore, Event, Lock
+
+# Stores that talk to a network service can be asynchronous: instead of
+# check, get and put, which wait for the transfer, they set asynchronous to
+# True and provide
+#
+#   checkAsync(key, done)
+#   getAsync(src, dst, size, offset, done, progress)
+#   putAsync(src, dst, size, done, progress)
+#
+# which start the transfer and return right away, and call done with what
+# check, get or put would have returned once it is over, from any thread (an
+# event loop of their own, say). Errors are reported by passing None, an
+# exception raised by the call itself fails only that transfer, and only the
+# first call of done counts. Progress is reported by calling progress(done,
+# size) of the transfer, also from any thread, rather than the callback the
+# store was made with, which can't tell which transfer it is about. The calls
+# are made from several threads at once.
+#
+# fit uses such a store through an AsyncStore, which has the synchronous and
+# batch methods of DataStore (see fitlib/__init__.py), and keeps up to
+# inFlight transfers going at once over all of them. Since that includes the
+# batch methods, get and put keep that many objects in flight with only a few
+# threads, however many objects there are.
+
+_waitTimeout = 1 << 20
+
+class AsyncStore:
+    threadSafe = True
+
+    # getProgress is called on the thread that starts a transfer, and returns
+    # the progress callback for it
+    def __init__(self, store, inFlight, getProgress):
+        self.store = store
+        self.resumable = getattr(store, 'resumable', False)
+        self.slots = BoundedSemaphore(inFlight)
+        self.getProgress = getProgress
+
+    # Starts method with each of the argument tuples, as slots become free,
+    # and returns the results once they're all done
+    def _runAll(self, method, argsList):
+        results = [None] * len(argsList)
+        if not argsList:
+            return results
+        remaining = [len(argsList)]
+        completed = [False] * len(argsList)
+        lock = Lock()
+        finished = Event()
+
+        def start(i, args):
+            def done(result):
+                lock.acquire()
+                try:
+                    if completed[i]:
+                        return
+                    completed[i] = True
+                    results[i] = result
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        finished.set()
+                finally:
+                    lock.release()
+                self.slots.release()
+            extra = (done,) if method == 'check' else (done, self.getProgress())
+            self.slots.acquire()
+            try:
+                getattr(self.store, method + 'Async')(*(args + extra))
+            except:
+                done(None)
+
+        for i,args in enumerate(argsList):
+            start(i, args)
+        # Waiting with a timeout can be interrupted (with Ctrl-C)
+        while not finished.wait(_waitTimeout):
+            pass
+        return results
+
+    def check(self, key):
+        return self._runAll('check', [(key,)])[0]
+
+    def get(self, src, dst, size, offset=0):
+        return self._runAll('get', [(src, dst, size, offset)])[0]
+
+    def put(self, src, dst, size):
+        return self._runAll('put', [(src, dst, size)])[0]
+
+    def checkMany(self, keys):
+        return {k:l for k,l in zip(keys, self._runAll('check', [(k,) for k in keys])) if l}
+
+    def getMany(self, items):
+        return {d for (s,d,n),r in zip(items, self._runAll('get', [(s, d, n, 0) for s,d,n in items])) if r}
+
+    def putMany(self, items):
+        return {d for (s,d,n),r in zip(items, self._runAll('put', list(items))) if r}
+
+    def close(self):
+        self.store.close()
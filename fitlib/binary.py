@@ -0,0 +1,134 @@
+from codecs import getincrementaldecoder
+from json import load, dumps
+from locking import writeFile
+from multiprocessing.pool import ThreadPool
+from os import path
+import re
+
+# A file is classified by sniffing the beginning of it, the same amount git
+# looks at to decide whether a blob is binary. It is binary if it contains a
+# NUL byte or control characters that don't occur in text files. Otherwise
+# it is text if it is valid UTF-8 (an incomplete sequence cut off at the end
+# of the sniffed data is fine), or if its non-ASCII bytes all are printable
+# characters of the ISO-8859 encodings. UTF-16 and UTF-32 text, which is
+# full of NUL bytes, is recognized by its byte order mark, or for UTF-16
+# without one, by NULs in at least half of the odd or of the even bytes and
+# none of the others (as in mostly ASCII text). It is text if it decodes to
+# characters that aren't control characters.
+_sniffSize = 8000
+_controlChars = re.compile('[\x00-\x07\x0e-\x1a\x1c-\x1f\x7f]')
+_c1ControlChars = re.compile('[\x80-\x9f]')
+# The UTF-32 ones first, as the little endian one starts with UTF-16's
+_byteOrderMarks = [
+    ('\xff\xfe\0\0', 'utf-32-le'),
+    ('\0\0\xfe\xff', 'utf-32-be'),
+    ('\xff\xfe', 'utf-16-le'),
+    ('\xfe\xff', 'utf-16-be'),
+]
+
+_threadingThreshold = 16
+_jobs = 16
+
+# Classifications are memoised by blob id, but only the latest few thousand
+# are kept around
+_maxMemoItems = 10000
+
+# Returns the encoding of UTF-16 or UTF-32 data and where its text starts, or
+# (None, 0)
+def _wideEncoding(data):
+    for bom,encoding in _byteOrderMarks:
+        if data.startswith(bom):
+            return encoding, len(bom)
+    if len(data) > 1:
+        even, odd = data[::2], data[1::2]
+        if odd.count('\0')*2 >= len(odd) and '\0' not in even:
+            return 'utf-16-le', 0
+        if even.count('\0')*2 >= len(even) and '\0' not in odd:
+            return 'utf-16-be', 0
+    return None, 0
+
+def isBinaryData(data):
+    encoding, start = _wideEncoding(data)
+    if encoding:
+        try:
+            text = getincrementaldecoder(encoding)().decode(data[start:], final=False)
+        except UnicodeDecodeError:
+            return True
+        return bool(_controlChars.search(text))
+    if _controlChars.search(data):
+        return True
+    try:
+        getincrementaldecoder('utf-8')().decode(data, final=False)
+        return False
+    except UnicodeDecodeError:
+        return bool(_c1ControlChars.search(data))
+
+def isBinaryFile(filePath):
+    try:
+        f = open(filePath, 'rb')
+    except IOError:
+        # Let git deal with whatever it is that can't be read
+        return False
+    data = f.read(_sniffSize)
+    f.close()
+    return isBinaryData(data)
+
+def _classify(filePath):
+    return filePath, isBinaryFile(filePath)
+
+def _classifyBlob(filePath, blobId, readBlob):
+    data = readBlob(blobId, _sniffSize)
+    return filePath, isBinaryData(data) if data != None else isBinaryFile(filePath)
+
+def _readMemo(memoFile):
+    if not path.exists(memoFile):
+        return {}
+    try:
+        return load(open(memoFile))
+    except ValueError:
+        return {}
+
+# Status runs at the same time may each write it, the last one wins
+def _writeMemo(memo, memoFile):
+    writeFile(memoFile, dumps(memo), 'w')
+
+# Returns {path: isBinary} for the given files. If blob ids are given for
+# them ({path: blob id}), results are looked up in and stored to memoFile,
+# and if readBlob is given as well (readBlob(blob id, size) returning the
+# first size bytes of a blob, see gitobjects.py), it is the blobs that are
+# sniffed rather than the files, which may have changed since they were
+# staged.
+def classifyFiles(files, blobIds=None, memoFile=None, readBlob=None):
+    blobIds = blobIds or {}
+    memo = _readMemo(memoFile) if memoFile and blobIds else {}
+
+    results = {}
+    unknown = []
+    for f in files:
+        blobId = blobIds.get(f)
+        if blobId in memo:
+            results[f] = memo[blobId]
+        else:
+            unknown.append(f)
+
+    if readBlob:
+        # One git process reads them all, one at a time
+        results.update(_classifyBlob(f, blobIds[f], readBlob) if f in blobIds else _classify(f) for f in unknown)
+    elif len(unknown) < _threadingThreshold:
+        results.update(_classify(f) for f in unknown)
+    else:
+        pool = ThreadPool(_jobs)
+        try:
+            results.update(pool.imap_unordered(_classify, unknown))
+        finally:
+            pool.terminate()
+            pool.join()
+
+    newMemo = {blobIds[f]:results[f] for f in unknown if f in blobIds}
+    if newMemo and memoFile and path.isdir(path.dirname(memoFile)):
+        if len(memo) + len(newMemo) > _maxMemoItems:
+            memo = {blobIds[f]:results[f] for f in files if f in blobIds}
+        memo.update(newMemo)
+        _writeMemo(memo, memoFile)
+
+    return results
@@ -1,185 +1,866 @@
-from . import lruFile, objectsDir
-from json import load,dump
-from os import remove, makedirs
-from os.path import exists
-from shutil import copyfile
+from . import context
+from config import gitConfig, gitConfigSize
+from statdb import _chunks, _maxQueryParams
+from hashlib import sha1
+from json import load
+from os import remove, rename, makedirs, link, write, stat, close as osclose
+from os.path import exists, isdir, basename, dirname, getsize, join as joinpath
+from shutil import copyfileobj, rmtree
+from filecopy import Copier, ingestMode
+from locking import acquire, release, isLocked
+from compression import getCodec, getSkipExtensions, isCompressible, compressFile, decompressFile
+import chunking
 from sys import stdout
+from time import time
+from tempfile import mkstemp
+from uuid import uuid4
+import sqlite3
 
-def _cacheIO(decoratee):
-    def decorator(*a, **k):
-        loaded = False
+# The cache index is an sqlite database with one row per cached object:
+#   key --> (size, lru counter, committed, size on disk, codec)
+# Objects with an lru counter are in the "lru" part of the cache, i.e. they
+# are available from the external data store and may be pruned, least
+# recently used first. All others are in the "map" part, which holds objects
+# that only exist locally. The total size on disk and counter of each part are
+# kept in the meta table.
+#
+# The cache can be shared by several repositories (e.g. the clones and
+# worktrees of one repository on a build machine), by pointing them all at
+# the same directory:
+#
+#   > git config fit.cache.dir /var/cache/fit
+#
+# The saves and commits bookkeeping stays in each repository's own fit
+# directory, a cache of its own from before is imported (see
+# _importRepoCache). Objects in the map part belong to the repositories that saved
+# them, each with its own committed flag, in the owners table:
+#   (key, repository id) --> committed
+# An object leaves the map part once the last repository owning it no longer
+# needs it, or when it moves to the lru part (nobody needs to put it then).
+# Repositories are told apart by an id kept in their fit directory, rather
+# than by their path, which changes when a clone is moved. The committed
+# column of the objects table is not used anymore.
+#
+# Objects stored compressed (see compression.py) have the name of their
+# codec appended to their file name, e.g. objects/ab/cdef....zlib, so the
+# paths returned by find tell how to get at their contents (see extract).
+#
+# Large objects can be stored as chunks instead (see chunking.py). Their
+# object file, named with a .chunks suffix, is a recipe listing the chunks,
+# which are kept in objects/chunks and shared by all objects that contain
+# them. The chunks table counts the references to every chunk, and whether
+# it is known to be in the external data store already:
+#   key --> (size, references, uploaded)
+# A chunk is removed with the last object referring to it. The size of the
+# chunks is counted separately from that of the objects (whose size on disk
+# only is that of their recipe), and is included in the size of the lru part.
+#
+# Each public function below runs in a single transaction, and only the rows
+# it looks at are read or written. Transactions that may write take the write
+# lock on the index up front, so that the totals they read can't change
+# before they write them back, and processes using the cache at the same time
+# wait for each other (for up to _lockTimeout seconds). Those that only read
+# (find without updating the lru counters, size, and the like) take no more
+# than a read lock, and run alongside each other and alongside a writer until
+# it commits. Object and chunk files are
+# written under a temporary name and renamed into place, and insert does so
+# before it takes the lock, so that other processes don't have to wait for
+# it to copy large files. Files are only ever removed with the lock held,
+# along with their rows. Using an object bumps its lru counter to
+# the next value of the (never reset) global one, and the index on the lru
+# column lets prune walk from the least recently used object up, stopping as
+# soon as enough has been evicted.
+#
+# The cache can be kept to a size (on disk) with fit.cache.maxSize. Every
+# insert checks it, and once the cache grows past fit.cache.highWatermark
+# percent of it, objects are evicted from the lru part until it is down to
+# fit.cache.lowWatermark percent, so that it isn't pruned a little on every
+# command once it is full:
+#
+#   > git config fit.cache.maxSize 50g
+#
+# Only the lru part is evicted from, as the map part holds the only copy of
+# its objects. An object moves from the map part to the lru part as soon as
+# it is known to be in the external data store (when put sends it or finds
+# it there already), which is when it can be aged out.
+
+_schemaVersion = 6
+_scanThreshold = 10000
+_lockTimeout = 600
+_orphanGracePeriod = 24*3600
+_defaultHighWatermark = 90
+_defaultLowWatermark = 80
+
+# Returns the id the map part entries of this repository are owned by
+def _repoId():
+    idFile = context.repoIdFile
+    if not exists(idFile):
+        # Whichever process links its id into place first wins
+        tempHandle, tempPath = mkstemp(dir=context.fitDir)
+        write(tempHandle, uuid4().hex)
+        osclose(tempHandle)
+        try:
+            link(tempPath, idFile)
+        except OSError:
+            pass
+        remove(tempPath)
+    return open(idFile).read().strip()
+
+def _makedirs(dirPath):
+    try:
+        makedirs(dirPath)
+    except OSError:
+        # Made by another process in the meantime
+        if not isdir(dirPath):
+            raise
+
+def _connect(filePath):
+    conn = sqlite3.connect(filePath, timeout=_lockTimeout)
+    conn.text_factory = str
+    if conn.execute('PRAGMA user_version').fetchone()[0] < _schemaVersion:
+        # Upgraded in one transaction, which statements other than queries
+        # would commit unless transactions are left entirely to us
+        conn.isolation_level = None
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 1:
+            conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER, lru INTEGER, committed INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+            conn.executemany('INSERT OR IGNORE INTO meta VALUES (?,0)', [('lruSize',), ('lruCount',), ('mapSize',)])
+        if version < 2:
+            # Keeps the lru part of the cache in least recently used order
+            conn.execute('CREATE INDEX IF NOT EXISTS objectsLru ON objects (lru) WHERE lru IS NOT NULL')
+        if version < 3:
+            conn.execute('ALTER TABLE objects ADD COLUMN diskSize INTEGER')
+            conn.execute('ALTER TABLE objects ADD COLUMN codec TEXT')
+            conn.execute('UPDATE objects SET diskSize = size')
+        if version < 4:
+            conn.execute('CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, size INTEGER, refs INTEGER, uploaded INTEGER)')
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('chunkSize',0)")
+        if version < 5:
+            conn.execute('CREATE TABLE IF NOT EXISTS owners (key TEXT, repo TEXT, committed INTEGER, PRIMARY KEY (key, repo))')
+            # Caches were not shared before
+            if conn.execute('SELECT 1 FROM objects WHERE lru IS NULL LIMIT 1').fetchone():
+                conn.execute('INSERT OR IGNORE INTO owners SELECT key, ?, committed FROM objects WHERE lru IS NULL', (_repoId(),))
+                conn.execute('UPDATE objects SET committed = 0')
+        if version < 6:
+            # How many objects in the map part refer to each chunk
+            conn.execute('ALTER TABLE chunks ADD COLUMN mapRefs INTEGER DEFAULT 0')
+            conn.execute('INSERT OR IGNORE INTO meta VALUES (?,?)',
+                ('mapChunkSize', _countMapRefs(conn, joinpath(dirname(filePath), 'objects'))))
+        conn.execute('PRAGMA user_version = %d'%_schemaVersion)
+        conn.execute('COMMIT')
+        conn.isolation_level = ''
+    return conn
+
+# Sets how many objects in the map part refer to each chunk from their
+# recipes, returns the size of the chunks they refer to
+def _countMapRefs(conn, objectsDir):
+    refs = {}
+    for (k,) in conn.execute("SELECT key FROM objects WHERE lru IS NULL AND codec = 'chunks'").fetchall():
+        try:
+            recipe = readRecipe(_objectPath(k, objectsDir, 'chunks'))
+        except IOError:
+            continue
+        for c,s in recipe:
+            refs[c] = refs.get(c, 0) + 1
+    conn.execute('UPDATE chunks SET mapRefs = 0')
+    conn.executemany('UPDATE chunks SET mapRefs = ? WHERE key = ?', ((r, c) for c,r in refs.iteritems()))
+    return conn.execute('SELECT SUM(size) FROM chunks WHERE mapRefs > 0').fetchone()[0] or 0
+
+# Older versions of fit kept the cache index as a single JSON document in the
+# lru file. It is converted into a database next to it, which is then moved
+# into place before the JSON file is removed. Processes that find the lru
+# file at the same time take turns, those that come after the first find it
+# gone.
+def _migrateLruFile(lruFile, dbFile):
+    lockFile = lruFile + '.lock'
+    acquire(lockFile, exclusive=True, quiet=True)
+    try:
+        if exists(lruFile):
+            _migrateLruData(lruFile, dbFile)
+    finally:
+        release(lockFile)
+
+def _migrateLruData(lruFile, dbFile):
+    try:
+        data = load(open(lruFile))
+    except ValueError:
+        # The objects are still there, but without an index they are unknown
+        data = {'lru':{'size':0,'count':0,'items':{}},'map':{'size':0,'items':{}}}
+    tempPath = dbFile + '.migrating'
+    if exists(tempPath):
+        remove(tempPath)
+    conn = _connect(tempPath)
+    conn.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,?,0,?,NULL)',
+        ((k, s, c, s) for k,(s,c) in data['lru']['items'].iteritems()))
+    conn.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,NULL,0,?,NULL)',
+        ((k, s, s) for k,(s,c) in data['map']['items'].iteritems()))
+    repo = _repoId()
+    conn.executemany('INSERT OR REPLACE INTO owners VALUES (?,?,?)',
+        ((k, repo, int(c)) for k,(s,c) in data['map']['items'].iteritems()))
+    conn.executemany('UPDATE meta SET value = ? WHERE key = ?', [
+        (data['lru']['size'], 'lruSize'), (data['lru']['count'], 'lruCount'), (data['map']['size'], 'mapSize')])
+    conn.commit()
+    conn.close()
+    rename(tempPath, dbFile)
+    remove(lruFile)
+
+# A repository that is pointed at a shared cache may have a cache of its own
+# from before. Its objects are inserted into the shared one, along with which
+# of them this repository saved and committed (the map part holds the only
+# copy of those), and then it is removed. Processes of the repository that
+# find it at the same time take turns, and those that come after the first
+# find it gone.
+def _importRepoCache():
+    repoCacheDir = context.repoCacheDir
+    lockFile = joinpath(repoCacheDir, 'import.lock')
+    acquire(lockFile, exclusive=True, quiet=True)
+    try:
+        dbFile = joinpath(repoCacheDir, 'index')
+        if exists(joinpath(repoCacheDir, 'lru')):
+            _migrateLruFile(joinpath(repoCacheDir, 'lru'), dbFile)
+        if not exists(dbFile):
+            return
+        conn = _connect(dbFile)
+        rows = conn.execute('SELECT o.key, o.size, o.lru, w.committed, o.codec FROM objects o '
+            'LEFT JOIN owners w ON w.key = o.key AND w.repo = ?', (_repoId(),)).fetchall()
+        conn.close()
+
+        objectsDir = joinpath(repoCacheDir, 'objects')
+        committed = []
+        for k,s,c,m,x in rows:
+            objPath = _objectPath(k, objectsDir, x)
+            if not exists(objPath):
+                continue
+            if not x:
+                insert({k: (s, objPath)}, inLru=c != None)
+            else:
+                tempPath = _newTempFile()
+                try:
+                    if x == 'chunks':
+                        assemble([_chunkPath(cn, objectsDir) for cn,cs in readRecipe(objPath)], tempPath)
+                    else:
+                        decompressFile(x, objPath, tempPath)
+                    insert({k: (s, tempPath)}, inLru=c != None)
+                finally:
+                    remove(tempPath)
+            if m:
+                committed.append(k)
+        commit(committed)
+
+        for n in ['objects', 'tmp']:
+            isdir(joinpath(repoCacheDir, n)) and rmtree(joinpath(repoCacheDir, n))
+        remove(dbFile)
+    finally:
+        release(lockFile)
+
+class _Index:
+    def __init__(self, conn, repo):
+        self.conn = conn
+        self.repo = repo
+        self.lruSize, self.lruCount, self.mapSize, self.chunkSize, self.mapChunkSize = [
+            self._meta(k) for k in ('lruSize', 'lruCount', 'mapSize', 'chunkSize', 'mapChunkSize')]
+
+    def _meta(self, key):
+        return self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+
+    # Returns {key: (size, lru counter, committed, size on disk, codec)} for
+    # the given keys that are in the cache, committed being None unless the
+    # object is in the map part for this repository
+    def get(self, keys):
+        rows = {}
+        query = ('SELECT o.key, o.size, o.lru, w.committed, o.diskSize, o.codec FROM objects o '
+            'LEFT JOIN owners w ON w.key = o.key AND w.repo = ?')
+        if len(keys) > _scanThreshold:
+            # Cheaper to read all rows than to look up this many one by one
+            keys = set(keys)
+            for row in self.conn.execute(query, (self.repo,)):
+                if row[0] in keys:
+                    rows[row[0]] = row[1:]
+            return rows
+        for chunk in _chunks(keys, _maxQueryParams - 1):
+            chunkQuery = query + ' WHERE o.key IN (%s)'%','.join('?'*len(chunk))
+            rows.update((row[0], row[1:]) for row in self.conn.execute(chunkQuery, [self.repo] + chunk))
+        return rows
+
+    # Takes an iterable of (key, (size, lru counter, size on disk, codec))
+    def setLru(self, items):
+        self.conn.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,?,0,?,?)', ((k,s,c,d,x) for k,(s,c,d,x) in items))
+
+    def bumpLru(self, items):
+        self.conn.executemany('UPDATE objects SET lru = ? WHERE key = ?', ((c,k) for k,c in items))
+
+    # Takes an iterable of (key, (size, committed, size on disk, codec)),
+    # which this repository owns
+    def setMap(self, items):
+        items = list(items)
+        self.conn.executemany('INSERT OR REPLACE INTO objects VALUES (?,?,NULL,0,?,?)', ((k,s,d,x) for k,(s,c,d,x) in items))
+        self.conn.executemany('INSERT OR REPLACE INTO owners VALUES (?,?,?)', ((k,self.repo,int(c)) for k,(s,c,d,x) in items))
+
+    # Gives up this repository's claim on objects, or that of all of them
+    def disown(self, keys, allRepos=False):
+        for chunk in _chunks(keys, _maxQueryParams - 1):
+            query = 'DELETE FROM owners WHERE key IN (%s)'%','.join('?'*len(chunk))
+            if allRepos:
+                self.conn.execute(query, chunk)
+            else:
+                self.conn.execute(query + ' AND repo = ?', chunk + [self.repo])
+
+    # Returns the given keys that some repository owns
+    def getOwned(self, keys):
+        owned = set()
+        for chunk in _chunks(keys):
+            query = 'SELECT DISTINCT key FROM owners WHERE key IN (%s)'%','.join('?'*len(chunk))
+            owned.update(k for (k,) in self.conn.execute(query, chunk))
+        return owned
 
-        if k.get('data') == None:
-            loaded = True
-            k['data'] = load(open(lruFile)) if exists(lruFile) else {'lru':{'size':0,'count':0,'items':{}},'map':{'size':0,'items':{}}}
+    def delete(self, keys):
+        keys = list(keys)
+        for chunk in _chunks(keys):
+            self.conn.execute('DELETE FROM objects WHERE key IN (%s)'%','.join('?'*len(chunk)), chunk)
+        self.disown(keys, allRepos=True)
 
-        updated, r = decoratee(*a, **k)
+    def saveTotals(self):
+        self.conn.executemany('UPDATE meta SET value = ? WHERE key = ?', [
+            (self.lruSize, 'lruSize'), (self.lruCount, 'lruCount'), (self.mapSize, 'mapSize'), (self.chunkSize, 'chunkSize'),
+            (self.mapChunkSize, 'mapChunkSize')])
 
-        if loaded and updated:
-            f = open(lruFile, 'w')
-            dump(k['data'], f)
-            f.close()
+    # Returns {key: (size, references, uploaded, map part references)} for the
+    # given chunk keys
+    # that are in the cache
+    def getChunks(self, keys):
+        rows = {}
+        for chunk in _chunks(set(keys)):
+            query = 'SELECT * FROM chunks WHERE key IN (%s)'%','.join('?'*len(chunk))
+            rows.update((row[0], row[1:]) for row in self.conn.execute(query, chunk))
+        return rows
 
-        return r
+    # Takes an iterable of (key, size) with a new chunk, or another
+    # reference to a known one, for every chunk of an object. The object is
+    # in the map part unless its chunks are uploaded.
+    def addChunkRefs(self, chunks, uploaded=False):
+        mapRef = int(not uploaded)
+        for k,s in chunks:
+            if not self.conn.execute('UPDATE chunks SET refs = refs + 1, uploaded = max(uploaded, ?), mapRefs = mapRefs + ? WHERE key = ?',
+                    (int(uploaded), mapRef, k)).rowcount:
+                self.conn.execute('INSERT INTO chunks VALUES (?,?,1,?,?)', (k, s, int(uploaded), mapRef))
+                self.chunkSize += s
+                self.mapChunkSize += s*mapRef
+            elif mapRef and self.conn.execute('SELECT mapRefs FROM chunks WHERE key = ?', (k,)).fetchone()[0] == 1:
+                self.mapChunkSize += s
+
+    def setChunksUploaded(self, keys):
+        for chunk in _chunks(set(keys)):
+            self.conn.execute('UPDATE chunks SET uploaded = 1 WHERE key IN (%s)'%','.join('?'*len(chunk)), chunk)
+
+    # Drops the references of an object that leaves the map part to its
+    # chunks, those no other object in the map part refers to can be evicted
+    def unmapChunks(self, chunks):
+        for k,s in chunks:
+            if (self.conn.execute('UPDATE chunks SET mapRefs = mapRefs - 1 WHERE key = ? AND mapRefs > 0', (k,)).rowcount and
+                    self.conn.execute('SELECT mapRefs FROM chunks WHERE key = ?', (k,)).fetchone()[0] == 0):
+                self.mapChunkSize -= s
+
+    # Drops a reference to every chunk of an object, returns [(key, size)]
+    # of the chunks no object refers to anymore
+    def releaseChunks(self, chunks, inMap=False):
+        if inMap:
+            self.unmapChunks(chunks)
+        released = []
+        for k,s in chunks:
+            self.conn.execute('UPDATE chunks SET refs = refs - 1 WHERE key = ?', (k,))
+            if self.conn.execute('DELETE FROM chunks WHERE key = ? AND refs <= 0', (k,)).rowcount:
+                self.chunkSize -= s
+                released.append((k, s))
+        return released
+
+# Runs the decoratee in a transaction of its own, unless it is given the index
+# of one it is part of. The transaction is a read-only one if readOnly says
+# so, given the keyword arguments of the call.
+def _cacheIO(decoratee, readOnly=lambda k: False):
+    def decorator(*a, **k):
+        if k.get('index') != None:
+            return decoratee(*a, **k)[1]
+
+        exists(context.cacheDir) or _makedirs(context.cacheDir)
+        if exists(context.lruFile):
+            _migrateLruFile(context.lruFile, context.cacheIndexFile)
+        # Not while importing it, which uses the shared cache too
+        if context.isCacheShared and not isLocked(joinpath(context.repoCacheDir, 'import.lock')) and (
+            exists(joinpath(context.repoCacheDir, 'index')) or exists(joinpath(context.repoCacheDir, 'lru'))):
+            _importRepoCache()
+        conn = _connect(context.cacheIndexFile)
+        try:
+            conn.execute('BEGIN' if readOnly(k) else 'BEGIN IMMEDIATE')
+            k['index'] = _Index(conn, _repoId())
+            updated, r = decoratee(*a, **k)
+            if updated:
+                k['index'].saveTotals()
+            # Ends the transaction (and releases the lock) either way
+            conn.commit()
+            return r
+        finally:
+            conn.close()
     return decorator
 
-def _unpack(data):
-    l = data['lru']
-    m = data['map']
-    return l['size'], l['count'], l['items'], m['size'], m['items']
+def _cacheReadIf(readOnly):
+    return lambda decoratee: _cacheIO(decoratee, readOnly)
+
+_cacheRead = _cacheReadIf(lambda k: True)
+
+def _objectPath(k, objectsDir=None, codec=None):
+    objPath = '%s/%s/%s'%(objectsDir or context.objectsDir, k[:2], k[2:])
+    return '%s.%s'%(objPath, codec) if codec else objPath
+
+def _chunkPath(k, objectsDir=None):
+    return '%s/chunks/%s/%s'%(objectsDir or context.objectsDir, k[:2], k[2:])
+
+def _objectCodec(objPath):
+    return basename(objPath).partition('.')[2] or None
+
+def isCompressed(objPath):
+    return _objectCodec(objPath) != None
+
+def isChunked(objPath):
+    return _objectCodec(objPath) == 'chunks'
+
+readRecipe = chunking.readRecipe
+
+# Joins chunk files (in order) into filePath, passing what is written to
+# hasher (see hashing.BlobHasher) if given
+def assemble(chunkPaths, filePath, hasher=None):
+    fileOut = open(filePath, 'wb')
+    try:
+        for chunkPath in chunkPaths:
+            chunkIn = open(chunkPath, 'rb')
+            try:
+                if hasher:
+                    for data in iter(lambda: chunkIn.read(1 << 20), ''):
+                        hasher.update(data)
+                        fileOut.write(data)
+                else:
+                    copyfileobj(chunkIn, fileOut, 1 << 20)
+            finally:
+                chunkIn.close()
+    finally:
+        fileOut.close()
+
+# Objects in the lru part are in the external data store, and so are their
+# chunks. Those of objects that were in the map part may be evicted now.
+def _setChunksUploaded(objects, index, fromMap=()):
+    objectsDir = context.objectsDir
+    for k,x in objects:
+        if x == 'chunks':
+            chunks = readRecipe(_objectPath(k, objectsDir, x))
+            index.setChunksUploaded(c for c,s in chunks)
+            if k in fromMap:
+                index.unmapChunks(chunks)
+
+# Removes the files of objects [(key, codec)] that are being removed from the
+# cache, along with chunks only they referred to. Objects that are gone
+# already (e.g. removed by hand) are skipped if missingOk is set.
+def _removeObjects(objects, index, missingOk=False, inMap=False):
+    objectsDir = context.objectsDir
+    for k,x in objects:
+        objPath = _objectPath(k, objectsDir, x)
+        try:
+            if x == 'chunks':
+                for c,s in index.releaseChunks(readRecipe(objPath), inMap):
+                    remove(_chunkPath(c, objectsDir))
+            remove(objPath)
+        except (IOError, OSError):
+            if not missingOk:
+                raise
+
+# Copies a cached object (a path returned by find) to filePath, decompressing
+# it if it is stored compressed. Returns how it was copied.
+def extract(objPath, filePath, copier=None):
+    codec = _objectCodec(objPath)
+    if codec == 'chunks':
+        objectsDir = context.objectsDir
+        assemble([_chunkPath(c, objectsDir) for c,s in readRecipe(objPath)], filePath)
+        return codec
+    if codec:
+        decompressFile(codec, objPath, filePath)
+        return codec
+    return (copier or Copier()).copy(objPath, filePath)
+
+# Objects and chunks are written to a temporary file in the cache, which is
+# then renamed into place
+def _newTempFile():
+    tempDir = context.cacheTempDir
+    exists(tempDir) or _makedirs(tempDir)
+    tempHandle, tempPath = mkstemp(dir=tempDir)
+    osclose(tempHandle)
+    return tempPath
+
+def _publish(tempPath, dstPath):
+    exists(dirname(dstPath)) or _makedirs(dirname(dstPath))
+    rename(tempPath, dstPath)
 
-def _pack(data, ls, lc, ms):
-    l = data['lru']
-    m = data['map']
-    l['size'], l['count'], m['size'] = ls, lc, ms
+def _writeChunk(data, chunkPath):
+    tempPath = _newTempFile()
+    chunkOut = open(tempPath, 'wb')
+    chunkOut.write(data)
+    chunkOut.close()
+    _publish(tempPath, chunkPath)
+
+# Stores a file as the chunks of an object, returns the size of its recipe
+# and [(hash, size)] of its chunks. Chunks there are already are left alone.
+def _storeChunks(k, filePath):
+    objectsDir = context.objectsDir
+    chunks = []
+    for c,data in chunking.iterFileChunks(filePath):
+        chunks.append((c, len(data)))
+        if not exists(_chunkPath(c, objectsDir)):
+            _writeChunk(data, _chunkPath(c, objectsDir))
+    tempPath = _newTempFile()
+    size = chunking.writeRecipe(chunks, tempPath)
+    _publish(tempPath, _objectPath(k, objectsDir, 'chunks'))
+    return size, chunks
+
+# Adds the references of an object stored by _storeChunks to its chunks. A
+# chunk that was there already then may have been removed by another process
+# since (along with the last object referring to it), and is written again
+# from the file.
+def _addChunkRefs(chunks, filePath, index, uploaded):
+    objectsDir = context.objectsDir
+    known = index.getChunks(c for c,s in chunks)
+    fileIn = None
+    offset = 0
+    try:
+        for c,s in chunks:
+            if c not in known and not exists(_chunkPath(c, objectsDir)):
+                fileIn = fileIn or open(filePath, 'rb')
+                fileIn.seek(offset)
+                data = fileIn.read(s)
+                if sha1(data).hexdigest() != c:
+                    raise Exception('error: %s changed while it was being cached.'%filePath)
+                _writeChunk(data, _chunkPath(c, objectsDir))
+            offset += s
+    finally:
+        fileIn and fileIn.close()
+    index.addChunkRefs(chunks, uploaded)
+
+# Removes what _storeObjects stored for an object that another process cached
+# in the meantime, unless it is the very same file
+def _discardStored(k, stored, codec, index):
+    objectsDir = context.objectsDir
+    d, x, chunks = stored
+    if x == codec:
+        return
+    remove(_objectPath(k, objectsDir, x))
+    if chunks:
+        known = index.getChunks(c for c,s in chunks)
+        for c,s in set(chunks):
+            if c not in known and exists(_chunkPath(c, objectsDir)):
+                remove(_chunkPath(c, objectsDir))
+
+# Stores the given files {key: path} as cache objects, returns {key: (size on
+# disk, codec, chunks)} of them, chunks being [(hash, size)] for chunked ones
+def _storeObjects(files, progressMsg):
+    chunkingMinSize = chunking.getMinFileSize()
+    codec = getCodec()
+    skipExtensions = getSkipExtensions() if codec else None
+    objectsDir = context.objectsDir
+    copier = Copier(ingestMode())
+    used = set()
+    stored = {}
+    n = len(files)
+    for i,(k,f) in enumerate(files.iteritems()):
+        stored[k] = None
+        if chunkingMinSize != None and getsize(f) >= chunkingMinSize:
+            size, chunks = _storeChunks(k, f)
+            stored[k] = (size, 'chunks', chunks)
+            used.add('chunks')
+        elif codec and isCompressible(f, skipExtensions):
+            tempPath = _newTempFile()
+            diskSize = compressFile(codec, f, tempPath)
+            if diskSize < getsize(f):
+                _publish(tempPath, _objectPath(k, objectsDir, codec))
+                stored[k] = (diskSize, codec, None)
+                used.add(codec)
+            else:
+                # Not worth it
+                remove(tempPath)
+        if not stored[k]:
+            tempPath = _newTempFile()
+            used.add(copier.copy(f, tempPath))
+            stored[k] = (getsize(tempPath), None, None)
+            _publish(tempPath, _objectPath(k, objectsDir))
+        if progressMsg:
+            print '\r%s (%s)...%6.2f%%  %s/%s           '%(progressMsg, ', '.join(sorted(used)), (i+1)*100./n, i+1, n),
+            stdout.flush()
+
+    if progressMsg and n > 0:
+        print
+
+    return stored
+
+# Files are stored before the index is locked, and what other processes did
+# with the same objects in the meantime is sorted out once it is
+def insert(keys, inLru=False, progressMsg=None):
+    cached = find(keys, update=False)
+    stored = _storeObjects({k:f for k,(s,f) in keys.iteritems() if k not in cached}, progressMsg)
+    return _insert(keys, stored, inLru, progressMsg)
 
 @_cacheIO
-def insert(keys, inLru=False, progressMsg=None, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def _insert(keys, stored, inLru, progressMsg, index=None):
+    rows = index.get(keys)
+    for k in [k for k in stored if k in rows]:
+        _discardStored(k, stored.pop(k), rows[k][4], index)
+    # Evicted by another process since they were looked up
+    stored.update(_storeObjects({k:f for k,(s,f) in keys.iteritems() if k not in rows and k not in stored}, None))
+    inserted = {k:f for k,(s,f) in keys.iteritems() if k not in rows}
+    for k,(d,x,chunks) in stored.iteritems():
+        if chunks:
+            _addChunkRefs(chunks, keys[k][1], index, inLru)
 
-    inserted = {}
     inOther = []
+    lruItems = []
+    mapItems = []
     if inLru:
         for k,(s,f) in keys.iteritems():
-            lc += 1
-            if k in mi:
-                inOther.append(k)
-                del mi[k]
-                ms -= s
-                ls += s
-            elif k not in li:
-                inserted[k] = f
-                ls += s
-            li[k] = (s,lc)
+            index.lruCount += 1
+            if k in inserted:
+                d, x = stored[k][:2]
+                index.lruSize += d
+            else:
+                d, x = rows[k][3:]
+                if rows[k][1] == None:
+                    inOther.append(k)
+                    index.mapSize -= d
+                    index.lruSize += d
+            lruItems.append((k, (s, index.lruCount, d, x)))
     else:
         for k,(s,f) in keys.iteritems():
-            if k in li:
+            if k in inserted:
+                d, x = stored[k][:2]
+                mapItems.append((k, (s, False, d, x)))
+                index.mapSize += d
+            elif rows[k][1] != None:
                 inOther.append(k)
-                lc += 1
-                li[k] = (s,lc)
-            elif k not in mi:
-                inserted[k] = f
-                mi[k] = (s, False)
-                ms += s
-
-    n = len(inserted)
-    for i,(k,f) in enumerate(inserted.iteritems()):
-        dstDir = '%s/%s'%(objectsDir, k[:2])
-        dst = '%s/%s'%(dstDir, k[2:])
-        exists(dstDir) or makedirs(dstDir)
-        copyfile(f, dst)
-        if progressMsg:
-            print '\r%s...%6.2f%%  %s/%s           '%(progressMsg,(i+1)*100./n, i+1, n),
-            stdout.flush()
-
-    if progressMsg and len(inserted) > 0:
-        print
+                index.lruCount += 1
+                lruItems.append((k, (s, index.lruCount) + rows[k][3:]))
+            elif rows[k][2] == None:
+                # Saved by another repository sharing the cache
+                mapItems.append((k, (s, False) + rows[k][3:]))
+    index.setLru(lruItems)
+    index.setMap(mapItems)
+    if inLru:
+        index.disown(inOther, allRepos=True)
+        _setChunksUploaded([(k, rows[k][4]) for k in inOther], index, fromMap=inOther)
+    evict(quiet=not progressMsg, index=index)
 
-    _pack(data, ls, lc, ms)
-    return True, (inserted, inOther, ls, ms)
+    return True, (inserted, inOther, index.lruSize, index.mapSize)
 
 @_cacheIO
-def commit(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-
-    commited = {}
-    for k in keys:
-        if k in mi and not mi[k][1]:
-            s = mi[k][0]
-            mi[k] = (s, True)
-            commited[k] = s
-
-    _pack(data, ls, lc, ms)
-    return len(commited) > 0, commited
+def commit(keys, index=None):
+    commited = {k:r for k,r in index.get(keys).iteritems() if r[1] == None and r[2] == 0}
+    index.setMap((k, (s, True, d, x)) for k,(s,c,m,d,x) in commited.iteritems())
+    return len(commited) > 0, {k:r[0] for k,r in commited.iteritems()}
 
 @_cacheIO
-def enque(keys, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+def enque(keys, index=None):
+    keys = list(keys)
+    rows = index.get(keys)
 
     enqued = {}
     fromMap = {}
+    lruItems = []
     for k in keys:
-        val = None
-        if k in li:
-            val = li[k][0]
-        elif k in mi:
-            val = mi.pop(k)
-            fromMap[k] = val
-            val = val[0]
-            ms -= val
-            ls += val
-
-        if val:
-            enqued[k] = val
-            lc += 1
-            li[k] = (val, lc)
-
-    _pack(data, ls, lc, ms)
+        if k not in rows:
+            continue
+        s, c, m, d, x = rows[k]
+        if c == None:
+            fromMap[k] = (s, bool(m))
+            index.mapSize -= d
+            index.lruSize += d
+
+        if s:
+            enqued[k] = s
+            index.lruCount += 1
+            rows[k] = (s, index.lruCount, 0, d, x)
+            lruItems.append((k, (s, index.lruCount, d, x)))
+    index.setLru(lruItems)
+    index.disown(fromMap, allRepos=True)
+    _setChunksUploaded([(k, rows[k][4]) for k in enqued], index, fromMap=fromMap)
+
     return len(enqued) > 0, (enqued, fromMap)
 
-@_cacheIO
-def find(keys, inMap=False, update=True, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
+@_cacheReadIf(lambda k: k.get('inMap') or not k.get('update', True))
+def find(keys, inMap=False, update=True, index=None):
+    keys = list(keys)
+    rows = index.get(keys)
+    objectsDir = context.objectsDir
     if inMap:
-        return False, {k:'%s/%s/%s'%(objectsDir, k[:2], k[2:]) for k in keys if k in mi}
+        return False, {k:_objectPath(k, objectsDir, rows[k][4]) for k in keys if k in rows and rows[k][1] == None}
 
-    inLru = False
     found = {}
+    lruItems = []
     for k in keys:
-        if k in li:
-            inLru = True
-            lc += 1
-            val = li[k][0]
-            li[k] = (val, lc)
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
-        elif k in mi:
-            found[k] = '%s/%s/%s'%(objectsDir, k[:2], k[2:])
-
-    _pack(data, ls, lc, ms)
-    return inLru and update, found
+        if k in rows:
+            found[k] = _objectPath(k, objectsDir, rows[k][4])
+            if rows[k][1] != None:
+                index.lruCount += 1
+                lruItems.append((k, index.lruCount))
+    if update:
+        index.bumpLru(lruItems)
 
+    return len(lruItems) > 0 and update, found
+
+# Drops this repository's claim on the given objects in the map part that
+# are (or with commits unset, are not) committed, removing those no other
+# repository owns
 @_cacheIO
-def delete(keys, commits=False, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-    deleted = {}
-    for k in keys:
-        if k in mi:
-            s,c = mi.pop(k)
-            if commits == c:
-                deleted[k] = s
-                ms -= s
-                remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
+def delete(keys, commits=False, index=None):
+    deleted = {k:r for k,r in index.get(keys).iteritems() if r[1] == None and r[2] != None and commits == bool(r[2])}
+    index.disown(deleted)
+    owned = index.getOwned(deleted)
+    removed = []
+    for k,(s,c,m,d,x) in deleted.iteritems():
+        if k not in owned:
+            index.mapSize -= d
+            _removeObjects([(k, x)], index, inMap=True)
+            removed.append(k)
+    index.delete(removed)
+
+    return len(deleted) > 0, ({k:r[0] for k,r in deleted.iteritems()}, index.lruSize, index.mapSize)
+
+# Evicts least recently used objects until the lru part of the cache takes
+# up no more than size bytes on disk, counting only the chunks that no object
+# in the map part refers to
+@_cacheIO
+def prune(size, index=None):
+    pruned = []
+    for k,d,x in index.conn.execute('SELECT key, diskSize, codec FROM objects WHERE lru IS NOT NULL ORDER BY lru'):
+        if index.lruSize + index.chunkSize - index.mapChunkSize <= size:
+            break
+        pruned.append(k)
+        index.lruSize -= d
+        _removeObjects([(k, x)], index, missingOk=True)
+    index.delete(pruned)
+
+    return len(pruned) > 0, index.lruSize + index.chunkSize - index.mapChunkSize
 
-    _pack(data, ls, lc, ms)
-    return len(deleted) > 0, (deleted, ls, ms)
+# Returns the high and low watermarks (in bytes) the cache is kept between,
+# or None if there is no limit to its size
+def getSizeLimits():
+    maxSize = gitConfigSize('fit.cache.maxSize')
+    if maxSize == None:
+        return None
+    high = float(gitConfig('fit.cache.highWatermark') or _defaultHighWatermark)
+    low = float(gitConfig('fit.cache.lowWatermark') or _defaultLowWatermark)
+    if not 0 <= low <= high <= 100:
+        raise Exception('error: fit.cache.lowWatermark and fit.cache.highWatermark must be percentages of fit.cache.maxSize, the low one no higher than the high one.')
+    return int(maxSize * high / 100), int(maxSize * low / 100)
 
+# Evicts least recently used objects if the cache has grown past its high
+# watermark, until it is down to the low one (or there is nothing left in the
+# lru part). Returns the number of bytes reclaimed.
 @_cacheIO
-def prune(size, data=None):
-    ls, lc, li, ms, mi = _unpack(data)
-    
-    i = 0
-    items = sorted(li.iteritems(), key=lambda (i,(j,k)): k)
-    while ls > size and i < len(items):
-        k, (s, c) = items[i]
-        remove('%s/%s/%s'%(objectsDir, k[:2], k[2:]))
-        ls -= s
-        i += 1
-
-    for k,(s,c) in items[:i]:
-        del li[k]
-
-    lc = 0
-    for k,(s,c) in items[i:]:
-        lc += 1
-        li[k] = (s,lc)
-
-    _pack(data, ls, lc, ms)
-    return True,ls
+def evict(quiet=False, index=None):
+    limits = getSizeLimits()
+    cacheSize = index.lruSize + index.chunkSize + index.mapSize
+    if not limits or cacheSize <= limits[0]:
+        return False, 0
+
+    high, low = limits
+    # The chunks of objects in the map part can't be evicted either
+    mapSize = index.mapSize + index.mapChunkSize
+    prune(low - mapSize, index=index)
+    reclaimed = cacheSize - (index.lruSize + index.chunkSize + index.mapSize)
+    if not quiet:
+        print 'Cache is past its high watermark (%.2fMB on disk, watermark %.2fMB), evicted %.2fMB of least recently used objects.'%(
+            cacheSize/1048576., high/1048576., reclaimed/1048576.)
+    if mapSize > low and not quiet:
+        print 'warning: %.2fMB of the cache is in objects that have not been put, which cannot be evicted.'%(mapSize/1048576.)
+    return reclaimed > 0, reclaimed
+
+# Returns the sizes on disk of the lru and map parts of the cache, the chunks
+# of chunked objects counting towards the lru part
+@_cacheRead
+def size(index=None):
+    return False, (index.lruSize + index.chunkSize, index.mapSize)
+
+@_cacheRead
+def getCommittedObjects(index=None):
+    return False, {k for (k,) in index.conn.execute('SELECT key FROM owners WHERE repo = ? AND committed', (index.repo,))}
+
+# Returns {key: (path, uploaded)} for the given chunk keys that are cached
+@_cacheRead
+def findChunks(keys, index=None):
+    objectsDir = context.objectsDir
+    return False, {k:(_chunkPath(k, objectsDir), bool(u)) for k,(s,r,u,m) in index.getChunks(keys).iteritems()}
 
 @_cacheIO
-def size(data=None):
-    return False, (data['lru']['size'], data['map']['size'])
+def setChunksUploaded(keys, index=None):
+    index.setChunksUploaded(keys)
+    return True, None
+
+# Returns the whole cache index, as ({key: (size, lru counter, committed, size
+# on disk, codec)}, {chunk key: (size, references, uploaded)})
+@_cacheRead
+def listIndex(index=None):
+    objects = {r[0]:r[1:] for r in index.conn.execute('SELECT * FROM objects')}
+    chunks = {r[0]:r[1:] for r in index.conn.execute('SELECT key, size, refs, uploaded FROM chunks')}
+    return False, (objects, chunks)
 
+# Whether a file in the objects directory was written (or linked or renamed
+# into place) less than _orphanGracePeriod ago. insert publishes its files
+# before it indexes them, so such a file may not be orphaned at all. The
+# change time counts too, as ingesting by hard link keeps the modification
+# time of the working tree file.
+def isRecent(filePath):
+    try:
+        st = stat(filePath)
+    except OSError:
+        return False
+    return time() - max(st.st_mtime, st.st_ctime) < _orphanGracePeriod
+
+# Brings the index back in line with the objects directory (see verify.py):
+# drops the given broken objects [(key, codec)] and chunks, removing whatever
+# is left of their files along with the given orphaned files, recounts the
+# references to chunks from the recipes of the objects that are left (chunks
+# no longer referred to are removed), and recomputes the totals. Orphaned
+# files that are indexed by now, or are recent, are kept. Returns the
+# orphaned files removed.
 @_cacheIO
-def getCommittedObjects(data=None):
-    return False, {h for h,(s,c) in data['map']['items'].iteritems() if c}
+def repair(objects, chunks, orphans, index=None):
+    objectsDir = context.objectsDir
+    # The orphans were found before the lock was taken, those that have been
+    # indexed since, or might be about to be, are left alone
+    indexed = {_objectPath(k, objectsDir, x) for k,x in index.conn.execute('SELECT key, codec FROM objects')}
+    indexed.update(_chunkPath(c, objectsDir) for (c,) in index.conn.execute('SELECT key FROM chunks'))
+    removedOrphans = [p for p in orphans if p not in indexed and not isRecent(p)]
+
+    for path in [_objectPath(k, objectsDir, x) for k,x in objects] + [_chunkPath(c, objectsDir) for c in chunks] + removedOrphans:
+        try:
+            remove(path)
+        except OSError:
+            pass
+    index.delete(k for k,x in objects)
+
+    refs = {}
+    for (k,) in index.conn.execute("SELECT key FROM objects WHERE codec = 'chunks'").fetchall():
+        for c,s in readRecipe(_objectPath(k, objectsDir, 'chunks')):
+            refs[c] = refs.get(c, 0) + 1
+    dropped = set(chunks)
+    for k,r in index.conn.execute('SELECT key, refs FROM chunks').fetchall():
+        if k not in refs:
+            dropped.add(k)
+            if k not in chunks and exists(_chunkPath(k, objectsDir)):
+                remove(_chunkPath(k, objectsDir))
+        elif r != refs[k]:
+            index.conn.execute('UPDATE chunks SET refs = ? WHERE key = ?', (refs[k], k))
+    for chunk in _chunks(list(dropped)):
+        index.conn.execute('DELETE FROM chunks WHERE key IN (%s)'%','.join('?'*len(chunk)), chunk)
+
+    total = lambda query: index.conn.execute(query).fetchone()[0] or 0
+    index.lruSize = total('SELECT SUM(diskSize) FROM objects WHERE lru IS NOT NULL')
+    index.mapSize = total('SELECT SUM(diskSize) FROM objects WHERE lru IS NULL')
+    index.chunkSize = total('SELECT SUM(size) FROM chunks')
+    index.mapChunkSize = _countMapRefs(index.conn, objectsDir)
+    index.lruCount = max(index.lruCount, total('SELECT MAX(lru) FROM objects'))
+    return True, removedOrphans
@@ -1,14 +1,16 @@
 
-from . import fitFile, gitDirOperation, repoDir, savesDir, workingDir
-from . import updateStats, refreshStats, addedStatFile, writeFitFile, readFitFile
+from . import context, repoDirOperation, workingDir
+from . import updateStats, pruneStats, refreshStats, writeFitFile, readFitFile
 from . import filterBinaryFiles, getStagedFitFileHash, getFitFileStatus
 from objects import getUpstreamItems, getDownstreamItems
 from paths import getValidFitPaths
-import merge, cache
+from statdb import StatStore
+import merge, cache, watcher
 from subprocess import Popen as popen, PIPE
-from os.path import exists, dirname, join as joinpath
-from os import remove, makedirs, stat, listdir, mkdir
-from shutil import copyfile
+from os.path import exists, dirname, basename, join as joinpath
+from os import remove, stat, listdir, mkdir
+from filecopy import ingestMode
+from materialize import Materializer
 import re
 from sys import stdout
 
@@ -50,12 +52,13 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
     if legend:
         printLegend()
 
-    trackedItems = getTrackedItems()
+    watcherChanges = getWatcherChanges()
+    trackedItems = getTrackedItems(watcherChanges)
     fitItems = set(fitTrackedData)
     allItems = fitItems | trackedItems
-    paths = None if not pathArgs else getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir)
+    paths = None if not pathArgs else getValidFitPaths(pathArgs, allItems, basePath=context.repoDir, workingDir=workingDir)
 
-    modifiedItems, addedItems, removedItems, untrackedItems, unchangedItems, stats, stubs = getChangedItems(fitTrackedData, trackedItems=trackedItems, paths=paths)
+    modifiedItems, addedItems, removedItems, untrackedItems, unchangedItems, stats, stubs = getChangedItems(fitTrackedData, trackedItems=trackedItems, paths=paths, watcherChanges=watcherChanges)
 
     conflict, binary = getStagedOffenders()
     offenders = conflict | binary
@@ -117,7 +120,7 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
 
     print
 
-    if dirtyFit and exists(fitFile):
+    if dirtyFit and exists(context.fitFile):
         print 'The .fit file contains changes that have not yet been staged for commit.'
         if noChanges:
             print 'If you want to include these changes in a commit, you should run "git-fit save"'
@@ -142,25 +145,119 @@ def printStatus(fitTrackedData, pathArgs=None, legend=True, showall=False, merge
         print '   them with their cached contents (may not be up to date with remote storage).'
 
 
-@gitDirOperation(repoDir)
-def getTrackedItems():
+# Beyond this many changed paths reported by the watcher, it is quicker to
+# find the tracked items from scratch than to recheck each of them
+_maxWatcherRecheckPaths = 1000
+
+# Asks the watcher daemon, if one is running, what has changed in the working
+# tree since the last time all fit items were checked
+@repoDirOperation
+def getWatcherChanges():
+    if not exists(context.watcherSocket):
+        return None
+    store = StatStore(context.statFile)
+    token = store.getMeta('watcherToken')
+    store.close()
+    return watcher.query(context.watcherSocket, token)
+
+@repoDirOperation
+def watch(action):
+    if action == 'start':
+        try:
+            started = watcher.start(context.repoDir, context.gitDir, context.watcherSocket, context.watcherPidFile)
+        except OSError as e:
+            print 'error: Could not watch the working tree (%s).'%e
+            print 'On Linux, the number of inotify watches can be raised with the'
+            print 'fs.inotify.max_user_watches sysctl.'
+            return False
+        print 'Started watching the working tree.' if started else 'Already watching the working tree.'
+    elif action == 'stop':
+        print 'Stopped watching the working tree.' if watcher.stop(context.watcherSocket, context.watcherPidFile) else 'Not watching the working tree.'
+    else:
+        print 'Watching the working tree.' if watcher.isRunning(context.watcherSocket) else 'Not watching the working tree.'
+    return True
+
+def _isInDirs(p, dirs):
+    p = dirname(p)
+    while p and dirs:
+        if p in dirs:
+            return True
+        p = dirname(p)
+    return False
+
+# Returns the changed files and directories in which the fit attribute of
+# items has to be checked again, or None if all items have to be
+def _getWatcherRecheckPaths(watcherChanges):
+    if watcherChanges.reset or watcherChanges.gitFiles or '.gitattributes' in watcherChanges.files:
+        return None
+
+    # A .gitattributes file only affects the items in and below its directory
+    dirs = watcherChanges.dirs | {dirname(f) for f in watcherChanges.files if basename(f) == '.gitattributes'}
+    files = {f for f in watcherChanges.files if not _isInDirs(f, dirs)}
+    if len(files) + len(dirs) > _maxWatcherRecheckPaths:
+        return None
+    return files, dirs
+
+def _getFitAttributeItems(pathspecs=[]):
+    p = popen('git --literal-pathspecs ls-files -o -z --'.split() + pathspecs, stdout=PIPE)
+    p = popen('git check-attr -z --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
+    out = p.communicate()[0].split('\0')
+    return {filepath for filepath, value in zip(out[0::3], out[2::3]) if value == 'set'}
+
+@repoDirOperation
+def getTrackedItems(watcherChanges=None):
     # The tracked items in the working tree according to the
     # currently set fit attributes
-    fitSetRgx = re.compile('(.*): fit: set')
-    p = popen('git ls-files -o'.split(), stdout=PIPE)
-    p = popen('git check-attr --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
-    return {m.group(1) for m in [fitSetRgx.match(l) for l in p.stdout] if m}
-
-@gitDirOperation(repoDir)
-def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None):
+    if not watcherChanges:
+        return _getFitAttributeItems()
+
+    # With the watcher running, the tracked items are kept in the stat store
+    # and only those paths it reports as changed are checked again
+    store = StatStore(context.statFile)
+    recheck = _getWatcherRecheckPaths(watcherChanges)
+    if recheck == None:
+        trackedItems = _getFitAttributeItems()
+        store.setTracked(trackedItems)
+    else:
+        files, dirs = recheck
+        cachedItems = store.getTracked()
+        staleItems = cachedItems & files
+        if dirs:
+            staleItems.update(i for i in cachedItems if _isInDirs(i, dirs))
+        foundItems = _getFitAttributeItems(list(files | dirs)) if files or dirs else set()
+        trackedItems = (cachedItems - staleItems) | foundItems
+        store.updateTracked(foundItems - cachedItems, staleItems - foundItems)
+    store.close()
+    return trackedItems
+
+# Records that all fit items were checked as of the given watcher changes.
+# Stored stats of changed paths that were not among the checked items are
+# dropped, so every stat left in the store is either current or of a file
+# that has not changed since.
+def _saveWatcherToken(watcherChanges, checkedItems):
+    store = StatStore(context.statFile)
+    if watcherChanges.reset:
+        staleItems = store.getPaths()
+    else:
+        staleItems = set(watcherChanges.files)
+        for d in watcherChanges.dirs:
+            staleItems.update(store.getPaths(under=d))
+    store.delete(staleItems - checkedItems)
+    store.setMeta('watcherToken', watcherChanges.token)
+    store.close()
+
+@repoDirOperation
+def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None, watcherChanges=None):
 
     # The tracked items according to the saved/committed .fit file
     expectedItems = set(fitTrackedData)
-    trackedItems = trackedItems or getTrackedItems()
+    if not trackedItems:
+        watcherChanges = watcherChanges or getWatcherChanges()
+        trackedItems = getTrackedItems(watcherChanges)
 
     # Get valid, fit-friendly repo paths from given arbitrary path arguments
     if paths == None and pathArgs:
-        paths = getValidFitPaths(pathArgs, expectedItems | trackedItems, basePath=repoDir, workingDir=workingDir)
+        paths = getValidFitPaths(pathArgs, expectedItems | trackedItems, basePath=context.repoDir, workingDir=workingDir)
 
     if paths != None:
         if len(paths) == 0:
@@ -181,35 +278,51 @@ def getChangedItems(fitTrackedData, trackedItems=None, paths=None, pathArgs=None
     untrackedItems = {i for i in missingItems if exists(i)}
     removedItems = missingItems - untrackedItems
 
+    # Items the watcher saw no changes to don't need to be looked at
+    unchanged = None
+    if watcherChanges and not watcherChanges.reset:
+        unchanged = {i for i in existingItems if not watcherChanges.isChanged(i)}
+
     # Check all existing items for modification by comparing their expected
     # hash sums (those stored in the .fit file) to their new, actual hash sums.
-    stats, stubs = updateStats(existingItems)
+    stats, stubs = updateStats(existingItems, unchanged=unchanged)
     modifiedItems = {i: [h,s[0]] for i,(h,s) in stats.iteritems() if h != fitTrackedData[i][0]}
     unchangedItems = existingItems - set(modifiedItems)
 
+    if watcherChanges and paths == None:
+        _saveWatcherToken(watcherChanges, existingItems)
+    elif paths == None:
+        pruneStats(trackedItems | untrackedItems)
+
     return modifiedItems, newItems, removedItems, untrackedItems, unchangedItems, stats, stubs
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def getStagedOffenders():
     fitConflict = []
     binaryFiles = []
 
+    # With -z, each added file is listed as ":<modes> <old id> <new id> A"
+    # followed by its path, each NUL-terminated
+    blobIds = {}
+    out = popen('git diff --raw --no-abbrev -z --diff-filter=A --cached'.split(), stdout=PIPE).communicate()[0].split('\0')
+    for info, filepath in zip(out[0::2], out[1::2]):
+        blobIds[filepath] = info.split()[3]
+
     staged = []
-    p = popen('git diff --name-only --diff-filter=A --cached'.split(), stdout=PIPE)
-    p = popen('git check-attr --stdin fit'.split(), stdin=p.stdout, stdout=PIPE)
-    for l in p.stdout:
-        filepath = l[:l.find(':')]
-        if l.endswith(' set\n'):
+    p = popen('git check-attr -z --stdin fit'.split(), stdin=PIPE, stdout=PIPE)
+    out = p.communicate('\0'.join(blobIds))[0].split('\0')
+    for filepath, value in zip(out[0::3], out[2::3]):
+        if value == 'set':
             fitConflict.append(filepath)
-        elif l.endswith(' unspecified\n'):
+        elif value == 'unspecified':
             staged.append(filepath)
 
     if len(staged) > 0:
-        binaryFiles = filterBinaryFiles(staged)
+        binaryFiles = filterBinaryFiles(staged, blobIds=blobIds)
 
     return set(fitConflict), set(binaryFiles)
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def checkForChanges(fitTrackedData, paths=None, pathArgs=None):
     changes = getChangedItems(fitTrackedData, paths=paths, pathArgs=pathArgs)[:-3]
     if not any(changes):
@@ -217,7 +330,7 @@ def checkForChanges(fitTrackedData, paths=None, pathArgs=None):
     
     return changes
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def restore(fitTrackedData, quiet=False, pathArgs=None):
     changes = checkForChanges(fitTrackedData, pathArgs=pathArgs)
     if not changes:
@@ -230,50 +343,39 @@ def restore(fitTrackedData, quiet=False, pathArgs=None):
     if missing > 0:
         print restoreMissingMessage%missing
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def restoreItems(fitTrackedData, modified, added, removed, quiet=False):
     for i in sorted(added):
         remove(i)
         if not quiet:
             print 'Removed: %s'%i
 
-    missing = 0
-    touched = {}
-
-    result = _restoreFromCache('Added', sorted(removed), fitTrackedData, quiet=quiet)
-    touched.update(result[0])
-    missing += result[1]
-    result = _restoreFromCache('Restored', sorted(modified), fitTrackedData, quiet=quiet)
-    touched.update(result[0])
-    missing += result[1]
-
-    refreshStats(touched)
+    materializer = Materializer()
+    missing = _restoreFromCache('Added', sorted(removed), fitTrackedData, materializer, quiet=quiet)
+    missing += _restoreFromCache('Restored', sorted(modified), fitTrackedData, materializer, quiet=quiet)
+    materializer.finish()
+    cache.evict(quiet=quiet)
 
     return missing
 
-def _restoreFromCache(restoreType, objects, fitTrackedData, quiet=False):
+def _restoreFromCache(restoreType, objects, fitTrackedData, materializer, quiet=False):
     missing = 0
-    touched = {}
     cached = cache.find(fitTrackedData[f][0] for f in objects)
     for filePath in objects:
         objHash = fitTrackedData[filePath][0]
-        fileDir = dirname(filePath)
-        fileDir and (exists(fileDir) or makedirs(fileDir))
         if objHash in cached:
             if not quiet:
                 print '%s: %s'%(restoreType, filePath)
-            copyfile(cached[objHash], filePath)
-            touched[filePath] = objHash
+            materializer.fromCache(cached[objHash], filePath, objHash)
         else:
             if not quiet:
                 print '%s (empty): %s'%(restoreType, filePath)
-            open(filePath, 'w').close()  #write a 0-byte file as placeholder
-            touched[filePath] = 0
+            materializer.stub(filePath)
             missing += 1
 
-    return (touched, missing)
+    return missing
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=False):
     added,removed,stubs = saveItems(fitTrackedData, paths=paths, pathArgs=pathArgs, quiet=quiet)
 
@@ -296,7 +398,7 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
     newStagedFitFileHash = None
     if fitFileStatus[0] == 'A':
         oldStagedFitFileHash = getStagedFitFileHash()
-    popen('git add -f'.split()+[fitFile]).wait()
+    popen('git add -f'.split()+[context.fitFile]).wait()
     newStagedFitFileHash = getStagedFitFileHash()
     print 'Staged .fit file.'
 
@@ -305,7 +407,7 @@ def save(fitTrackedData, paths=None, pathArgs=None, forceWrite=False, quiet=Fals
 
     return True
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
     changes = checkForChanges(fitTrackedData, paths=paths, pathArgs=pathArgs)
     if not changes:
@@ -315,7 +417,9 @@ def saveItems(fitTrackedData, paths=None, pathArgs=None, quiet=False):
     
     modified, added, removed, untracked = changes
 
-    stats, stubs = updateStats(added, filePath=addedStatFile)
+    stats, stubs = updateStats(added, filePath=context.addedStatFile)
+    if paths == None and not pathArgs:
+        pruneStats(added, filePath=context.addedStatFile)
     modified.update((i,[h,s[0]]) for i,(h,s) in stats.iteritems())
     removed |= untracked
 
@@ -329,8 +433,8 @@ def _saveToCache(newItems, fitTrackedData, fitFileHash):
     toAdd = dict(newItems)
     toRemove = set()
 
-    for l in listdir(savesDir):
-        savesFile = joinpath(savesDir, l)
+    for l in listdir(context.savesDir):
+        savesFile = joinpath(context.savesDir, l)
         oldSaveItems = readFitFile(savesFile)
         for i,f in oldSaveItems.iteritems():
             if fitTrackedData.get(i) == f:
@@ -339,6 +443,9 @@ def _saveToCache(newItems, fitTrackedData, fitFileHash):
                 toRemove.add(f[0])
         remove(savesFile)
 
-    writeFitFile(toAdd, joinpath(savesDir,fitFileHash))
+    writeFitFile(toAdd, joinpath(context.savesDir,fitFileHash))
     cache.delete(toRemove - {toAdd[i][0] for i in toAdd})
     cache.insert({h:(s,f) for f,(h,s) in newItems.iteritems()}, progressMsg='Caching new and modified items')
+    if ingestMode() == 'hardlink':
+        # Making the hard linked files read-only changed their stats
+        refreshStats({f:h for f,(h,s) in newItems.iteritems()})
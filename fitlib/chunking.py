@@ -0,0 +1,97 @@
+from config import gitConfig
+from hashlib import sha1
+
+# Large files are split into chunks at content-defined boundaries, so that
+# versions of a file that differ in a few places (even where bytes were
+# inserted or removed) share most of their chunks, and only the chunks that
+# are new have to be stored or transferred.
+#
+# Boundaries are found with a rolling fingerprint of the last _windowSize
+# bytes: every byte value maps to one pseudo-random bit, and a chunk ends
+# where the bits of the bytes before it spell out _pattern, but not before
+# _minChunkSize and no later than _maxChunkSize. The bits are computed with
+# str.translate and the pattern found with str.find, so the data is never
+# looked at one byte at a time in Python (a classic per-byte rolling hash
+# runs at about 3MB/s in CPython, this at about 50MB/s). For random data
+# chunks average about 140KB.
+#
+# Chunking is off by default, and only done for files of at least
+# fit.chunking.minFileSize bytes when on:
+#
+#   > git config fit.chunking true
+#
+# The table and pattern are derived from fixed seeds, since chunks are only
+# shared by files chunked the same way; changing them changes all chunks.
+
+_windowSize = 16
+_minChunkSize = 16 << 10
+_maxChunkSize = 512 << 10
+_readSize = 4 << 20
+_defaultMinFileSize = 4 << 20
+
+_table = ''.join('ab'[ord(sha1('fit-chunking-%d'%i).digest()[0]) & 1] for i in xrange(256))
+_pattern = ''.join('ab'[ord(c) & 1] for c in sha1('fit-chunking-pattern').digest()[:_windowSize])
+
+# Returns the size from which files are to be chunked, or None if they aren't
+def getMinFileSize():
+    if gitConfig('fit.chunking').lower() not in ('true', 'yes', 'on', '1'):
+        return None
+    size = gitConfig('fit.chunking.minFileSize')
+    return int(size) if size else _defaultMinFileSize
+
+# Returns the length of the first chunk of data[start:end] (data being
+# fingerprints translated with _table), given that there is no more data
+# after end if final is set. Returns None if more data is needed.
+def _chunkLength(fingerprints, start, end, final):
+    pos = fingerprints.find(_pattern, start + _minChunkSize - _windowSize, start + _maxChunkSize)
+    if pos != -1:
+        return pos + _windowSize - start
+    if end - start >= _maxChunkSize:
+        return _maxChunkSize
+    return end - start if final else None
+
+# Yields the chunks (strings) of the contents of a file object
+def iterChunks(fileIn):
+    data = ''
+    fingerprints = ''
+    start = 0
+    final = False
+    while True:
+        length = _chunkLength(fingerprints, start, len(data), final)
+        if length == None:
+            block = fileIn.read(_readSize)
+            final = not block
+            data = data[start:] + block
+            fingerprints = fingerprints[start:] + block.translate(_table)
+            start = 0
+            continue
+        if length == 0:
+            return
+        yield data[start:start+length]
+        start += length
+
+# Yields (hash, chunk) for the chunks of a file
+def iterFileChunks(filePath):
+    fileIn = open(filePath, 'rb')
+    try:
+        for c in iterChunks(fileIn):
+            yield sha1(c).hexdigest(), c
+    finally:
+        fileIn.close()
+
+# A recipe lists the chunks of an object in order, one "<hash> <size>" line
+# per chunk
+def writeRecipe(chunks, filePath):
+    fileOut = open(filePath, 'w')
+    fileOut.write(''.join('%s %d\n'%c for c in chunks))
+    size = fileOut.tell()
+    fileOut.close()
+    return size
+
+# Returns [(hash, size)] of the chunks listed in a recipe
+def readRecipe(filePath):
+    fileIn = open(filePath)
+    try:
+        return [(h, int(s)) for h,s in (l.split() for l in fileIn if l.strip())]
+    finally:
+        fileIn.close()
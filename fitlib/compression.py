@@ -0,0 +1,92 @@
+from config import gitConfig
+from os.path import splitext
+import zlib
+
+# Objects in the local cache can be stored compressed. It is off by default
+# and turned on by naming a codec:
+#
+#   > git config fit.cache.compression zlib
+#
+# Files whose contents are compressed already gain nothing from it, so those
+# with the extensions in fit.cache.compressionSkipExtensions (compared
+# case-insensitively, a default list of common ones if not set) are stored
+# as they are, and so is anything that turns out not to get any smaller.
+#
+# Files are compressed and decompressed in chunks, so large ones don't have
+# to fit in memory. A codec is a pair of functions returning a new
+# compressor and decompressor object, with the interface of the ones from
+# zlib.compressobj() and zlib.decompressobj().
+
+codecs = {
+    'zlib': (lambda: zlib.compressobj(6), zlib.decompressobj),
+}
+
+_defaultSkipExtensions = ('.7z .aac .avi .bz2 .docx .flac .gif .gz .jar .jpeg .jpg .m4a .mkv .mov .mp3 .mp4 '
+    '.ogg .png .pptx .rar .tgz .webm .webp .xlsx .xz .zip .zst')
+
+_chunkSize = 1 << 20
+
+# Returns the configured codec, or None if objects are not to be compressed
+def getCodec():
+    codec = gitConfig('fit.cache.compression').lower()
+    if codec in ('', 'none', 'false'):
+        return None
+    if codec not in codecs:
+        raise Exception('error: Unknown fit.cache.compression codec %s (known are: %s).'%(codec, ', '.join(sorted(codecs))))
+    return codec
+
+def getSkipExtensions():
+    extensions = gitConfig('fit.cache.compressionSkipExtensions') or _defaultSkipExtensions
+    return set(e.lower() for e in extensions.split())
+
+def isCompressible(filePath, skipExtensions):
+    return splitext(filePath)[-1].lower() not in skipExtensions
+
+def _transform(src, dst, process, finish):
+    fileIn = open(src, 'rb')
+    try:
+        fileOut = open(dst, 'wb')
+        try:
+            while True:
+                chunk = fileIn.read(_chunkSize)
+                if not chunk:
+                    break
+                for data in process(chunk):
+                    fileOut.write(data)
+            fileOut.write(finish())
+            return fileOut.tell()
+        finally:
+            fileOut.close()
+    finally:
+        fileIn.close()
+
+# Compresses src into dst, returns the size of dst
+def compressFile(codec, src, dst):
+    compressor = codecs[codec][0]()
+    return _transform(src, dst, lambda chunk: [compressor.compress(chunk)], compressor.flush)
+
+# Decompresses src into dst, returns the size of dst. A highly compressed
+# chunk is decompressed a bit at a time, rather than all at once.
+def decompressFile(codec, src, dst):
+    decompressor = codecs[codec][1]()
+    def process(chunk):
+        while chunk:
+            yield decompressor.decompress(chunk, _chunkSize)
+            chunk = decompressor.unconsumed_tail
+    return _transform(src, dst, process, decompressor.flush)
+
+# Yields the decompressed contents of src a bit at a time
+def iterDecompressed(codec, src):
+    decompressor = codecs[codec][1]()
+    fileIn = open(src, 'rb')
+    try:
+        while True:
+            chunk = fileIn.read(_chunkSize)
+            if not chunk:
+                break
+            while chunk:
+                yield decompressor.decompress(chunk, _chunkSize)
+                chunk = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    finally:
+        fileIn.close()
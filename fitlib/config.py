@@ -0,0 +1,46 @@
+from subprocess import Popen as popen, PIPE
+
+# All of the git config is read with one "git config -z --list" call the
+# first time any key is asked for, and is then kept for the rest of the
+# process. The -z format separates entries with NUL and a key from its value
+# with a newline (a key without a value is a boolean that is set).
+_values = None
+
+def _loadConfig():
+    values = {}
+    out = popen('git config -z --list'.split(), stdout=PIPE).communicate()[0]
+    for entry in out.split('\0'):
+        if entry:
+            key, sep, value = entry.partition('\n')
+            values[key] = value if sep else 'true'
+    return values
+
+# Section and variable names are case-insensitive and are listed in lower
+# case by git, while subsection names are case-sensitive
+def _normalizeKey(key):
+    parts = key.split('.')
+    parts[0] = parts[0].lower()
+    parts[-1] = parts[-1].lower()
+    return '.'.join(parts)
+
+# Returns the (last) value of the given key, or an empty string if not set
+def gitConfig(key):
+    global _values
+    if _values == None:
+        _values = _loadConfig()
+    return _values.get(_normalizeKey(key), '')
+
+_sizeUnits = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+# Returns the value of the given key as a number of bytes, or None if not
+# set. Like git's own integer values, it may end in k, m or g.
+def gitConfigSize(key):
+    value = gitConfig(key).strip().lower()
+    if not value:
+        return None
+    try:
+        if value[-1] in _sizeUnits:
+            return int(value[:-1]) * _sizeUnits[value[-1]]
+        return int(value)
+    except ValueError:
+        raise Exception('error: Bad size for %s in git config: %s'%(key, value))
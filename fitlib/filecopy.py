@@ -0,0 +1,168 @@
+from config import gitConfig
+from ctypes import CDLL, c_int, c_uint, c_size_t, c_ssize_t, c_void_p, get_errno
+from ctypes.util import find_library
+from errno import EXDEV, EPERM, EMLINK, ENOSYS, EINVAL, EOPNOTSUPP, ENOTTY, EBADF, EIO
+from os import path, remove, strerror
+from shutil import copyfileobj
+from stat import S_IWUSR, S_IWGRP, S_IWOTH
+import os
+
+try:
+    from fcntl import ioctl
+except ImportError:
+    ioctl = None
+
+# Files are copied into (and out of) the object cache in the cheapest way the
+# file systems involved support, trying in turn:
+#
+#   reflink          clone the file (FICLONE), so that both share their
+#                    blocks until either is written to (btrfs, xfs, ...)
+#   copy_file_range  copy in the kernel, which some file systems turn into a
+#                    clone or a server-side copy
+#   sendfile         copy in the kernel
+#   copy             read and write through user space
+#
+# The fit.cache.ingest git config key decides how files get into the cache:
+# "auto" (the default) tries the above, "copy" only does a plain copy, and
+# "hardlink" hard links the cache object to the working tree file if they
+# are on the same file system. That takes neither time nor space, but the
+# two are then the same file. It is made read-only, so that it isn't changed
+# in place by accident (which would change the cached object as well), and
+# has to be replaced rather than edited, as most tools that save files do.
+
+FICLONE = 0x40049409
+
+_chunkSize = 1 << 30
+
+_strategies = {
+    'auto': ['reflink', 'copy_file_range', 'sendfile', 'copy'],
+    'copy': ['copy'],
+    'hardlink': ['hardlink', 'reflink', 'copy_file_range', 'sendfile', 'copy'],
+}
+
+# Errors that mean the file system (or kernel, or platform) can't do a kind
+# of copy, rather than that the files can't be read or written
+_unsupportedErrors = {EXDEV, ENOSYS, EINVAL, EOPNOTSUPP, ENOTTY, EBADF}
+_unsupportedLinkErrors = {EXDEV, EPERM, EMLINK, ENOSYS, EOPNOTSUPP}
+
+def ingestMode():
+    mode = gitConfig('fit.cache.ingest').lower()
+    return mode if mode in _strategies else 'auto'
+
+_libc = []
+
+def _getLibcFunction(name, argtypes):
+    if not _libc:
+        try:
+            _libc.append(CDLL(find_library('c'), use_errno=True))
+        except OSError:
+            _libc.append(None)
+    func = getattr(_libc[0], name, None)
+    if func == None:
+        raise OSError(ENOSYS, '%s is not available'%name)
+    func.argtypes = argtypes
+    func.restype = c_ssize_t
+    return func
+
+# Runs a kernel copy function until it has copied the whole file. Some file
+# systems (e.g. /proc) claim there is nothing to copy, so the result is
+# checked against the size of the source.
+def _kernelCopy(src, dst, copyChunk):
+    s = open(src, 'rb')
+    try:
+        d = open(dst, 'wb')
+        try:
+            size = os.fstat(s.fileno()).st_size
+            copied = 0
+            while True:
+                n = copyChunk(s.fileno(), d.fileno())
+                if n < 0:
+                    e = get_errno()
+                    raise OSError(e, strerror(e))
+                if n == 0:
+                    break
+                copied += n
+            if copied != size:
+                raise OSError(EINVAL, 'copied %d of %d bytes'%(copied, size))
+        finally:
+            d.close()
+    finally:
+        s.close()
+
+def _reflink(src, dst):
+    if ioctl == None:
+        raise OSError(ENOSYS, 'reflinks are not available')
+    s = open(src, 'rb')
+    try:
+        d = open(dst, 'wb')
+        try:
+            ioctl(d.fileno(), FICLONE, s.fileno())
+        finally:
+            d.close()
+    finally:
+        s.close()
+
+def _copyFileRange(src, dst):
+    func = _getLibcFunction('copy_file_range', [c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint])
+    _kernelCopy(src, dst, lambda s, d: func(s, None, d, None, _chunkSize, 0))
+
+def _sendfile(src, dst):
+    func = _getLibcFunction('sendfile', [c_int, c_int, c_void_p, c_size_t])
+    _kernelCopy(src, dst, lambda s, d: func(d, s, None, _chunkSize))
+
+def _copy(src, dst):
+    s = open(src, 'rb')
+    try:
+        d = open(dst, 'wb')
+        try:
+            copyfileobj(s, d, 1 << 20)
+        finally:
+            d.close()
+    finally:
+        s.close()
+
+def _hardlink(src, dst):
+    if not hasattr(os, 'link'):
+        raise OSError(ENOSYS, 'hard links are not available')
+    os.link(src, dst)
+    os.chmod(dst, os.stat(dst).st_mode & ~(S_IWUSR | S_IWGRP | S_IWOTH))
+
+_functions = {
+    'reflink': _reflink,
+    'copy_file_range': _copyFileRange,
+    'sendfile': _sendfile,
+    'copy': _copy,
+    'hardlink': _hardlink,
+}
+
+# Copies files using the first strategy of the given mode that works, and
+# remembers which ones didn't so that they aren't tried again for the next
+# file. Keeps count of the strategies used in used: {strategy: count}.
+class Copier:
+    def __init__(self, mode='auto'):
+        self.strategies = list(_strategies[mode])
+        self.used = {}
+
+    # Copies src to dst, replacing (rather than writing to) dst if it exists,
+    # as it may be a hard link to a cached object. Returns the strategy used.
+    def copy(self, src, dst):
+        if path.lexists(dst):
+            remove(dst)
+        for strategy in list(self.strategies):
+            try:
+                _functions[strategy](src, dst)
+            except (IOError, OSError) as e:
+                unsupported = _unsupportedLinkErrors if strategy == 'hardlink' else _unsupportedErrors
+                if e.errno not in unsupported or strategy == 'copy':
+                    raise
+                self.strategies.remove(strategy)
+                continue
+            self.used[strategy] = self.used.get(strategy, 0) + 1
+            return strategy
+        raise IOError(EIO, 'could not copy %s'%src)
+
+    def describe(self):
+        return ', '.join(sorted(self.used))
+
+def copyFile(src, dst):
+    return Copier().copy(src, dst)
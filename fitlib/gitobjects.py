@@ -0,0 +1,48 @@
+from subprocess import Popen as popen, PIPE
+from threading import Lock
+import atexit
+
+# Objects are read from the repository through a single long-lived
+# "git cat-file --batch" process, instead of starting a git process for every
+# object read. For each object name written to its stdin, it answers with
+# "<id> <type> <size>\n", the contents and a "\n", or "<name> missing\n".
+class BatchReader:
+    def __init__(self, repoDir):
+        self.repoDir = repoDir
+        self.proc = None
+        self.lock = Lock()
+        atexit.register(self.close)
+
+    def _start(self):
+        self.proc = popen('git cat-file --batch'.split(), stdin=PIPE, stdout=PIPE, cwd=self.repoDir)
+
+    # Returns (object id, contents) of the named object (anything git
+    # rev-parse accepts, e.g. "HEAD:.fit"), or (None, None) if there is none.
+    # With limit, only that much of the contents is returned (and kept in
+    # memory), the rest is skipped.
+    def read(self, name, limit=None):
+        if '\n' in name:
+            return None, None
+        with self.lock:
+            if not self.proc or self.proc.poll() != None:
+                self._start()
+            self.proc.stdin.write(name + '\n')
+            self.proc.stdin.flush()
+            header = self.proc.stdout.readline().split()
+            if len(header) != 3:
+                # missing or ambiguous
+                return None, None
+            size = int(header[2])
+            data = self.proc.stdout.read(size if limit == None else min(size, limit))
+            left = size - len(data)
+            while left > 0:
+                left -= len(self.proc.stdout.read(min(left, 1 << 20)))
+            self.proc.stdout.read(1)
+            return header[0], data
+
+    def close(self):
+        with self.lock:
+            if self.proc:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
@@ -0,0 +1,102 @@
+from hashlib import sha1
+from mmap import mmap, ACCESS_READ
+from os import fstat, stat, open as osopen, read as osread, close as osclose, lseek, O_RDONLY, SEEK_SET
+import os
+
+# Object ids computed here are the same as the ones "git hash-object" gives
+# for the raw contents of a file, i.e. the SHA-1 of "blob <size>\0" followed
+# by the file contents. No attribute-driven conversions (eol, filters) are
+# applied, so these are only used when git would not apply any either.
+
+_readSize = 1 << 20
+_mmapThreshold = 16 << 20
+
+# Files smaller than _batchFileSize are handed to the workers in batches, so
+# that hashing lots of small files is not dominated by the cost of sending
+# each of them to a worker process separately
+_batchFileSize = 1 << 20
+_batchMaxFiles = 256
+_batchMaxBytes = 32 << 20
+
+def gitBlobHash(filePath):
+    f = open(filePath, 'rb')
+    try:
+        size = fstat(f.fileno()).st_size
+        h = sha1('blob %d\0'%size)
+        if size >= _mmapThreshold:
+            m = mmap(f.fileno(), 0, access=ACCESS_READ)
+            h.update(m)
+            m.close()
+        elif size > 0:
+            read = f.read
+            data = read(_readSize)
+            while data:
+                h.update(data)
+                data = read(_readSize)
+        return h.hexdigest()
+    finally:
+        f.close()
+
+# Computes the object id of a file of the given size while it is being
+# written (e.g. downloaded), from the data passed to update, or from what has
+# been written to the file since catchUp was last called, so that it needn't
+# be read again in full once it's complete
+class BlobHasher:
+    def __init__(self, size):
+        self.hash = sha1('blob %d\0'%size)
+        self.hashed = 0
+        self.fd = None
+
+    def update(self, data):
+        self.hash.update(data)
+        self.hashed += len(data)
+
+    def catchUp(self, filePath):
+        # Read without buffering, which could take the end of what's been
+        # written so far for the end of the file
+        if self.fd == None:
+            self.fd = osopen(filePath, O_RDONLY | getattr(os, 'O_BINARY', 0))
+            lseek(self.fd, self.hashed, SEEK_SET)
+        data = osread(self.fd, _readSize)
+        while data:
+            self.update(data)
+            data = osread(self.fd, _readSize)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def close(self):
+        if self.fd != None:
+            osclose(self.fd)
+            self.fd = None
+
+def _hashBatch(batch):
+    return [(i, gitBlobHash(p)) for i,p in batch]
+
+# Largest files are scheduled first, so that a big file picked up last does
+# not leave all but one of the workers idle at the end
+def _getBatches(items, sizes):
+    sized = sorted(((sizes[p] if sizes else stat(p).st_size, i, p) for i,p in enumerate(items)), reverse=True)
+    batch = []
+    batchBytes = 0
+    for size,i,p in sized:
+        if size >= _batchFileSize:
+            yield [(i,p)]
+            continue
+        batch.append((i,p))
+        batchBytes += size
+        if len(batch) >= _batchMaxFiles or batchBytes >= _batchMaxBytes:
+            yield batch
+            batch = []
+            batchBytes = 0
+    if batch:
+        yield batch
+
+# Yields an (index, hash) tuple for each of the given file paths as soon as
+# its hash is available, hashing in the given multiprocessing pool if any
+def iterBlobHashes(items, sizes=None, pool=None):
+    batches = _getBatches(items, sizes)
+    results = pool.imap_unordered(_hashBatch, batches) if pool else (_hashBatch(b) for b in batches)
+    for batch in results:
+        for r in batch:
+            yield r
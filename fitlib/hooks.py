@@ -1,4 +1,4 @@
-from . import gitDirOperation, repoDir, savesDir, getCommitFile
+from . import context, repoDirOperation, getCommitFile
 from . import getFitManifestChanges, dirtyGitItemsFilter, readFitFile
 from changes import getStagedOffenders, saveItems, restoreItems, restoreMissingMessage, checkForChanges
 from merge import getMergedFit
@@ -42,7 +42,7 @@ def _getWorkingTreeStateForLastHead(fitData, fitManifestChanges):
             popen('git checkout HEAD'.split() + list(fitManifestChanges), stdout=open(devnull, 'wb'), stderr=open(devnull, 'wb')).wait()
     return fitData
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def postCheckout():
     fitfileChanged = False
     fitManifestChanges = set(getFitManifestChanges())
@@ -63,14 +63,14 @@ def postCheckout():
     if missing > 0:
         print restoreMissingMessage%missing
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def postCommit():
     fitFileHash = popen('git ls-tree HEAD .fit'.split(), stdout=PIPE).communicate()[0].strip()
     if not fitFileHash:
         return
 
     fitFileHash = fitFileHash.split()[2]
-    savesFile = joinpath(savesDir, fitFileHash)
+    savesFile = joinpath(context.savesDir, fitFileHash)
     committed = []
     if exists(savesFile):
         committed = cache.commit({h for f,(h,s) in readFitFile(savesFile).iteritems()})
@@ -85,7 +85,7 @@ def postCommit():
         print '  cache. If you plan to git-fit push this commit, you must first copy these'
         print '  objects to the datastore configured for this repository bt running git-fit put.'
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def preCommit():
     offenders = getStagedOffenders()
 
@@ -0,0 +1,120 @@
+from os import close as osclose, remove, rename, chmod, umask, path
+from sys import stderr
+from tempfile import mkstemp
+from errno import EAGAIN, EACCES, EWOULDBLOCK
+import platform
+
+try:
+    from fcntl import flock, LOCK_SH, LOCK_EX, LOCK_NB
+except ImportError:
+    flock = None
+
+# Git GUIs and IDEs run git-fit from several hooks and status queries at the
+# same time, so the state fit keeps in the git directory is guarded by
+# reader/writer locks: advisory locks (flock) on lock files, held shared by
+# operations that only read the state (any number of which can run at the
+# same time) and exclusively by those that change it. They are released when
+# the process exits at the latest. Where there is no flock (Windows), the
+# locks are no-ops.
+#
+# A lock that is held already by this process is not taken again, so
+# operations that call others taking the same lock don't deadlock, but one
+# held shared can't be upgraded to exclusive (two processes upgrading would
+# each wait for the other to let go of its shared lock).
+#
+# Files are also never written in place: they are written to a temp file in
+# the same directory, which is then renamed over the original, so a reader
+# that doesn't take the lock (like git itself, reading the .fit file) sees
+# either the old or the new version, but never a partially written one.
+
+# {lockFile: [file, exclusive, depth]}
+_held = {}
+
+def _flock(lockIn, exclusive, quiet):
+    mode = LOCK_EX if exclusive else LOCK_SH
+    try:
+        flock(lockIn.fileno(), mode | LOCK_NB)
+        return
+    except IOError as e:
+        if e.errno not in (EAGAIN, EACCES, EWOULDBLOCK):
+            raise
+    if not quiet:
+        stderr.write('Waiting for another git-fit process to finish...\n')
+    flock(lockIn.fileno(), mode)
+
+def acquire(lockFile, exclusive=False, quiet=False):
+    held = _held.get(lockFile)
+    if held:
+        if exclusive and not held[1]:
+            raise Exception('error: %s is locked for reading, it can not be locked for writing as well.'%lockFile)
+        held[2] += 1
+        return
+
+    lockIn = open(lockFile, 'a')
+    if flock:
+        try:
+            _flock(lockIn, exclusive, quiet)
+        except:
+            lockIn.close()
+            raise
+    _held[lockFile] = [lockIn, exclusive, 1]
+
+def release(lockFile):
+    held = _held[lockFile]
+    held[2] -= 1
+    if held[2] == 0:
+        del _held[lockFile]
+        # Closing the file releases the lock
+        held[0].close()
+
+def isLocked(lockFile):
+    return lockFile in _held
+
+# Decorator that holds the lock file returned by getLockFile (called when
+# the decoratee is, not when decorated) while running the decoratee
+def lockedOperation(getLockFile, exclusive=False):
+    def wrapper(func):
+        def decorator(*args, **kwargs):
+            lockFile = getLockFile()
+            acquire(lockFile, exclusive)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                release(lockFile)
+        return decorator
+    return wrapper
+
+# mkstemp creates files only the owner can read, published files get the
+# permissions they would have had if they had been written in place
+_umask = umask(0)
+umask(_umask)
+
+# Returns the path of a new temp file next to filePath, to be written and
+# then published in its place
+def newTempFile(filePath):
+    tempHandle, tempPath = mkstemp(dir=path.dirname(filePath) or '.', prefix='.%s.'%path.basename(filePath), suffix='.tmp')
+    osclose(tempHandle)
+    chmod(tempPath, 0666 & ~_umask)
+    return tempPath
+
+def publish(tempPath, filePath):
+    if platform.system() == 'Windows' and path.exists(filePath):
+        # Renaming over an existing file fails there
+        remove(filePath)
+    rename(tempPath, filePath)
+
+def discard(tempPath):
+    if path.exists(tempPath):
+        remove(tempPath)
+
+# Writes data to filePath by way of a temp file
+def writeFile(filePath, data, mode='wb'):
+    tempPath = newTempFile(filePath)
+    try:
+        fileOut = open(tempPath, mode)
+        fileOut.write(data)
+        fileOut.close()
+        publish(tempPath, filePath)
+    except:
+        discard(tempPath)
+        raise
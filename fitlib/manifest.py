@@ -0,0 +1,227 @@
+from binascii import hexlify, unhexlify
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+
+# The v2 .fit format is a compact binary alternative to the text format, laid
+# out so that a memory-mapped file can be searched without parsing all of it:
+#
+#   header      "FIT2\0", item count, restart interval, offsets of the path
+#               index and of the hash index
+#   items       per item, sorted by path (bytewise): varint length of the
+#               prefix shared with the previous path, varint length of the
+#               rest of the path, the rest of the path, 20-byte binary hash,
+#               varint size
+#   path index  uint64 offset of every restart item, i.e. of every item whose
+#               number is a multiple of the restart interval. Restart items
+#               share no prefix with the previous path.
+#   hash index  uint32 item number of every item, in order of their hashes
+#
+# All integers are little-endian; varints are LEB128 (7 bits per byte, low
+# bits first, high bit set on all but the last byte).
+
+# The NUL keeps this from ever being mistaken for the start of a text .fit
+magic = 'FIT2\0'
+_header = Struct('<5sIIQQ')
+_offset = Struct('<Q')
+_itemNumber = Struct('<I')
+_hashSize = 20
+_restartInterval = 16
+
+def isManifestData(data):
+    return data[:len(magic)] == magic
+
+_smallVarints = [chr(n) for n in xrange(0x80)]
+
+def _varint(n):
+    if n < 0x80:
+        return _smallVarints[n]
+    out = []
+    while n >= 0x80:
+        out.append(chr(0x80 | (n & 0x7f)))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _readVarint(data, pos):
+    b = ord(data[pos])
+    if b < 0x80:
+        return b, pos+1
+    n = 0
+    shift = 0
+    while b >= 0x80:
+        n |= (b & 0x7f) << shift
+        shift += 7
+        pos += 1
+        b = ord(data[pos])
+    return n | (b << shift), pos+1
+
+# Reads the item at pos given the path of the previous one, returns
+# (path, binary hash, size, position of the next item)
+def _readItem(data, pos, prevPath):
+    shared, pos = _readVarint(data, pos)
+    length, pos = _readVarint(data, pos)
+    p = prevPath[:shared] + data[pos:pos+length]
+    pos += length
+    binHash = data[pos:pos+_hashSize]
+    size, pos = _readVarint(data, pos+_hashSize)
+    return p, binHash, size, pos
+
+# Binary search over slice comparisons, which is quicker than comparing one
+# character at a time in Python. Consecutive paths mostly are in the same
+# directory, so that is tried first.
+def _sharedPrefixLength(a, b):
+    lo = b.rfind('/') + 1
+    if a[:lo] != b[:lo]:
+        lo = 0
+    hi = min(len(a), len(b))
+    while lo < hi:
+        mid = (lo+hi+1)//2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid-1
+    return lo
+
+# Returns the v2 encoding of {path: [hash, size]}. Raises ValueError if any
+# hash is not a hex SHA-1.
+def encodeManifest(fitData):
+    paths = sorted(fitData)
+    items = []
+    restartOffsets = []
+    binHashes = []
+    offset = _header.size
+    prevPath = ''
+    for n,p in enumerate(paths):
+        objHash, size = fitData[p]
+        try:
+            binHash = unhexlify(objHash)
+        except TypeError:
+            binHash = None
+        if not binHash or len(binHash) != _hashSize:
+            raise ValueError('not a SHA-1: %s'%objHash)
+
+        if n%_restartInterval == 0:
+            restartOffsets.append(_offset.pack(offset))
+            shared = 0
+        else:
+            shared = _sharedPrefixLength(prevPath, p)
+        item = '%s%s%s%s%s'%(_varint(shared), _varint(len(p)-shared), p[shared:], binHash, _varint(int(size)))
+        items.append(item)
+        binHashes.append(binHash)
+        offset += len(item)
+        prevPath = p
+
+    hashOrder = sorted(xrange(len(paths)), key=binHashes.__getitem__)
+    pathIndexOffset = offset
+    hashIndexOffset = pathIndexOffset + _offset.size*len(restartOffsets)
+    return ''.join([_header.pack(magic, len(paths), _restartInterval, pathIndexOffset, hashIndexOffset)]
+        + items + restartOffsets + [_itemNumber.pack(n) for n in hashOrder])
+
+# Yields (path, hash, size) for every item of v2 manifest data, in path order
+def iterManifestItems(data):
+    count = _header.unpack_from(data)[1]
+    pos = _header.size
+    p = ''
+    for i in xrange(count):
+        p, binHash, size, pos = _readItem(data, pos, p)
+        yield p, hexlify(binHash), size
+
+def decodeManifest(data):
+    return {p:[h,s] for p,h,s in iterManifestItems(data)}
+
+# Looks up items of a v2 manifest file, or of v2 manifest data in memory,
+# without reading all of it
+class Manifest:
+    def __init__(self, filePath=None, data=None):
+        self.file = None
+        self.data = data
+        if data == None:
+            self.file = open(filePath, 'rb')
+            self.data = data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        if not isManifestData(data):
+            self.close()
+            raise ValueError('not a v2 .fit manifest')
+        self.count, self.restartInterval, self.pathIndexOffset, self.hashIndexOffset = _header.unpack_from(data)[1:]
+        self.restarts = (self.count + self.restartInterval - 1)//self.restartInterval
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.file:
+            self.data.close()
+            self.file.close()
+            self.file = None
+
+    def _restartOffset(self, r):
+        return _offset.unpack_from(self.data, self.pathIndexOffset + r*_offset.size)[0]
+
+    # Yields (item number, path, binary hash, size) from restart item r on
+    def _iterFrom(self, r):
+        pos = self._restartOffset(r)
+        p = ''
+        for n in xrange(r*self.restartInterval, self.count):
+            p, binHash, size, pos = _readItem(self.data, pos, p)
+            yield n, p, binHash, size
+
+    def _item(self, n):
+        for item in self._iterFrom(n//self.restartInterval):
+            if item[0] == n:
+                return item
+
+    # Yields the items from the first one whose path is not less than p on
+    def _iterFromPath(self, p):
+        if not self.count:
+            return
+        # Find the last restart item with a path less than p, the wanted item
+        # is either in its run of items or is the next restart item
+        lo, hi = 0, self.restarts
+        while lo < hi:
+            mid = (lo+hi)//2
+            if _readItem(self.data, self._restartOffset(mid), '')[0] < p:
+                lo = mid+1
+            else:
+                hi = mid
+        for item in self._iterFrom(max(lo-1, 0)):
+            if item[1] >= p:
+                yield item
+
+    # Returns [hash, size] of the item at the given path, or None
+    def get(self, p):
+        for n, itemPath, binHash, size in self._iterFromPath(p):
+            if itemPath == p:
+                return [hexlify(binHash), size]
+            break
+        return None
+
+    # Yields (path, hash, size) of all items whose path starts with prefix,
+    # e.g. "some/dir/" for all items below a directory
+    def iterPrefix(self, prefix):
+        for n, p, binHash, size in self._iterFromPath(prefix):
+            if not p.startswith(prefix):
+                break
+            yield p, hexlify(binHash), size
+
+    def _hashOrderItem(self, i):
+        return self._item(_itemNumber.unpack_from(self.data, self.hashIndexOffset + i*_itemNumber.size)[0])
+
+    # Returns the paths of all items with the given hash
+    def findHash(self, objHash):
+        binHash = unhexlify(objHash)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo+hi)//2
+            if self._hashOrderItem(mid)[2] < binHash:
+                lo = mid+1
+            else:
+                hi = mid
+        paths = []
+        for i in xrange(lo, self.count):
+            n, p, itemHash, size = self._hashOrderItem(i)
+            if itemHash != binHash:
+                break
+            paths.append(p)
+        return paths
+
+    def items(self):
+        return iterManifestItems(self.data)
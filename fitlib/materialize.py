@@ -0,0 +1,52 @@
+from . import refreshStats
+from filecopy import Copier, ingestMode
+import cache
+from os import remove, makedirs
+from os.path import exists, lexists, dirname
+from shutil import move
+
+# Everything fit writes into the working tree goes through a Materializer:
+# cached objects restored by restore, checkout and get, downloaded objects
+# and empty stubs. Objects come out of the cache the way they go into it
+# (see filecopy.py), i.e. as reflinks where the file system allows, or as
+# hard links if fit.cache.ingest is set to hardlink, unless they are stored
+# compressed (see compression.py). An existing file is always replaced
+# rather than written to, as it may be hard linked into the cache.
+#
+# The hash of every file written is known, so finish() stores it with the
+# file's stats, and the file is not hashed again by the next status.
+class Materializer:
+    def __init__(self):
+        self.copier = Copier(ingestMode())
+        self.written = {}
+
+    def _replace(self, filePath):
+        fileDir = dirname(filePath)
+        fileDir and (exists(fileDir) or makedirs(fileDir))
+        if lexists(filePath):
+            remove(filePath)
+
+    # Copies (or links) a cached object to filePath
+    def fromCache(self, objPath, filePath, objHash):
+        self._replace(filePath)
+        cache.extract(objPath, filePath, self.copier)
+        self.written[filePath] = objHash
+
+    # Moves a file that is not in the cache (e.g. a download) to filePath
+    def fromFile(self, srcPath, filePath, objHash):
+        self._replace(filePath)
+        move(srcPath, filePath)
+        self.written[filePath] = objHash
+
+    # Writes a 0-byte placeholder for an object that isn't available
+    def stub(self, filePath):
+        self._replace(filePath)
+        open(filePath, 'w').close()
+        self.written[filePath] = 0
+
+    # Stores the stats of the files written, returns {path: hash} of them
+    # (0 for stubs). Hard linking a file changes the stats of all links to
+    # it, so this must only be done once everything has been written.
+    def finish(self):
+        refreshStats(self.written)
+        return self.written
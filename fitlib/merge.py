@@ -1,5 +1,5 @@
-from . import gitDirOperation, repoDir, fitFile, readFitFile, writeFitFile
-from . import mergeOtherFitFile, mergeMineFitFile, filterBinaryFiles, getFitFileStatus
+from . import context, readFitFile, writeFitFile
+from . import filterBinaryFiles, getFitFileStatus
 import changes
 from os import path, remove
 from shutil import move
@@ -122,8 +122,8 @@ def mergeDriver(common, mine, other):
 
     if conflicts:
         resolved = False
-        writeFitFile(mergedFit, mergeMineFitFile)
-        move(other, mergeOtherFitFile)
+        writeFitFile(mergedFit, context.mergeMineFitFile)
+        move(other, context.mergeOtherFitFile)
         prepareResolutionForm(conflicts, mine)
         print conflictMsg
     else:
@@ -174,8 +174,8 @@ def resolve():
     return True
 
 def getResolutions():
-    mineFitData = readFitFile(mergeMineFitFile)
-    otherFitData = readFitFile(mergeOtherFitFile)
+    mineFitData = readFitFile(context.mergeMineFitFile)
+    otherFitData = readFitFile(context.mergeOtherFitFile)
 
     mine = []
     theirs = []
@@ -185,7 +185,7 @@ def getResolutions():
     stack = []
     batchResolution = ''
 
-    for n,l in enumerate(open(fitFile).readlines()):
+    for n,l in enumerate(open(context.fitFile).readlines()):
         if l.startswith('#'):
             continue
         l = l.strip()
@@ -239,9 +239,9 @@ def isMergeInProgress():
 
     merging = (
         ('U' in fitFileStatus or fitFileStatus in ('AA', 'DD'))
-        and path.exists(mergeMineFitFile) and path.exists(mergeOtherFitFile)
-        and path.exists(fitFile) and fitFile not in filterBinaryFiles([fitFile])
-        and open(fitFile).next().strip() == crfHeader[0]
+        and path.exists(context.mergeMineFitFile) and path.exists(context.mergeOtherFitFile)
+        and path.exists(context.fitFile) and context.fitFile not in filterBinaryFiles([context.fitFile])
+        and open(context.fitFile).next().strip() == crfHeader[0]
     )
 
     if not merging:
@@ -249,11 +249,15 @@ def isMergeInProgress():
 
     return merging
 
+# Status runs at the same time (which only share the repo lock) may all find
+# a merge to have ended, and clean up after it
 def cleanupMergeArtifacts():
-    if path.exists(mergeMineFitFile):
-        remove(mergeMineFitFile)
-    if path.exists(mergeOtherFitFile):
-        remove(mergeOtherFitFile)
+    for f in (context.mergeMineFitFile, context.mergeOtherFitFile):
+        try:
+            remove(f)
+        except OSError:
+            if path.exists(f):
+                raise
 
 def getMergedFit(common, mine, other):
     mineMod,mineAdd,mineRem = fitDiff(common, mine)
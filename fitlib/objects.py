@@ -1,18 +1,58 @@
-from . import gitDirOperation, refreshStats, getFitSize, readFitFile, writeFitFile, getCommitFile, commitsDir
-from . import repoDir, fitDir, objectsDir, tempDir, workingDir
+from . import repoDirOperation, getFitSize, readFitFile, writeFitFile, getCommitFile
+from . import context, workingDir, gitConfig, getConvertedPaths, gitHashData
 from paths import getValidFitPaths
 import cache
-from subprocess import Popen as popen, PIPE
-from os.path import dirname, basename, splitext, exists, join as joinpath, getsize
-from os import walk, makedirs, remove, close as osclose, mkdir, listdir, stat
-from shutil import copyfile, move
+from os.path import basename, splitext, exists, join as joinpath, getsize
+from os import walk, remove, close as osclose, mkdir, listdir, stat
+from materialize import Materializer
+from functools import partial
+from hashlib import sha1
+from hashing import BlobHasher, gitBlobHash
+from asyncstore import AsyncStore
+from multiprocessing.pool import ThreadPool
+from shutil import move
 from sys import stdout
 from tempfile import mkstemp
-from skipExtensions import downstreamSkipExtensionsCaseInsensitive, downstreamSkipExtensionsCaseSensitive
-
-def getDataStore(progressCallback):
-    moduleName = popen('git config fit.datastore.moduleName'.split(), stdout=PIPE).communicate()[0].strip()
-    modulePath = popen('git config fit.datastore.modulePath'.split(), stdout=PIPE).communicate()[0].strip()
+from threading import local, Lock
+from time import time
+from skipExtensions import getSkipExtensionsCaseInsensitive, getSkipExtensionsCaseSensitive, isSkippedExtension
+
+# Transfers run on fit.transfer.jobs threads, so that many small objects
+# aren't gotten or put one round trip to the store after the other. Stores
+# that can't be used from several threads at once say so by setting
+# threadSafe to False (see DataStore), their transfers run one at a time.
+_defaultTransferJobs = 8
+
+def getTransferJobs():
+    jobs = gitConfig('fit.transfer.jobs')
+    return int(jobs) if jobs else _defaultTransferJobs
+
+# Asynchronous stores (see asyncstore.py) have up to fit.transfer.inFlight
+# transfers going at once instead, however few threads there are
+_defaultTransfersInFlight = 64
+
+def getTransfersInFlight():
+    inFlight = gitConfig('fit.transfer.inFlight')
+    return int(inFlight) if inFlight else _defaultTransfersInFlight
+
+# Downloads are checked to be the objects they were gotten for. The object id
+# is computed as the object comes in: whenever the store reports progress on a
+# download, what it has written to the file since is hashed (while it's still
+# in memory), and what's left of it once it's complete. A store that doesn't
+# write the file front to back only makes that come out wrong, so the file is
+# hashed again in full before a mismatch is believed. The ids of files that
+# git converts or filters (see getConvertedPaths) are those of their converted
+# contents, so those are hashed by git then. Downloads that fail or don't
+# match are tried again up to fit.transfer.retries times.
+_defaultTransferRetries = 2
+
+def getTransferRetries():
+    retries = gitConfig('fit.transfer.retries')
+    return int(retries) if retries else _defaultTransferRetries
+
+def getDataStoreClass():
+    moduleName = gitConfig('fit.datastore.moduleName')
+    modulePath = gitConfig('fit.datastore.modulePath')
 
     if not moduleName:
         raise Exception('error: No external data store is configured. Check the fit.datastore keys in git config.')
@@ -23,11 +63,14 @@ def getDataStore(progressCallback):
 
     try:
         from importlib import import_module
-        return import_module(moduleName).Store(progressCallback)
+        return import_module(moduleName).Store
     except Exception as e:
         print 'error: Could not load the data store configured in fit.datastore.'
         raise
 
+def getDataStore(progressCallback):
+    return getDataStoreClass()(progressCallback)
+
 def getUpstreamItems():
     cachedCommits = cache.getCommittedObjects()
     return set(f for f,(h,s) in readFitFile(getCommitFile()).iteritems() if h in cachedCommits)
@@ -35,7 +78,7 @@ def getUpstreamItems():
 def getDownstreamItems(fitTrackedData, paths, stats):
     cached = cache.find((fitTrackedData[p][0] for p in paths), update=False)
     skippedFiles = []
-    downstreamItems = [p for p in paths if not (p in stats or fitTrackedData[p][0] in cached or True if (splitext(p)[-1] not in downstreamSkipExtensionsCaseSensitive) else True if (splitext(p)[-1] not in map(str.lower, downstreamSkipExtensionsCaseInsensitive)) else False, skippedFiles.append(p))]
+    downstreamItems = [p for p in paths if not (p in stats or fitTrackedData[p][0] in cached or True if (splitext(p)[-1] not in getSkipExtensionsCaseSensitive()) else True if (splitext(p)[-1] not in map(str.lower, getSkipExtensionsCaseInsensitive())) else False, skippedFiles.append(p))]
     return downstreamItems, skippedFiles
 
 class _ProgressPrinter:
@@ -64,7 +107,9 @@ class _ProgressPrinter:
             print '\rOverall: %6.2f%%    %7.3f MB   %6.2f%%   %s'%fmt_args,
         stdout.flush()
         self.item_started = True
-    def newItem(self, name, size):
+    def itemProgress(self):
+        return self.updateProgress
+    def newItem(self, name, size, count=1):
         if self.size_item and self.item_started:
             print
 
@@ -81,37 +126,125 @@ class _ProgressPrinter:
     def setTotalSize(self, totalSize):
         self.size_total = totalSize
 
+# Progress of several transfers in flight at once is shown on one line: the
+# overall progress, and the items in flight. Progress reported by the store
+# is for the item that the reporting thread is transferring, or for the one
+# given by itemProgress, for stores that report from other threads.
+_progressInterval = 0.1
+_progressWidth = 79
+
+class _ConcurrentProgressPrinter:
+    def __init__(self):
+        self.size_total = 0
+        self.size_done = 0
+        self.items_done = 0
+        self.in_flight = []
+        self.current = local()
+        self.lock = Lock()
+        self.printed = 0
+        self.last_print = 0
+
+    def _finishItem(self):
+        item = getattr(self.current, 'item', None)
+        if item:
+            self.in_flight.remove(item)
+            self.size_done += item[1]
+            self.items_done += item[3]
+            self.current.item = None
+
+    def _print(self, force=False):
+        now = time()
+        if not force and now - self.last_print < _progressInterval:
+            return
+        self.last_print = now
+        done = self.size_done + sum(i[2] for i in self.in_flight)
+        line = 'Overall: %6.2f%%    %d done, %d in flight   %s'%(done*100./(self.size_total or 1), self.items_done,
+            len(self.in_flight), ' '.join(basename(i[0]) for i in self.in_flight))
+        line = line[:_progressWidth]
+        print '\r%s%s'%(line, ' '*(self.printed - len(line))),
+        stdout.flush()
+        self.printed = len(line)
+
+    def updateProgress(self, done, size, custom_item_string=None):
+        self._updateItem(getattr(self.current, 'item', None), done, size, custom_item_string)
+
+    # Returns the progress callback of the item this thread is transferring
+    def itemProgress(self):
+        return partial(self._updateItem, getattr(self.current, 'item', None))
+
+    def _updateItem(self, item, done, size, custom_item_string=None):
+        if not item:
+            return
+        self.lock.acquire()
+        try:
+            item[2] = min(done, item[1])
+            if custom_item_string == 'ERROR':
+                # Failures are listed again at the end, but show which ones
+                # as they happen
+                print '\r%-*s'%(self.printed, '%s   %s'%(custom_item_string, item[0]))
+                self.printed = 0
+            self._print(force=custom_item_string != None)
+        finally:
+            self.lock.release()
+
+    # A batch of items is transferred as one, count is the number of items
+    def newItem(self, name, size, count=1):
+        self.lock.acquire()
+        try:
+            self._finishItem()
+            self.current.item = [name, size, 0, count]
+            self.in_flight.append(self.current.item)
+            self._print()
+        finally:
+            self.lock.release()
+
+    def done(self):
+        self.lock.acquire()
+        try:
+            self.size_done += sum(i[1] for i in self.in_flight)
+            self.items_done += sum(i[3] for i in self.in_flight)
+            self.in_flight = []
+            if self.items_done:
+                self._print(force=True)
+                print
+        finally:
+            self.lock.release()
+
+    def setTotalSize(self, totalSize):
+        self.size_total = totalSize
+
 class _QuietProgressPrinter:
-    def updateProgress(self, done, size):
+    def updateProgress(self, done, size, custom_item_string=None):
         pass
-    def newItem(self, name, size):
+    def itemProgress(self):
+        return self.updateProgress
+    def newItem(self, name, size, count=1):
         pass
     def done(self):
         pass
     def setTotalSize(self, totalSize):
         pass
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=False):    
     allItems = fitTrackedData.keys()
-    validPaths = getValidFitPaths(pathArgs, allItems, basePath=repoDir, workingDir=workingDir) if pathArgs else allItems
+    validPaths = getValidFitPaths(pathArgs, allItems, basePath=context.repoDir, workingDir=workingDir) if pathArgs else allItems
 
     needed = []   # not in working tree nor in cache, must be downloaded
     touched = {}
     skippedFiles = [] # these files will not be transferred downstream, because they are configured to be skipped based on extension
 
+    materializer = Materializer()
     cached = cache.find(fitTrackedData[f][0] for f in validPaths)
     for filePath in validPaths:
         objHash, size = fitTrackedData[filePath]
         if exists(filePath) and getsize(filePath) == 0:
             objPath = cached.get(objHash)
-            fileDir = dirname(filePath)
-            fileDir and (exists(fileDir) or makedirs(fileDir))
             if objPath:
-                copyfile(objPath, filePath)
+                materializer.fromCache(objPath, filePath, objHash)
                 touched[filePath] = objHash
             else:
-                if splitext(filePath)[-1].lower() in map(str.lower, downstreamSkipExtensionsCaseInsensitive) or splitext(filePath)[-1] in downstreamSkipExtensionsCaseSensitive:
+                if isSkippedExtension(filePath):
                     skippedFiles.append((filePath, objHash, size))
                 else:
                     needed.append((filePath, objHash, size))
@@ -128,17 +261,17 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
         if len(skippedFiles) > 0:
             print
             for filePath,h,size in sorted(skippedFiles):
-                print '  %6.2fMB  %s (skipped)'%(size/1048576, filePath)
+                print '  %6.2fMB  %s (skipped)'%(size/1048576., filePath)
             
             print '\nThe above objects will be skipped (based on extension).'
-            print 'Total tranfer size (skipped): %.2fMB'%(totalSkippedSize/1048576)
+            print 'Total tranfer size (skipped): %.2fMB'%(totalSkippedSize/1048576.)
         
         if len(needed) > 0:
             print
             for filePath,h,size in sorted(needed):
-                print '  %6.2fMB  %s'%(size/1048576, filePath)
+                print '  %6.2fMB  %s'%(size/1048576., filePath)
                 
-            print '\nThe above objects can be tranferred (total transfer size: %.2fMB).'%(totalSize/1048576)
+            print '\nThe above objects can be tranferred (total transfer size: %.2fMB).'%(totalSize/1048576.)
             print 'You may run git-fit get to start the transfer.'
             
     elif summary:
@@ -156,48 +289,311 @@ def get(fitTrackedData, pathArgs=None, summary=False, showlist=False, quiet=Fals
                 print '\nNo transfers required.'
     else:
         successes = []
-        _transfer(_get, needed + skippedFiles, totalSize + totalSkippedSize, fitTrackedData, successes, quiet)
-
-        for filePath, objHash, size in successes:
-            touched[filePath] = objHash
-
-    refreshStats(touched)
-
-def _get(items, store, pp, successes, failures):
-    if not exists(tempDir):
-        mkdir(tempDir)
-    
-    skippedFiles = []
-    for filePath,objHash,size in items:
-        if splitext(filePath)[-1].lower() in map(str.lower, downstreamSkipExtensionsCaseInsensitive) or splitext(filePath)[-1] in downstreamSkipExtensionsCaseSensitive:
-            pp.newItem(filePath, size)
-            pp.updateProgress(size, size, custom_item_string='Skipped')
-            skippedFiles.append(filePath)
-            continue
-        pp.newItem(filePath, size)
-        
-        # Copy download to temp file first, and then to actual object location
-        # This is to prevent interrupted downloads from causing bad objects to be placed
-        # in the objects cache
-        (tempHandle, tempTransferFile) = mkstemp(dir=tempDir)
-        osclose(tempHandle)
-        key = store.check('%s/%s'%(objHash[:2], objHash[2:]))
+        _transfer(partial(_get, materializer=materializer), needed + skippedFiles, totalSize + totalSkippedSize, fitTrackedData, successes, quiet)
+
+    materializer.finish()
+
+_waitTimeout = 1 << 20
+_skipped = 'skipped'
+
+# Stores can check and transfer many objects per call (see DataStore). If
+# they can, keys are checked _batchSize per call, and objects that are cached
+# as they are (neither chunked nor compressed) are gotten and put in batches
+# of that many. The chunks of a chunked object are checked and transferred
+# in batches as well.
+_batchSize = 256
+
+# Runs transfer(item) for all items, on jobs threads, and yields
+# (item, result) in the order of the items
+def _iterTransfers(transfer, items, jobs):
+    if jobs <= 1 or len(items) < 2:
+        for i in items:
+            yield i, transfer(i)
+        return
 
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        results = pool.imap(lambda i: (i, transfer(i)), items)
+        while True:
+            # Waiting with a timeout can be interrupted (with Ctrl-C)
+            try:
+                r = results.next(_waitTimeout)
+            except StopIteration:
+                return
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Runs transferBatch(batch) for the batches (returning a result per item)
+# and transferItem(item) for the items, on jobs threads, and yields
+# (item, result) for all items
+def _iterUnits(transferBatch, transferItem, batches, items, jobs):
+    def transfer(unit):
+        return transferBatch(unit) if isinstance(unit, list) else [transferItem(unit)]
+    for unit,results in _iterTransfers(transfer, batches + items, jobs):
+        for r in zip(unit if isinstance(unit, list) else [unit], results):
+            yield r
+
+def _hasBatch(store, method):
+    return callable(getattr(store, method + 'Many', None))
+
+def _batches(items):
+    return [items[i:i+_batchSize] for i in xrange(0, len(items), _batchSize)]
+
+def _batchName(batch):
+    return batch[0][0] if len(batch) == 1 else '%s and %d more'%(batch[0][0], len(batch) - 1)
+
+def _objectKey(objHash):
+    return '%s/%s'%(objHash[:2], objHash[2:])
+
+def _checkBatch(keys, store):
+    try:
+        return store.checkMany(keys)
+    except:
+        # Which fails the transfers of those objects
+        return {}
+
+# Returns {key: location} for those of the keys the store has, checking
+# _batchSize keys per call if the store can, and one per call otherwise
+def _checkKeys(store, keys, jobs=1):
+    keys = list(keys)
+    located = {}
+    if _hasBatch(store, 'check'):
+        for b,found in _iterTransfers(partial(_checkBatch, store=store), _batches(keys), jobs):
+            located.update(found)
+    else:
+        for k,l in _iterTransfers(store.check, keys, jobs):
+            if l:
+                located[k] = l
+    return located
+
+# Returns the location of key, from the keys checked up front if they were
+def _locate(store, key, located):
+    return store.check(key) if located == None else located.get(key)
+
+# Gets or puts (depending on method) [(src, dst, size)] in as few calls as
+# the store allows, returns the set of dsts transferred
+def _transferAll(store, method, transfers):
+    if _hasBatch(store, method):
+        done = set()
+        for b in _batches(transfers):
+            done.update(getattr(store, method + 'Many')(b))
+        return done
+    return {d for s,d,n in transfers if getattr(store, method)(s, d, n)}
+
+def _newTempFile():
+    (tempHandle, tempFile) = mkstemp(dir=context.tempDir)
+    osclose(tempHandle)
+    return tempFile
+
+# Objects are downloaded to a partial file in tempDir named after them, which
+# is kept if the download fails when the store is resumable (see DataStore),
+# so that the next get continues where it stopped. Files in tempDir that
+# haven't been written to for _staleAge seconds (abandoned downloads, and
+# temp files left behind by interrupted runs) are removed by every get and put.
+_partialSuffix = '.part'
+_staleAge = 7 * 24 * 3600
+
+def _partialFile(objHash):
+    return joinpath(context.tempDir, objHash + _partialSuffix)
+
+def _removeStaleTempFiles():
+    now = time()
+    for f in listdir(context.tempDir):
+        filePath = joinpath(context.tempDir, f)
+        try:
+            if now - stat(filePath).st_mtime > _staleAge:
+                remove(filePath)
+        except OSError:
+            pass
+
+def _isResumable(store):
+    return getattr(store, 'resumable', False)
+
+# Returns the file to download item to: the partial file of its object, unless
+# that is for another item of the same object
+def _downloadFile(item, partials):
+    return _partialFile(item[1]) if partials.get(item[1]) == item else _newTempFile()
+
+# Removes what failed to download to downloadFile, unless it can be continued
+def _discardDownload(store, downloadFile):
+    if not (_isResumable(store) and downloadFile.endswith(_partialSuffix)):
+        exists(downloadFile) and remove(downloadFile)
+
+# (dst, hasher) of the download in progress on this thread
+_downloading = local()
+
+# Reports progress on an item, and hashes what's come in of its download
+# (dst, hasher) if it is one. Stores pass on the size they were given, which
+# is None for recipes (see _getChunked).
+def _reportProgress(updateProgress, download, done, size, *args, **kwargs):
+    if download:
         try:
-            transferred = store.get(key, tempTransferFile, size)
+            download[1].catchUp(download[0])
+        except OSError:
+            # Not there yet
+            pass
+    # Nor is there progress to show on what isn't known the size of
+    if size != None:
+        updateProgress(done, size, *args, **kwargs)
+
+# Returns the progress callback of what this thread is transferring
+def _itemProgress(pp):
+    return partial(_reportProgress, pp.itemProgress(), getattr(_downloading, 'current', None))
+
+# The progress callback stores are given, for what the calling thread is
+# transferring
+def _threadProgress(pp, *args, **kwargs):
+    _itemProgress(pp)(*args, **kwargs)
+
+# Gets key into dst, continuing from what's in it already if the store can
+def _getStreamed(store, key, dst, size, hasher):
+    offset = getsize(dst) if exists(dst) else 0
+    if not (0 < offset < size and _isResumable(store)):
+        offset = 0
+    else:
+        hasher.catchUp(dst)
+    _downloading.current = (dst, hasher)
+    try:
+        return store.get(key, dst, size, offset) if offset else store.get(key, dst, size)
+    finally:
+        _downloading.current = None
+
+# Returns the object id of filePath, as git hashes it at gitPath if given
+def _hashFile(filePath, gitPath=None):
+    if not gitPath:
+        return gitBlobHash(filePath)
+    fileIn = open(filePath, 'rb')
+    try:
+        return gitHashData(iter(lambda: fileIn.read(1 << 20), ''), gitPath)
+    finally:
+        fileIn.close()
+
+# Gets an object into dst with transfer(dst, hasher), trying again up to
+# retries times if it can't be gotten or isn't objHash (as git hashes it at
+# gitPath, if given). Corrupt downloads are removed, failed ones are continued
+# where the store can.
+def _getVerified(transfer, dst, objHash, size, retries, gitPath=None):
+    for attempt in xrange(retries + 1):
+        hasher = BlobHasher(size)
+        try:
+            if not transfer(dst, hasher):
+                continue
+            hasher.catchUp(dst)
+            if hasher.hexdigest() == objHash or _hashFile(dst, gitPath) == objHash:
+                return True
         except:
-            transferred = False
-        if key and transferred:
-            pp.updateProgress(size, size)
-            popen(['mv', tempTransferFile, filePath]).wait()
+            continue
+        finally:
+            hasher.close()
+        remove(dst)
+    return False
+
+# Gets the object stored under key into dst (see _getVerified)
+def _getObject(store, key, dst, objHash, size, retries, gitPath=None):
+    return _getVerified(lambda d, hasher: _getStreamed(store, key, d, size, hasher), dst, objHash, size, retries, gitPath)
+
+# Downloads a batch of objects stored under their own keys, returns a temp
+# file for each, or None if it could not be gotten. There's no progress on
+# the objects of a batch to hash them by as they come in, they are hashed
+# once they are all there.
+def _getBatch(batch, store, pp, located, partials, retries, converted):
+    size = sum(s for f,h,s in batch)
+    pp.newItem(_batchName(batch), size, len(batch))
+    tempFiles = [_downloadFile(i, partials) for i in batch]
+    try:
+        gotten = _transferAll(store, 'get', [(located[_objectKey(h)], t, s) for (f,h,s),t in zip(batch, tempFiles)])
+    except:
+        gotten = set()
+    failed = 0
+    for i,((f,h,s),t) in enumerate(zip(batch, tempFiles)):
+        gitPath = f if f in converted else None
+        if t in gotten:
+            if _hashFile(t, gitPath) == h:
+                continue
+            remove(t)
+        # Those that failed or don't match are tried again one at a time
+        if retries and _getObject(store, located[_objectKey(h)], t, h, s, retries - 1, gitPath):
+            continue
+        _discardDownload(store, t)
+        tempFiles[i] = None
+        failed += 1
+    pp.updateProgress(size, size, custom_item_string='ERROR' if failed else None)
+    return tempFiles
+
+# Downloads an item to a temp file, returns the temp file, _skipped, or None
+# if it could not be gotten
+def _getItem(item, store, pp, located, partials, retries, converted):
+    filePath,objHash,size = item
+    pp.newItem(filePath, size)
+    if isSkippedExtension(filePath):
+        pp.updateProgress(size, size, custom_item_string='Skipped')
+        return _skipped
+
+    # Copy download to temp file first, and then to actual object location
+    # This is to prevent interrupted downloads from causing bad objects to be placed
+    # in the objects cache
+    tempTransferFile = _downloadFile(item, partials)
+    gitPath = filePath if filePath in converted else None
+    try:
+        key = _locate(store, _objectKey(objHash), located)
+        if key:
+            transferred = _getObject(store, key, tempTransferFile, objHash, size, retries, gitPath)
+        else:
+            key = _locate(store, _objectKey(objHash) + _recipeSuffix, located)
+            transferred = key and _getVerified(lambda d, hasher: _getChunked(key, d, size, store, hasher),
+                tempTransferFile, objHash, size, retries, gitPath)
+    except:
+        transferred = False
+    if transferred:
+        pp.updateProgress(size, size)
+        return tempTransferFile
+    pp.updateProgress(size, size, custom_item_string='ERROR')
+    _discardDownload(store, tempTransferFile)
+    return None
+
+# Downloaded items are moved into the working tree as they come in, by this
+# thread, while the next ones are still being transferred
+def _get(items, store, pp, successes, failures, jobs, materializer):
+    if not exists(context.tempDir):
+        mkdir(context.tempDir)
+    _removeStaleTempFiles()
+
+    # {hash: the item downloaded to the object's partial file}
+    partials = {}
+    for i in items:
+        partials.setdefault(i[1], i)
+
+    located = None
+    batches = []
+    if _hasBatch(store, 'check'):
+        wanted = [i for i in items if not isSkippedExtension(i[0])]
+        located = _checkKeys(store, [_objectKey(h) for f,h,s in wanted], jobs)
+        located.update(_checkKeys(store, [_objectKey(h) + _recipeSuffix for f,h,s in wanted if _objectKey(h) not in located], jobs))
+        if _hasBatch(store, 'get'):
+            # Those there is a partial download of are continued one by one
+            batches = _batches([i for i in wanted if _objectKey(i[1]) in located
+                and not (_isResumable(store) and exists(_partialFile(i[1])))])
+            batched = {i for b in batches for i in b}
+            items = [i for i in items if i not in batched]
+
+    retries = getTransferRetries()
+    converted = getConvertedPaths(f for f,h,s in items + [i for b in batches for i in b])
+    gotten = _iterUnits(partial(_getBatch, store=store, pp=pp, located=located, partials=partials, retries=retries, converted=converted),
+        partial(_getItem, store=store, pp=pp, located=located, partials=partials, retries=retries, converted=converted), batches, items, jobs)
+    for (filePath,objHash,size),tempTransferFile in gotten:
+        if tempTransferFile == _skipped:
+            continue
+        if tempTransferFile:
+            materializer.fromFile(tempTransferFile, filePath, objHash)
             successes.append((filePath, objHash, size))
         else:
-            pp.updateProgress(size, size, custom_item_string='ERROR')
             failures.append(filePath)
 
     cache.insert({h:(s,f) for f,h,s in successes}, inLru=True, progressMsg='Caching newly gotten items')
 
-@gitDirOperation(repoDir)
+@repoDirOperation
 def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=False, quiet=False):
     commitsFile = getCommitFile()
     commitsFitData = readFitFile(commitsFile)
@@ -210,13 +606,17 @@ def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=Fal
     elif showlist:
         print
         for filePath,h,size in available:
-            print '  %6.2fMB  %s'%(size/1048576, filePath)
-        print '\nThe above objects can be tranferred (maximum total transfer size: %.2fMB).'%(totalSize/1048576)
+            print '  %6.2fMB  %s'%(size/1048576., filePath)
+        print '\nThe above objects can be tranferred (maximum total transfer size: %.2fMB).'%(totalSize/1048576.)
         print 'You may run git-fit put to start the transfer.'
     elif summary:
         print len(fitTrackedData), 'items are being tracked'
         print len(available), 'of the tracked items MAY need to be sent to external location'
-        print '%.2fMB maximum possible transfer size'%(totalSize/1048576)
+        print '%.2fMB maximum possible transfer size'%(totalSize/1048576.)
+        chunkedSize, newChunksSize = _getChunkedTransferSizes(available)
+        if chunkedSize:
+            print '%.2fMB of it is stored in chunks, of which %.2fMB are new (dedup ratio %.1f:1)'%(chunkedSize/1048576.,
+                newChunksSize/1048576., chunkedSize/float(newChunksSize) if newChunksSize else float('inf'))
         print 'Run \'git-fit put -l\' to list these items.'
     else:
         successes = []
@@ -229,51 +629,170 @@ def put(fitTrackedData, pathArgs=None, force=False, summary=False,  showlist=Fal
         writeFitFile(commitsFitData, commitsFile)
     elif exists(commitsFile):
         remove(commitsFile)
-    for f in sorted(listdir(commitsDir), key=lambda x: stat(joinpath(commitsDir, x)).st_mtime)[:-2]:
-        remove(joinpath(commitsDir, f))
-
-def _put(items, store, pp, successes, failures):
-    cached = cache.find(o for f,o,s in items)
+    for f in sorted(listdir(context.commitsDir), key=lambda x: stat(joinpath(context.commitsDir, x)).st_mtime)[:-2]:
+        remove(joinpath(context.commitsDir, f))
+
+# Returns the total size of the chunked objects among the given items, and
+# that of the chunks of them that haven't been sent yet
+def _getChunkedTransferSizes(items):
+    cached = cache.find((o for f,o,s in items), update=False)
+    chunkedSize = 0
+    newChunks = {}
     for filePath,objHash,size in items:
-        pp.newItem(filePath, size)
-        if objHash not in cached:
-            pp.updateProgress(size, size, custom_item_string='ERROR')
-            failures.append(filePath)
-            continue
-
-        done = True
-        keyName = '%s/%s'%(objHash[:2], objHash[2:])
-        if store.check(keyName):
+        if objHash in cached and cache.isChunked(cached[objHash]):
+            chunkedSize += size
+            newChunks.update(cache.readRecipe(cached[objHash]))
+    uploaded = {c for c,(p,u) in cache.findChunks(newChunks).iteritems() if u}
+    return chunkedSize, sum(s for c,s in newChunks.iteritems() if c not in uploaded)
+
+def _chunkKey(chunkHash):
+    return 'chunks/%s/%s'%(chunkHash[:2], chunkHash[2:])
+
+# Chunked objects (see chunking.py) are put as the chunks the data store
+# doesn't have yet, followed by their recipe (stored under the key of the
+# object with _recipeSuffix appended, which get looks for if there is no
+# object under its own key)
+_recipeSuffix = '.chunks'
+
+def _putChunked(objPath, keyName, store):
+    recipe = cache.readRecipe(objPath)
+    chunks = cache.findChunks(c for c,s in recipe)
+    unsent = {c:s for c,s in recipe if not chunks[c][1]}
+    located = _checkKeys(store, (_chunkKey(c) for c in unsent))
+    missing = [(chunks[c][0], _chunkKey(c), s) for c,s in unsent.iteritems() if _chunkKey(c) not in located]
+    put = _transferAll(store, 'put', missing)
+    cache.setChunksUploaded(c for c in unsent if _chunkKey(c) in located or _chunkKey(c) in put)
+    if len(put) < len(missing):
+        return False
+    return store.put(objPath, keyName + _recipeSuffix, getsize(objPath))
+
+# Gets a chunked object into dst, taking what chunks there are from the cache,
+# and passing the object to hasher as it's put together if given
+def _getChunked(recipeKey, dst, size, store, hasher=None):
+    recipeFile = dst + _recipeSuffix
+    tempFiles = [recipeFile]
+    try:
+        # What size the recipe is isn't known until it's there
+        if not store.get(recipeKey, recipeFile, None):
+            return False
+        recipe = cache.readRecipe(recipeFile)
+        chunks = {c:p for c,(p,u) in cache.findChunks(c for c,s in recipe).iteritems()}
+        missing = {c:s for c,s in recipe if c not in chunks}
+        located = _checkKeys(store, (_chunkKey(c) for c in missing))
+        if len(located) < len(missing):
+            return False
+        transfers = [(located[_chunkKey(c)], '%s.%s'%(dst, c), s) for c,s in missing.iteritems()]
+        tempFiles += [t for l,t,s in transfers]
+        gotten = _transferAll(store, 'get', transfers)
+        for c in missing:
+            chunkFile = '%s.%s'%(dst, c)
+            if chunkFile not in gotten or sha1(open(chunkFile, 'rb').read()).hexdigest() != c:
+                return False
+            chunks[c] = chunkFile
+        cache.assemble([chunks[c] for c,s in recipe], dst, hasher)
+        return True
+    finally:
+        for f in tempFiles:
+            exists(f) and remove(f)
+
+# Uploads a batch of objects cached as they are, returns for each whether the
+# store has it now
+def _putBatch(batch, store, pp, cached):
+    size = sum(s for f,h,s in batch)
+    pp.newItem(_batchName(batch), size, len(batch))
+    try:
+        put = _transferAll(store, 'put', [(cached[h], _objectKey(h), s) for f,h,s in batch])
+    except:
+        put = set()
+    pp.updateProgress(size, size, custom_item_string=None if len(put) == len(batch) else 'ERROR')
+    return [_objectKey(h) in put for f,h,s in batch]
+
+# Uploads a cached object, returns whether the store has it now
+def _putItem(item, store, pp, cached, located):
+    filePath,objHash,size = item
+    pp.newItem(filePath, size)
+    if objHash not in cached:
+        pp.updateProgress(size, size, custom_item_string='ERROR')
+        return False
+
+    keyName = _objectKey(objHash)
+    objPath = cached[objHash]
+    tempFile = None
+    try:
+        if _locate(store, keyName, located) or _locate(store, keyName + _recipeSuffix, located):
             pp.updateProgress(size, size, custom_item_string='No transfer needed.')
+            return True
+        if cache.isChunked(objPath):
+            transferred = _putChunked(objPath, keyName, store)
+        elif cache.isCompressed(objPath):
+            # The store gets the contents, not the compressed object
+            tempFile = _newTempFile()
+            cache.extract(objPath, tempFile)
+            transferred = store.put(tempFile, keyName, size)
         else:
-            try:
-                transferred = store.put(cached[objHash], keyName, size)
-            except:
-                transferred = False
-            if transferred:
-                pp.updateProgress(size, size)
-            else:
-                done = False
-                pp.updateProgress(size, size, custom_item_string='ERROR')
-                failures.append(filePath)
-        if done:
-            successes.append((filePath, objHash, size))
+            transferred = store.put(objPath, keyName, size)
+    except:
+        transferred = False
+    finally:
+        tempFile and exists(tempFile) and remove(tempFile)
+    if transferred:
+        pp.updateProgress(size, size)
+        return True
+    pp.updateProgress(size, size, custom_item_string='ERROR')
+    return False
+
+def _put(items, store, pp, successes, failures, jobs):
+    exists(context.tempDir) or mkdir(context.tempDir)
+    _removeStaleTempFiles()
+    cached = cache.find(o for f,o,s in items)
+    located = None
+    batches = []
+    if _hasBatch(store, 'check'):
+        keys = [_objectKey(o) for f,o,s in items if o in cached]
+        located = _checkKeys(store, keys + [k + _recipeSuffix for k in keys], jobs)
+        if _hasBatch(store, 'put'):
+            batches = _batches([(f,o,s) for f,o,s in items if o in cached and not cache.isCompressed(cached[o])
+                and _objectKey(o) not in located and _objectKey(o) + _recipeSuffix not in located])
+            batched = {i for b in batches for i in b}
+            items = [i for i in items if i not in batched]
+
+    put = _iterUnits(partial(_putBatch, store=store, pp=pp, cached=cached),
+        partial(_putItem, store=store, pp=pp, cached=cached, located=located), batches, items, jobs)
+    for item,transferred in put:
+        if transferred:
+            successes.append(item)
+        else:
+            failures.append(item[0])
 
     cache.enque(o for f,o,s in successes)
 
 def _transfer(method, items, size, fitTrackedData, successes, quiet):
-    pp = _QuietProgressPrinter() if quiet else _ProgressPrinter()
+    try:
+        storeClass = getDataStoreClass()
+    except Exception as e:
+        print e
+        return
+
+    # Stores that don't derive from DataStore predate the flag
+    jobs = getTransferJobs() if getattr(storeClass, 'threadSafe', True) else 1
+    if quiet:
+        pp = _QuietProgressPrinter()
+    else:
+        pp = _ProgressPrinter() if jobs <= 1 or len(items) < 2 else _ConcurrentProgressPrinter()
     pp.setTotalSize(size)
     try:
-        store = getDataStore(pp.updateProgress)
+        store = storeClass(partial(_threadProgress, pp))
+        if getattr(storeClass, 'asynchronous', False):
+            store = AsyncStore(store, getTransfersInFlight(), partial(_itemProgress, pp))
     except Exception as e:
+        print 'error: Could not load the data store configured in fit.datastore.'
         print e
         return
 
     failures = []
     items.sort()
 
-    method(items, store, pp, successes, failures)
+    method(items, store, pp, successes, failures, jobs)
 
     pp.done()
     store.close()
@@ -282,10 +801,16 @@ def _transfer(method, items, size, fitTrackedData, successes, quiet):
         print '\n'.join(failures)
         print 'Above items could not be transferred.'
 
+    # With fit.cache.maxSize set, the cache is kept to that instead. A cache
+    # shared with other repositories is not pruned to the size of this one.
+    if cache.getSizeLimits() or context.isCacheShared:
+        cache.evict()
+        return
+
     fitSize = getFitSize(fitTrackedData)
     cacheSize = cache.size()[0]
     if cacheSize > fitSize * 2:
-        print 'Cache size (%.2fMB) is larger than twice the tracked size (%.2fMB). Pruning...'%(cacheSize/1048576., fitSize/1048576.)
+        print 'Cache size (%.2fMB on disk) is larger than twice the tracked size (%.2fMB). Pruning...'%(cacheSize/1048576., fitSize/1048576.)
         cache.prune(fitSize * 2)
     else:
-        print 'Cache size is %.2fMB and tracked size is %.2fMB (will not prune at this time).'%(cacheSize/1048576., fitSize/1048576.)
+        print 'Cache size is %.2fMB on disk and tracked size is %.2fMB (will not prune at this time).'%(cacheSize/1048576., fitSize/1048576.)
@@ -1,4 +1,5 @@
-from subprocess import Popen as popen, PIPE
+from config import gitConfig
+from os.path import splitext
 from platform import system
 
 # Below two lines prevents Python raising an exception
@@ -42,8 +43,14 @@ if system() != "Windows":
 #   Now, git-fit will not perform download of any .a or .dylib files from remote storage to that machine. The user will still be able to upload any types of files, including .a and .dylib.
 #   Similarly, skipping of .dll, .lib, .pdb, etc. can be configured on a Mac/Linux machine to save a lot of bandwidth, and storage space.
 
-# extensions in this list are compared case-insensitively, i.e., .DLL = .dll
-downstreamSkipExtensionsCaseInsensitive = popen('git config fit.downstream.skipExtensions'.split(), stdout=PIPE).communicate()[0].split()
+# extensions in the fit.downstream.skipExtensions list are compared case-insensitively, i.e., .DLL = .dll
+def getSkipExtensionsCaseInsensitive():
+    return gitConfig('fit.downstream.skipExtensions').split()
 
-# extensions in this list are compared case-sensitively, i.e., .DLL != .dll
-downstreamSkipExtensionsCaseSensitive = popen('git config fit.downstream.skipExtensionsCaseSensitive'.split(), stdout=PIPE).communicate()[0].split()
+# extensions in the fit.downstream.skipExtensionsCaseSensitive list are compared case-sensitively, i.e., .DLL != .dll
+def getSkipExtensionsCaseSensitive():
+    return gitConfig('fit.downstream.skipExtensionsCaseSensitive').split()
+
+def isSkippedExtension(filePath):
+    ext = splitext(filePath)[-1]
+    return ext in getSkipExtensionsCaseSensitive() or ext.lower() in map(str.lower, getSkipExtensionsCaseInsensitive())
@@ -0,0 +1,134 @@
+from json import load
+from locking import newTempFile, publish, discard
+from os import path
+import sqlite3
+
+# The stat database is an sqlite file holding one row per fit item of the form:
+#   path --> (checksum_hash, st_size, st_mtime, st_ctime, st_ino)
+# Rows are looked up and written by path, so checking a handful of items never
+# has to load or rewrite the stats of every other item in the working tree.
+#
+# It also holds the set of fit-tracked paths last found in the working tree,
+# and a few key/value pairs of metadata (e.g. the watcher token that stats
+# and tracked paths are known to be current as of).
+
+_sqliteMagic = 'SQLite format 3\x00'
+
+# Status runs and hooks at the same time update stats concurrently, sqlite
+# serializes their writes, for which one may have to wait for the others
+_busyTimeout = 60
+
+# Stay well under SQLITE_MAX_VARIABLE_NUMBER (999 in older sqlite builds)
+_maxQueryParams = 500
+
+def _chunks(items, n=_maxQueryParams):
+    items = list(items)
+    for i in xrange(0, len(items), n):
+        yield items[i:i+n]
+
+def _isSqliteFile(filePath):
+    f = open(filePath, 'rb')
+    header = f.read(len(_sqliteMagic))
+    f.close()
+    return header == _sqliteMagic
+
+def _connect(filePath):
+    conn = sqlite3.connect(filePath, timeout=_busyTimeout)
+    conn.text_factory = str
+    conn.execute('CREATE TABLE IF NOT EXISTS stat (path TEXT PRIMARY KEY, hash, size INTEGER, mtime REAL, ctime REAL, ino INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS tracked (path TEXT PRIMARY KEY)')
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+    return conn
+
+# Older versions of fit kept the stats as a single JSON document at the same
+# location. It is converted into a database next to it, which then atomically
+# replaces the JSON file.
+def _migrateJsonStatFile(filePath):
+    statIn = open(filePath)
+    try:
+        stats = load(statIn)
+    except ValueError:
+        # A corrupt stat file only means items will have to be rehashed
+        stats = {}
+    statIn.close()
+
+    tempPath = newTempFile(filePath)
+    try:
+        conn = _connect(tempPath)
+        conn.executemany('INSERT OR REPLACE INTO stat VALUES (?,?,?,?,?,?)',
+            ((p, h, s[0], s[1], s[2], s[3]) for p,(h,s) in stats.iteritems()))
+        conn.commit()
+        conn.close()
+        publish(tempPath, filePath)
+    except:
+        discard(tempPath)
+        raise
+
+class StatStore:
+    def __init__(self, filePath):
+        if path.exists(filePath) and path.getsize(filePath) > 0 and not _isSqliteFile(filePath):
+            _migrateJsonStatFile(filePath)
+        self.conn = _connect(filePath)
+
+    # Returns {path: (hash, (st_size, st_mtime, st_ctime, st_ino))} for those
+    # of the given paths that have stored stats
+    def get(self, paths):
+        stats = {}
+        for chunk in _chunks(paths):
+            query = 'SELECT * FROM stat WHERE path IN (%s)'%','.join('?'*len(chunk))
+            for p,h,s,m,c,i in self.conn.execute(query, chunk):
+                stats[p] = (h, (s, m, c, i))
+        return stats
+
+    # Returns the paths with stored stats, optionally only those below a directory
+    def getPaths(self, under=None):
+        if under == None:
+            return {p for (p,) in self.conn.execute('SELECT path FROM stat')}
+        # Paths below "dir" sort between "dir/" and "dir0" ('0' follows '/')
+        query = 'SELECT path FROM stat WHERE path >= ? AND path < ?'
+        return {p for (p,) in self.conn.execute(query, (under + '/', under + '0'))}
+
+    def items(self):
+        return {p:(h, (s, m, c, i)) for p,h,s,m,c,i in self.conn.execute('SELECT * FROM stat')}
+
+    # Takes an iterable of (path, (hash, (st_size, st_mtime, st_ctime, st_ino)))
+    def update(self, items):
+        self.conn.executemany('INSERT OR REPLACE INTO stat VALUES (?,?,?,?,?,?)',
+            ((p, h, s[0], s[1], s[2], s[3]) for p,(h,s) in items))
+
+    def delete(self, paths):
+        for chunk in _chunks(paths):
+            self.conn.execute('DELETE FROM stat WHERE path IN (%s)'%','.join('?'*len(chunk)), chunk)
+
+    # Deletes the stats of all paths but the given ones
+    def prune(self, keep):
+        self.delete(self.getPaths() - set(keep))
+
+    def clear(self):
+        self.conn.execute('DELETE FROM stat')
+
+    def getTracked(self):
+        return {p for (p,) in self.conn.execute('SELECT path FROM tracked')}
+
+    def setTracked(self, paths):
+        self.conn.execute('DELETE FROM tracked')
+        self.updateTracked(paths, [])
+
+    def updateTracked(self, added, removed):
+        self.conn.executemany('INSERT OR IGNORE INTO tracked VALUES (?)', ((p,) for p in added))
+        for chunk in _chunks(removed):
+            self.conn.execute('DELETE FROM tracked WHERE path IN (%s)'%','.join('?'*len(chunk)), chunk)
+
+    def getMeta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def setMeta(self, key, value):
+        if value == None:
+            self.conn.execute('DELETE FROM meta WHERE key = ?', (key,))
+        else:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', (key, value))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
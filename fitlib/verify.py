@@ -0,0 +1,285 @@
+from . import context, getStatJobs, getHashJobs, readFitFile, gitHashData
+import cache
+from compression import iterDecompressed
+from hashing import gitBlobHash
+from hashlib import sha1
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from os import listdir, remove
+from os.path import exists, isdir, join as joinpath
+from sys import stdout
+import zlib
+
+# Checks the cache index against the objects directory, for when they have
+# come apart (e.g. after a crash in the middle of a cache insert), which shows
+# as cache hits for objects that aren't there or aren't what they should be:
+#
+#   missing  objects (and chunks) in the index without a file
+#   corrupt  objects whose contents don't hash to their key, or that refer
+#            to missing or corrupt chunks, and corrupt chunks
+#   orphan   files in the objects directory that are not in the index, and
+#            that are older than cache._orphanGracePeriod (newer ones may
+#            be objects still being inserted)
+#
+# The fan-out directories are listed with fit.stat.jobs threads, and objects
+# rehashed with fit.hash.jobs processes. Compressed objects are hashed as
+# they are decompressed. Chunks are hashed on their own, and a chunked
+# object is checked by its recipe, which must list known chunks adding up to
+# the object's size, rather than by reassembling it.
+#
+# Objects of files that git converts or filters (see getConvertedPaths) are
+# keyed by the id of their converted contents, so an object that doesn't hash
+# to its key is hashed again by git, as the paths it is known under (in the
+# .fit file and the saved and committed ones not put yet) would have it, or,
+# if it isn't known under any, with its line endings normalized (as the text
+# and eol attributes and core.autocrlf have it). Only if that doesn't match
+# either is it corrupt.
+#
+# Every result is written to a checkpoint file as it comes in, so a verify
+# of a large cache can be interrupted and picks up where it left off when run
+# again. The checkpoint is removed once a verify has run to the end.
+#
+# With repair, broken objects are dropped from the index (those in the lru
+# part are gotten again the next time they are needed, but the contents of
+# ones that were never put are lost), orphaned files are removed, and the
+# chunk references and cache totals recounted. The directory is listed
+# before the index is read, so objects cached while it is listed don't look
+# orphaned, and the orphans are looked up in the index again, in the same
+# transaction that removes them, so ones cached since aren't removed either.
+# The cache may be shared by other repositories, whose fit commands can run
+# while a repair is.
+
+_resultsChunkSize = 16
+
+def _checkpointFile():
+    return joinpath(context.cacheDir, 'verify-checkpoint')
+
+# Returns {name: ok} from the checkpoint of an interrupted verify, names being
+# those of object or chunk files relative to the objects directory
+def _readCheckpoint():
+    results = {}
+    if exists(_checkpointFile()):
+        for line in open(_checkpointFile()):
+            parts = line.split()
+            # The last line may not have been written completely
+            if len(parts) == 2 and parts[1] in ('0', '1'):
+                results[parts[0]] = parts[1] == '1'
+    return results
+
+def _listDir(dirPath):
+    return dirPath, listdir(dirPath)
+
+# Returns the names of all files in the objects directory (listing the
+# fan-out directories of objects and of chunks), relative to it
+def _listObjectFiles(objectsDir):
+    names = set()
+    dirs = []
+    for parent in ['', 'chunks/']:
+        if isdir(joinpath(objectsDir, parent)):
+            for n in listdir(joinpath(objectsDir, parent)):
+                if not isdir(joinpath(objectsDir, parent + n)):
+                    names.add(parent + n)
+                elif parent + n != 'chunks':
+                    dirs.append(parent + n)
+    pool = ThreadPool(max(getStatJobs(), 1))
+    try:
+        for d,dirNames in pool.imap_unordered(_listDir, (joinpath(objectsDir, d) for d in dirs)):
+            names.update('%s/%s'%(d[len(objectsDir)+1:], n) for n in dirNames)
+        return names
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _objectName(k, codec):
+    return '%s/%s.%s'%(k[:2], k[2:], codec) if codec else '%s/%s'%(k[:2], k[2:])
+
+def _chunkName(c):
+    return 'chunks/%s/%s'%(c[:2], c[2:])
+
+# Returns (name, ok) for an object or chunk (with a codec of 'chunk')
+def _checkItem(item):
+    name, filePath, k, size, codec = item
+    try:
+        if codec == 'chunk':
+            data = open(filePath, 'rb').read()
+            return name, len(data) == size and sha1(data).hexdigest() == k
+        if codec == None:
+            return name, gitBlobHash(filePath) == k
+        h = sha1('blob %d\0'%size)
+        n = 0
+        for data in iterDecompressed(codec, filePath):
+            h.update(data)
+            n += len(data)
+        return name, n == size and h.hexdigest() == k
+    except (IOError, OSError, zlib.error):
+        return name, False
+
+# Yields the contents of an object
+def _readObject(filePath, codec):
+    if codec:
+        for d in iterDecompressed(codec, filePath):
+            yield d
+        return
+    fileIn = open(filePath, 'rb')
+    try:
+        for d in iter(lambda: fileIn.read(1 << 20), ''):
+            yield d
+    finally:
+        fileIn.close()
+
+# Yields data with CRLFs turned into LFs
+def _iterNormalized(data):
+    pending = ''
+    for d in data:
+        d = pending + d
+        pending = '\r' if d.endswith('\r') else ''
+        yield (d[:-1] if pending else d).replace('\r\n', '\n')
+    yield pending
+
+# Returns {hash: set of paths} of the objects in the .fit file and in the
+# saved and committed ones
+def _knownPaths():
+    fitFiles = [context.fitFile]
+    for d in [context.savesDir, context.commitsDir]:
+        if isdir(d):
+            fitFiles += [joinpath(d, f) for f in listdir(d)]
+    paths = {}
+    for f in fitFiles:
+        for p,(h,s) in readFitFile(f).iteritems():
+            paths.setdefault(h, set()).add(p)
+    return paths
+
+# Whether an object that doesn't hash to its key is what git gives that key
+# to after converting or filtering it (see above)
+def _isConverted(item, paths):
+    name, filePath, k, size, codec = item
+    try:
+        if paths:
+            return any(gitHashData(_readObject(filePath, codec), p) == k for p in paths)
+        normalizedSize = sum(len(d) for d in _iterNormalized(_readObject(filePath, codec)))
+        if normalizedSize == size:
+            return False
+        h = sha1('blob %d\0'%normalizedSize)
+        for d in _iterNormalized(_readObject(filePath, codec)):
+            h.update(d)
+        return h.hexdigest() == k
+    except (IOError, OSError, zlib.error):
+        return False
+
+def _iterResults(items, jobs):
+    if jobs <= 1 or len(items) < 2:
+        for i in items:
+            yield _checkItem(i)
+        return
+
+    pool = Pool(min(jobs, len(items)))
+    try:
+        for r in pool.imap_unordered(_checkItem, items, _resultsChunkSize):
+            yield r
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Returns {name: ok} for the given items, resuming from and adding to the
+# checkpoint
+def _checkItems(items, quiet):
+    results = _readCheckpoint()
+    todo = [i for i in items if i[0] not in results]
+    # The largest ones first, so that none is left to a single worker at the end
+    todo.sort(key=lambda i: i[3], reverse=True)
+    numItems = len(items)
+    if results and not quiet:
+        print 'Resuming an earlier verify (%d of %d cached objects and chunks checked already).'%(numItems - len(todo), numItems)
+
+    progress_fmt = '\rVerifying cached objects...%6.2f%%  %s/%s'
+    checkpoint = open(_checkpointFile(), 'a')
+    try:
+        for n,(name,ok) in enumerate(_iterResults(todo, getHashJobs()), numItems - len(todo) + 1):
+            results[name] = ok
+            checkpoint.write('%s %d\n'%(name, ok))
+            if not quiet:
+                print progress_fmt%(n*100./numItems, n, numItems),
+                stdout.flush()
+    finally:
+        checkpoint.close()
+    if todo and not quiet:
+        print
+    return results
+
+# Verifies the cache, returns {'missing': [names], 'corrupt': [names],
+# 'orphan': [names]} of the problems found (after repairing them if repair is
+# set), names being those of object and chunk files relative to the objects
+# directory
+def verifyCache(repair=False, quiet=False):
+    objectsDir = context.objectsDir
+    files = _listObjectFiles(objectsDir)
+    objects, chunks = cache.listIndex()
+
+    problems = {'missing': [], 'corrupt': [], 'orphan': []}
+    items = []
+    for c,(s,r,u) in chunks.iteritems():
+        name = _chunkName(c)
+        if name in files:
+            items.append((name, joinpath(objectsDir, name), c, s, 'chunk'))
+        else:
+            problems['missing'].append(name)
+    recipes = {}
+    for k,(s,c,m,d,x) in objects.iteritems():
+        name = _objectName(k, x)
+        if name not in files:
+            problems['missing'].append(name)
+        elif x == 'chunks':
+            try:
+                recipes[name] = k, cache.readRecipe(joinpath(objectsDir, name))
+            except (IOError, ValueError):
+                problems['corrupt'].append(name)
+                continue
+            if sum(cs for cn,cs in recipes[name][1]) != s:
+                problems['corrupt'].append(name)
+                del recipes[name]
+        else:
+            items.append((name, joinpath(objectsDir, name), k, s, x))
+    known = {i[0] for i in items} | set(recipes) | set(problems['missing']) | set(problems['corrupt'])
+    problems['orphan'] = sorted(n for n in files - known if not cache.isRecent(joinpath(objectsDir, n)))
+
+    results = _checkItems(items, quiet)
+    mismatched = [i for i in items if not results[i[0]]]
+    if mismatched:
+        paths = _knownPaths()
+        problems['corrupt'] += [i[0] for i in mismatched if i[4] == 'chunk' or not _isConverted(i, paths.get(i[2]))]
+    badChunks = {n for n in problems['missing'] + problems['corrupt'] if n.startswith('chunks/')}
+
+    refs = {}
+    for name,(k,recipe) in recipes.iteritems():
+        for c,s in recipe:
+            refs[c] = refs.get(c, 0) + 1
+        if any(_chunkName(c) in badChunks or c not in chunks for c,s in recipe):
+            problems['corrupt'].append(name)
+    miscounted = [c for c,(s,r,u) in chunks.iteritems() if refs.get(c, 0) != r]
+
+    for p in ('missing', 'corrupt'):
+        problems[p].sort()
+    if not quiet:
+        for p in ('missing', 'corrupt', 'orphan'):
+            for name in problems[p]:
+                print '%-8s %s'%(p, name)
+        if miscounted:
+            print '%d chunks have the wrong number of references.'%len(miscounted)
+
+    found = any(problems.values()) or miscounted
+    if repair and found:
+        broken = set(problems['missing'] + problems['corrupt'])
+        brokenObjects = [(k, x) for k,(s,c,m,d,x) in objects.iteritems() if _objectName(k, x) in broken]
+        brokenChunks = [n[len('chunks/'):].replace('/', '') for n in badChunks]
+        removed = cache.repair(brokenObjects, brokenChunks, [joinpath(objectsDir, n) for n in problems['orphan']])
+        if not quiet:
+            print 'Repaired the cache: dropped %d missing and %d corrupt objects or chunks from the index, removed %d orphaned files.'%(
+                len(problems['missing']), len(problems['corrupt']), len(removed))
+    elif not quiet:
+        if found:
+            print 'The cache has problems, git-fit cache verify --repair fixes them.'
+        else:
+            print 'The cache is OK (%d objects and %d chunks checked).'%(len(objects), len(chunks))
+
+    remove(_checkpointFile())
+    return problems
@@ -0,0 +1,392 @@
+from ctypes import CDLL, c_char_p, c_int, c_uint32, get_errno
+from ctypes.util import find_library
+from errno import EINTR, EAGAIN
+from os import path, walk, getpid, remove
+from select import select
+from signal import SIGTERM
+from struct import unpack_from, calcsize
+from time import time, sleep
+import os, socket
+
+# An optional background process that keeps track of which paths in the
+# working tree have changed, so that status runs don't have to stat (or
+# even list) every fit item to find out.
+#
+# The daemon watches every directory of the working tree (except .git) with
+# inotify and stamps each changed path with a logical clock. Clients ask
+# over a unix socket for the paths changed since a token they got from an
+# earlier query. The reply is a new token plus either the changed paths, or
+# a reset if the token is not from this daemon instance (the daemon was
+# restarted, or lost events to a queue overflow) and a full scan is needed.
+# The daemon remembers the latest change of each path, and only the latest
+# _maxChanges or so of those: once there are more, the oldest are forgotten,
+# and tokens from before them get a reset too.
+#
+# Request:    "since <token>\n"
+# Reply:      "<new token>\n" then either "reset\n", or "changes\n" followed
+#             by NUL-terminated entries, each a type character and a path:
+#               f  a file, relative to the root of the working tree
+#               d  a directory relative to the root of the working tree that
+#                  was created, removed or moved, with all of its contents
+#               g  "index" or "info/attributes" in the git directory, which
+#                  decide what git ls-files -o and git check-attr report
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+_watchMask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_eventHeader = 'iIII'
+_eventHeaderSize = calcsize(_eventHeader)
+
+_queryTimeout = 2.0
+_maxChanges = 1 << 18
+
+# unix socket paths are limited to about a hundred bytes, so long ones are
+# given relative to the current directory instead
+def _socketAddress(sockPath):
+    if len(sockPath) < 100:
+        return sockPath
+    return path.relpath(sockPath)
+
+class _Inotify:
+    def __init__(self):
+        self.libc = CDLL(find_library('c'), use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [c_int, c_char_p, c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), 'inotify_init1 failed')
+
+    def addWatch(self, dirPath):
+        wd = self.libc.inotify_add_watch(self.fd, dirPath, _watchMask)
+        if wd < 0:
+            raise OSError(get_errno(), 'inotify_add_watch failed for %s'%dirPath)
+        return wd
+
+    def removeWatch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    # Yields (wd, mask, name) for every event that is already queued
+    def readEvents(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except OSError as e:
+                if e.errno in (EAGAIN, EINTR):
+                    return
+                raise
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, length = unpack_from(_eventHeader, buf, offset)
+                offset += _eventHeaderSize
+                name = buf[offset:offset+length].rstrip('\0')
+                offset += length
+                yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+_gitDirNames = {'': {'index'}, 'info': {'attributes'}}
+
+class _Watcher:
+    def __init__(self, rootDir, gitDir):
+        if not path.isdir(rootDir):
+            raise OSError('%s is not a directory'%rootDir)
+        self.rootDir = rootDir
+        self.instance = '%d.%d'%(getpid(), int(time()*1000))
+        self.clock = 0
+        # The clock of the latest change of each path, and the paths by it,
+        # and the latest clock of the changes that have been forgotten
+        self.changed = {}
+        self.changedByClock = {}
+        self.forgotten = 0
+        self.dirsByWd = {}
+        self.wdsByDir = {}
+        self.inotify = _Inotify()
+        self._watchTree('')
+
+        # Only a couple of files are of interest in the git directory, so it
+        # is not watched recursively
+        self.gitDirsByWd = {}
+        for d in _gitDirNames:
+            if path.isdir(path.join(gitDir, d)):
+                self.gitDirsByWd[self.inotify.addWatch(path.join(gitDir, d))] = d
+
+    def token(self):
+        return '%s:%d'%(self.instance, self.clock)
+
+    def _stamp(self, change):
+        clock = self.changed.get(change)
+        if clock != None:
+            self.changedByClock[clock].discard(change)
+        self.changed[change] = self.clock
+        self.changedByClock.setdefault(self.clock, set()).add(change)
+
+    # Forgets the oldest changes once there are too many, down to half as many
+    def _forget(self):
+        if len(self.changed) <= _maxChanges:
+            return
+        for clock in sorted(self.changedByClock):
+            if len(self.changed) <= _maxChanges/2:
+                break
+            for change in self.changedByClock.pop(clock):
+                del self.changed[change]
+            self.forgotten = clock
+
+    def _watchTree(self, relDir):
+        for dirPath, dirNames, fileNames in walk(path.join(self.rootDir, relDir)):
+            rel = path.relpath(dirPath, self.rootDir)
+            rel = '' if rel == '.' else rel
+            if rel == '':
+                dirNames[:] = [d for d in dirNames if d != '.git']
+            try:
+                wd = self.inotify.addWatch(dirPath)
+            except OSError:
+                if not path.isdir(dirPath):
+                    # Removed before it could be watched
+                    continue
+                raise
+            self.dirsByWd[wd] = rel
+            self.wdsByDir[rel] = wd
+            if relDir:
+                # Anything inside a newly appeared directory is new as well
+                for f in fileNames:
+                    self._stamp(('f', path.join(rel, f)))
+
+    def _unwatchTree(self, relDir):
+        prefix = relDir + '/'
+        for d in [d for d in self.wdsByDir if d == relDir or d.startswith(prefix)]:
+            wd = self.wdsByDir.pop(d)
+            self.dirsByWd.pop(wd, None)
+            self.inotify.removeWatch(wd)
+
+    # Consumes all queued events, returns False if any events were lost
+    def drain(self):
+        events = list(self.inotify.readEvents())
+        if not events:
+            return True
+        self.clock += 1
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                return False
+            if wd in self.gitDirsByWd:
+                gitDir = self.gitDirsByWd[wd]
+                if name in _gitDirNames[gitDir]:
+                    self._stamp(('g', path.join(gitDir, name)))
+                continue
+            if mask & IN_IGNORED:
+                d = self.dirsByWd.pop(wd, None)
+                if d == '':
+                    # The working tree itself is gone
+                    return False
+                if d != None and self.wdsByDir.get(d) == wd:
+                    del self.wdsByDir[d]
+                continue
+            relDir = self.dirsByWd.get(wd)
+            if relDir == None or not name:
+                continue
+            rel = path.join(relDir, name)
+            if mask & IN_ISDIR:
+                self._stamp(('d', rel))
+                if mask & (IN_MOVED_FROM | IN_DELETE):
+                    self._unwatchTree(rel)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self._watchTree(rel)
+                    except OSError:
+                        # Most likely out of watches, so changes would be missed
+                        return False
+            else:
+                self._stamp(('f', rel))
+        self._forget()
+        return True
+
+    # Returns [(type, path)] changed since the given token, or None if the
+    # token did not come from this instance or is older than what it remembers
+    def changesSince(self, token):
+        instance, sep, clock = token.rpartition(':')
+        if instance != self.instance or not clock.isdigit() or int(clock) < self.forgotten:
+            return None
+        return [c for n in xrange(int(clock) + 1, self.clock + 1) for c in self.changedByClock.get(n, ())]
+
+    def close(self):
+        self.inotify.close()
+
+def _recvLine(conn):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.strip()
+
+def _serve(watcher, rootDir, gitDir, sockPath, pidFile):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if path.exists(sockPath):
+        remove(sockPath)
+    server.bind(_socketAddress(sockPath))
+    server.listen(16)
+    f = open(pidFile, 'w')
+    f.write(str(getpid()))
+    f.close()
+
+    try:
+        while True:
+            readable = select([watcher.inotify.fd, server], [], [])[0]
+            if watcher.inotify.fd in readable and not watcher.drain():
+                # Events were lost, so start over as a new instance
+                watcher.close()
+                watcher = _Watcher(rootDir, gitDir)
+            if server in readable:
+                conn = server.accept()[0]
+                try:
+                    conn.settimeout(_queryTimeout)
+                    request = _recvLine(conn)
+                    if request == 'stop':
+                        conn.sendall('stopped\n')
+                        return
+                    # Anything that happened before the request was made is
+                    # already queued, so take it into account before replying
+                    if not watcher.drain():
+                        watcher.close()
+                        watcher = _Watcher(rootDir, gitDir)
+                    changes = watcher.changesSince(request[len('since '):]) if request.startswith('since ') else None
+                    reply = [watcher.token(), '\n']
+                    if changes == None:
+                        reply.append('reset\n')
+                    else:
+                        reply.append('changes\n')
+                        reply.extend('%s%s\0'%c for c in changes)
+                    conn.sendall(''.join(reply))
+                except socket.error:
+                    pass
+                finally:
+                    conn.close()
+    finally:
+        server.close()
+        watcher.close()
+        for p in (sockPath, pidFile):
+            if path.exists(p):
+                remove(p)
+
+# Starts the daemon detached from the calling process. The working tree is
+# set up to be watched before that, so that failing to (e.g. for lack of
+# inotify watches) is reported to the caller.
+def start(rootDir, gitDir, sockPath, pidFile):
+    if isRunning(sockPath):
+        return False
+    watcher = _Watcher(rootDir, gitDir)
+    pid = os.fork()
+    if pid != 0:
+        watcher.close()
+        os.waitpid(pid, 0)
+        # Give the daemon a moment to start listening, so that it is used
+        # by whatever runs next
+        for i in xrange(100):
+            if isRunning(sockPath):
+                break
+            sleep(0.02)
+        return True
+
+    # First child: become a session leader, then fork again so that the
+    # daemon can never reacquire a controlling terminal
+    os.setsid()
+    if os.fork() != 0:
+        os._exit(0)
+    os.chdir(rootDir)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        _serve(watcher, rootDir, gitDir, sockPath, pidFile)
+    finally:
+        os._exit(0)
+
+def _request(sockPath, request):
+    if not path.exists(sockPath):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(_queryTimeout)
+    try:
+        conn.connect(_socketAddress(sockPath))
+        conn.sendall(request + '\n')
+        chunks = []
+        while True:
+            chunk = conn.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+    except socket.error:
+        return None
+    finally:
+        conn.close()
+
+def stop(sockPath, pidFile):
+    if _request(sockPath, 'stop') != None:
+        return True
+    # Not answering, so make sure it is gone for good
+    if path.exists(pidFile):
+        try:
+            os.kill(int(open(pidFile).read()), SIGTERM)
+        except (OSError, ValueError):
+            pass
+        remove(pidFile)
+        if path.exists(sockPath):
+            remove(sockPath)
+        return True
+    return False
+
+def isRunning(sockPath):
+    return _request(sockPath, 'since -') != None
+
+class WatcherChanges:
+    def __init__(self, token, changes):
+        self.token = token
+        self.reset = changes == None
+        self.files = set()
+        self.dirs = set()
+        self.gitFiles = set()
+        for c in changes or []:
+            {'f': self.files, 'd': self.dirs, 'g': self.gitFiles}[c[0]].add(c[1:])
+
+    # Whether the given working tree path or any of its parent directories
+    # has changed
+    def isChanged(self, p):
+        if p in self.files:
+            return True
+        p = path.dirname(p)
+        while p and self.dirs:
+            if p in self.dirs:
+                return True
+            p = path.dirname(p)
+        return False
+
+# Asks a running daemon for the changes since the given token. Returns None
+# if no daemon is running, otherwise a WatcherChanges with the new token and
+# the changes since the given one (reset is set if they can't be known).
+def query(sockPath, token):
+    reply = _request(sockPath, 'since %s'%(token or '-'))
+    if not reply:
+        return None
+    lines = reply.split('\n', 2)
+    if len(lines) < 3 or lines[1] not in ('reset', 'changes'):
+        return None
+    if lines[1] == 'reset':
+        return WatcherChanges(lines[0], None)
+    return WatcherChanges(lines[0], [c for c in lines[2].split('\0') if c])
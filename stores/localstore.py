@@ -1,18 +1,33 @@
-from os.path import exists, join as joinpath, dirname
-from shutil import copy, rmtree
+from os import makedirs
+from os.path import exists, isdir, join as joinpath, dirname
+from shutil import copy, copyfileobj, rmtree
 from tempfile import mkdtemp
 from subprocess import Popen as popen
-from fitlib import fitDir, DataStore
+from fitlib import context, DataStore
 
 class Store(DataStore):
+    resumable = True
 
     def __init__(self, *args, **kwds):
-        self.dir = joinpath(fitDir, 'store')
+        self.dir = joinpath(context.fitDir, 'store')
 
-    def get(self, key, dst, size):
-        if exists(key):
+    def get(self, key, dst, size, offset=0):
+        if not exists(key):
+            return
+        if not offset:
             copy(key, dst)
             return True
+        # Appends the rest of the object to what's there of it
+        src, out = open(key, 'rb'), open(dst, 'r+b')
+        try:
+            src.seek(offset)
+            out.seek(offset)
+            out.truncate()
+            copyfileobj(src, out, 1 << 20)
+        finally:
+            src.close()
+            out.close()
+        return True
 
     def put(self, src, dst, size):
         if exists(src):
@@ -24,3 +39,27 @@ class Store(DataStore):
     def check(self, key):
         path = joinpath(self.dir, key)
         return path if exists(path) else None
+
+    # The batch versions (see DataStore), which for a local directory come
+    # down to not starting processes for every object
+
+    def checkMany(self, keys):
+        return {k:p for k,p in ((k, joinpath(self.dir, k)) for k in keys) if exists(p)}
+
+    def getMany(self, items):
+        return {dst for key,dst,size in items if self.get(key, dst, size)}
+
+    def putMany(self, items):
+        put = set()
+        for src,dst,size in items:
+            if exists(src):
+                dstPath = joinpath(self.dir, dst)
+                try:
+                    makedirs(dirname(dstPath))
+                except OSError:
+                    # There already, or made by another batch meanwhile
+                    if not isdir(dirname(dstPath)):
+                        raise
+                copy(src, dstPath)
+                put.add(dst)
+        return put
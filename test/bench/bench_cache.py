@@ -0,0 +1,76 @@
+# Benchmarks the cache index with many cached objects, comparing cache.find
+# and cache.enque against the JSON lru file the index used to be (loaded and,
+# if anything changed, rewritten as a whole on every call). Run from inside a
+# git working tree (fitlib needs one to import):
+#
+#   python -m test.bench.bench_cache [NUM_OBJECTS [NUM_LOOKUPS]]
+
+import fitlib
+from fitlib import cache
+from hashlib import sha1
+from json import load, dump
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from time import time
+
+# The JSON index fit used before, as it was read and written by _cacheIO
+def legacyFind(lruFile, keys):
+    data = load(open(lruFile))
+    li = data['lru']['items']
+    lc = data['lru']['count']
+    found = {}
+    for k in keys:
+        if k in li:
+            lc += 1
+            li[k] = (li[k][0], lc)
+            found[k] = k
+    data['lru']['count'] = lc
+    f = open(lruFile, 'w')
+    dump(data, f)
+    f.close()
+    return found
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+def main():
+    numObjects = int(argv[1]) if len(argv) > 1 else 200000
+    numLookups = int(argv[2]) if len(argv) > 2 else 1000
+    keys = [sha1(str(i)).hexdigest() for i in xrange(numObjects)]
+    lruItems = {k:(1000, i+1) for i,k in enumerate(keys)}
+
+    tempDir = mkdtemp()
+    savedDirs = fitlib.context._dirs
+    fitlib.context._dirs = (tempDir, join(tempDir, '.git'))
+    try:
+        makedirs(fitlib.context.cacheDir)
+        legacyFile = join(tempDir, 'legacy-lru')
+        f = open(legacyFile, 'w')
+        dump({'lru':{'size':1000*numObjects,'count':numObjects,'items':lruItems},'map':{'size':0,'items':{}}}, f)
+        f.close()
+
+        # Let the index migrate from a copy of the same JSON document
+        f = open(fitlib.context.lruFile, 'w')
+        dump({'lru':{'size':1000*numObjects,'count':numObjects,'items':lruItems},'map':{'size':0,'items':{}}}, f)
+        f.close()
+        migrateTime, _ = timed(cache.size)
+        print 'migrating %d objects: %.3fs'%(numObjects, migrateTime)
+
+        print '%10s %12s %12s %8s'%('lookups', 'legacy (s)', 'sqlite (s)', 'speedup')
+        for n in [1, numLookups, numObjects]:
+            lookup = keys[::max(numObjects/n, 1)][:n]
+            legacyTime, legacyFound = timed(legacyFind, legacyFile, lookup)
+            indexTime, indexFound = timed(cache.find, lookup)
+            assert set(legacyFound) == set(indexFound)
+            print '%10d %12.3f %12.3f %7.1fx'%(n, legacyTime, indexTime, legacyTime/indexTime)
+    finally:
+        fitlib.context._dirs = savedDirs
+        rmtree(tempDir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Benchmarks reading and writing of synthetic .fit manifests of various sizes. Run from
+# inside a git working tree (fitlib needs one to import):
+#
+#   python -m test.bench.bench_fitfile [NUM_ITEMS...]
+
+from fitlib import readFitFile, writeFitFile
+from fitlib.paths import fitMapToTree, fitTreeToMap
+from hashlib import sha1
+from os import close as osclose, remove
+from os.path import getsize
+from sys import argv
+from tempfile import mkstemp
+from time import time
+import re
+
+_legacyItemRgx = re.compile('([^:]+):\[([^,]+),(\d+)\],?')
+
+# The recursive parser that readFitFile used before the streaming one, kept
+# here only as a point of comparison
+def _legacyReadRec(fitFileIn):
+    items = {}
+    for l in fitFileIn:
+        l = l.strip()
+        if l.endswith('{'):
+            items[l.split(':')[0]] = _legacyReadRec(fitFileIn)
+        elif l in ('}', '},') :
+            break
+        else:
+            parts = list(_legacyItemRgx.match(l).groups())
+            items[parts[0]] = [parts[1], int(parts[2])]
+    return items
+
+def legacyReadFitFile(filePath):
+    fitFileIn = open(filePath)
+    fitData = fitTreeToMap(_legacyReadRec(fitFileIn))
+    fitFileIn.close()
+    return fitData
+
+# The recursive writer that writeFitFile used before the streaming one
+def _legacyDictItemComparator(a,b):
+    if type(a[1]) == type(b[1]):
+        return -1 if a[0] < b[0] else (1 if a[0] > b[0] else 0)
+    if type(a[1]) == type({}):
+        return 1
+    return -1
+
+def _legacyWriteRec(fitFileOut, fitData):
+    if len(fitData) == 0:
+        return
+
+    items = sorted(fitData.iteritems(), cmp=_legacyDictItemComparator)
+    for k,v in items[:-1]:
+        _legacyWriteItem(fitFileOut, k, v)
+    k,v = items[-1]
+    _legacyWriteItem(fitFileOut, k, v, sep='')
+
+def _legacyWriteItem(fitFileOut, k,v, sep=','):
+    if type(v) == type({}):
+        print >>fitFileOut, '%s:{'%k
+        _legacyWriteRec(fitFileOut, v)
+        print >>fitFileOut, '}'+sep
+    else:
+        print >>fitFileOut, ('%s:[%s,%s]'+sep)%(k,v[0],v[1])
+
+def legacyWriteFitFile(fitData, filePath):
+    fitFileOut = open(filePath, 'wb')
+    _legacyWriteRec(fitFileOut, fitMapToTree(fitData))
+    fitFileOut.close()
+
+def readBytes(filePath):
+    f = open(filePath, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+# Spreads items over a few levels of directories, 20 items per leaf directory
+def syntheticFitData(numItems):
+    fitData = {}
+    for i in xrange(numItems):
+        p = 'assets/d%d/e%d/f%d/item%d.bin'%(i%7, i%53, i/20, i)
+        fitData[p] = [sha1(p).hexdigest(), i]
+    return fitData
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+def main():
+    sizes = [int(a) for a in argv[1:]] or [10000, 100000, 1000000]
+    handle, fitFile = mkstemp()
+    osclose(handle)
+    handle, legacyFitFile = mkstemp()
+    osclose(handle)
+    try:
+        print '%10s %8s %6s %12s %12s %8s'%('items', 'MB', 'op', 'legacy (s)', 'stream (s)', 'speedup')
+        for n in sizes:
+            fitData = syntheticFitData(n)
+
+            legacyTime, _ = timed(legacyWriteFitFile, fitData, legacyFitFile)
+            streamTime, _ = timed(writeFitFile, fitData, fitFile)
+            assert readBytes(legacyFitFile) == readBytes(fitFile)
+            mb = getsize(fitFile)/1048576.
+            print '%10d %8.2f %6s %12.3f %12.3f %7.2fx'%(n, mb, 'write', legacyTime, streamTime, legacyTime/streamTime)
+
+            legacyTime, legacyData = timed(legacyReadFitFile, fitFile)
+            streamTime, streamData = timed(readFitFile, fitFile)
+            assert legacyData == streamData == fitData
+            print '%10d %8.2f %6s %12.3f %12.3f %7.2fx'%(n, mb, 'read', legacyTime, streamTime, legacyTime/streamTime)
+    finally:
+        remove(fitFile)
+        remove(legacyFitFile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Times cache.insert, cache.find and cache.prune against a cache index of a
+# million objects, with prune compared to the way it used to work (sorting the
+# whole lru part and renumbering every object that is left). The index is
+# filled in directly, without the objects themselves, which prune doesn't
+# mind. Run from inside a git working tree (fitlib needs one to import):
+#
+#   python -m test.bench.bench_lru [NUM_OBJECTS [NUM_OPERATIONS]]
+
+import fitlib
+from fitlib import cache
+from hashlib import sha1
+from os import makedirs
+from os.path import join
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from time import time
+
+# prune as it was before the lru index, on the same database
+def renumberingPrune(size):
+    conn = cache._connect(fitlib.context.cacheIndexFile)
+    index = cache._Index(conn, cache._repoId())
+    items = conn.execute('SELECT key, size FROM objects WHERE lru IS NOT NULL ORDER BY lru').fetchall()
+    i = 0
+    while index.lruSize > size and i < len(items):
+        index.lruSize -= items[i][1]
+        i += 1
+    index.delete(k for k,s in items[:i])
+    index.lruCount = len(items) - i
+    index.setLru((k, (s, n+1, s, None)) for n,(k,s) in enumerate(items[i:]))
+    index.saveTotals()
+    conn.commit()
+    conn.close()
+    return index.lruSize
+
+def fillIndex(keys, objectSize):
+    conn = cache._connect(fitlib.context.cacheIndexFile)
+    conn.executemany('INSERT INTO objects VALUES (?,?,?,0,?,NULL)', ((k, objectSize, i+1, objectSize) for i,k in enumerate(keys)))
+    conn.executemany('UPDATE meta SET value = ? WHERE key = ?', [(objectSize*len(keys), 'lruSize'), (len(keys), 'lruCount')])
+    conn.commit()
+    conn.close()
+
+def timed(func, *args, **kw):
+    start = time()
+    result = func(*args, **kw)
+    return time() - start, result
+
+def main():
+    numObjects = int(argv[1]) if len(argv) > 1 else 1000000
+    numOps = int(argv[2]) if len(argv) > 2 else 1000
+    objectSize = 1000
+    keys = [sha1(str(i)).hexdigest() for i in xrange(numObjects)]
+
+    tempDir = mkdtemp()
+    savedDirs = fitlib.context._dirs
+    fitlib.context._dirs = (tempDir, join(tempDir, '.git'))
+    try:
+        makedirs(fitlib.context.objectsDir)
+        fillTime, _ = timed(fillIndex, keys, objectSize)
+        print 'filling the index with %d objects: %.3fs'%(numObjects, fillTime)
+
+        srcFile = join(tempDir, 'object')
+        open(srcFile, 'w').write('x'*objectSize)
+        newKeys = {sha1('new%d'%i).hexdigest():(objectSize, srcFile) for i in xrange(numOps)}
+        print '%-36s %8.3fs'%('insert %d'%numOps, timed(cache.insert, newKeys, inLru=True)[0])
+        print '%-36s %8.3fs'%('find %d (oldest ones)'%numOps, timed(cache.find, keys[:numOps])[0])
+        print '%-36s %8.3fs'%('find 1', timed(cache.find, keys[-1:])[0])
+
+        lruSize = cache.size()[0]
+        print '%-36s %8.3fs'%('prune %d'%numOps, timed(cache.prune, lruSize - numOps*objectSize)[0])
+        print '%-36s %8.3fs'%('prune 1', timed(cache.prune, lruSize - (numOps+1)*objectSize)[0])
+        print '%-36s %8.3fs'%('prune none', timed(cache.prune, lruSize)[0])
+        print '%-36s %8.3fs'%('renumbering prune %d'%numOps, timed(renumberingPrune, lruSize - (2*numOps+1)*objectSize)[0])
+    finally:
+        fitlib.context._dirs = savedDirs
+        rmtree(tempDir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# Compares the text and v2 .fit formats on synthetic manifests of various
+# sizes: file size, writing, a full read, and finding a single path, all paths
+# below a directory, and all paths with a given hash. Run from inside a git
+# working tree (fitlib needs one to import):
+#
+#   python -m test.bench.bench_manifest [NUM_ITEMS...]
+
+from fitlib import readFitFile, writeFitFile
+from fitlib.manifest import encodeManifest, Manifest
+from os import close as osclose, remove
+from os.path import getsize
+from sys import argv
+from tempfile import mkstemp
+from time import time
+from test.bench.bench_fitfile import syntheticFitData, timed
+
+def writeV2(fitData, filePath):
+    f = open(filePath, 'wb')
+    f.write(encodeManifest(fitData))
+    f.close()
+
+def textLookups(filePath, p, prefix, objHash):
+    fitData = readFitFile(filePath)
+    return (fitData.get(p), sorted(i for i in fitData if i.startswith(prefix)),
+        sorted(i for i,(h,s) in fitData.iteritems() if h == objHash))
+
+def v2Lookups(filePath, p, prefix, objHash):
+    m = Manifest(filePath)
+    try:
+        return m.get(p), [i for i,h,s in m.iterPrefix(prefix)], sorted(m.findHash(objHash))
+    finally:
+        m.close()
+
+def main():
+    sizes = [int(a) for a in argv[1:]] or [10000, 100000, 1000000]
+    handle, textFile = mkstemp()
+    osclose(handle)
+    handle, v2File = mkstemp()
+    osclose(handle)
+    try:
+        print '%10s %8s %8s %8s %8s %8s %8s %8s %8s'%('items', 'text MB', 'v2 MB', 'text w', 'v2 w', 'text r', 'v2 r', 'text q', 'v2 q')
+        for n in sizes:
+            fitData = syntheticFitData(n)
+            p = sorted(fitData)[n/2]
+            prefix = p[:p.rindex('/')+1]
+            objHash = fitData[p][0]
+
+            textWrite, _ = timed(writeFitFile, fitData, textFile)
+            v2Write, _ = timed(writeV2, fitData, v2File)
+            textRead, textData = timed(readFitFile, textFile)
+            v2Read, v2Data = timed(readFitFile, v2File)
+            assert textData == v2Data == fitData
+            textQuery, textResult = timed(textLookups, textFile, p, prefix, objHash)
+            v2Query, v2Result = timed(v2Lookups, v2File, p, prefix, objHash)
+            assert textResult == v2Result
+
+            print '%10d %8.2f %8.2f %8.3f %8.3f %8.3f %8.3f %8.3f %8.4f'%(n, getsize(textFile)/1048576., getsize(v2File)/1048576.,
+                textWrite, v2Write, textRead, v2Read, textQuery, v2Query)
+    finally:
+        remove(textFile)
+        remove(v2File)
+
+if __name__ == '__main__':
+    main()
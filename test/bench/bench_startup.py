@@ -0,0 +1,75 @@
+# Benchmarks the startup cost of each git-fit entry point that git invokes
+# on its own (hooks, merge driver, textconv) plus the status command, in a
+# scratch repository. Each run also counts the git subprocesses spawned, by
+# putting a logging git wrapper first in the PATH.
+#
+#   python -m test.bench.bench_startup [RUNS]
+
+from os import chmod, environ, pathsep
+from os.path import dirname, join, realpath
+from shutil import rmtree
+from subprocess import Popen as popen, PIPE, call
+from sys import argv, executable
+from tempfile import mkdtemp
+from time import time
+
+gitFit = join(dirname(dirname(dirname(realpath(__file__)))), 'git-fit')
+
+entryPoints = [
+    ('status', []),
+    ('text-output', ['--git=text-output', '.fit']),
+    ('merge-driver', ['--git=merge-driver', '.fit', '.fit-mine', '.fit']),
+    ('pre-commit', ['--git=pre-commit']),
+    ('post-commit', ['--git=post-commit']),
+    ('post-checkout', ['--git=post-checkout', '--git-head-change', 'HEAD', 'HEAD', '1']),
+]
+
+def shell(cmd, cwd):
+    return call('set -e\n' + cmd, shell=True, cwd=cwd, stdout=PIPE, stderr=PIPE)
+
+def makeGitWrapper(binDir, logFile):
+    realGit = popen(['which', 'git'], stdout=PIPE).communicate()[0].strip()
+    wrapper = join(binDir, 'git')
+    f = open(wrapper, 'w')
+    f.write('#!/bin/sh\necho "$*" >> "%s"\nexec "%s" "$@"\n'%(logFile, realGit))
+    f.close()
+    chmod(wrapper, 0755)
+
+def main():
+    runs = int(argv[1]) if len(argv) > 1 else 10
+    repo = mkdtemp()
+    binDir = mkdtemp()
+    logFile = join(binDir, 'git.log')
+    try:
+        shell('''
+            git init -q .
+            git config user.email bench@example.com
+            git config user.name bench
+            echo '*.bin fit' > .gitattributes
+            head -c 10000 /dev/urandom > a.bin
+            git add .gitattributes
+            git commit -q -m init
+        ''', repo)
+        call([executable, gitFit, '--no-hooks'], cwd=repo, stdout=PIPE)
+        call([executable, gitFit, 'save'], cwd=repo, stdout=PIPE)
+        shell('cp .fit .fit-mine', repo)
+
+        makeGitWrapper(binDir, logFile)
+        env = dict(environ)
+        env['PATH'] = binDir + pathsep + env['PATH']
+
+        print '%-15s %12s %14s'%('entry point', 'mean (ms)', 'git processes')
+        for name, args in entryPoints:
+            open(logFile, 'w').close()
+            start = time()
+            for i in xrange(runs):
+                call([executable, gitFit] + args, cwd=repo, env=env, stdout=PIPE, stderr=PIPE)
+            elapsed = (time() - start)/runs
+            gitCalls = len(open(logFile).readlines())/float(runs)
+            print '%-15s %12.1f %14.1f'%(name, elapsed*1000, gitCalls)
+    finally:
+        rmtree(repo)
+        rmtree(binDir)
+
+if __name__ == '__main__':
+    main()
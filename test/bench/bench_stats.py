@@ -0,0 +1,52 @@
+# Benchmarks collecting stats of fit items in a deep directory tree, comparing
+# the serial fitStats loop updateStats used to run with collectStats. Run from
+# inside a git working tree (fitlib needs one to import), optionally pointing
+# it at a directory on the file system of interest (e.g. an NFS mount):
+#
+#   python -m test.bench.bench_stats [NUM_ITEMS [DEPTH [BASE_DIR]]]
+
+from fitlib import fitStats, collectStats
+from os import makedirs, chdir, getcwd
+from os.path import join
+from shutil import rmtree
+from sys import argv
+from tempfile import mkdtemp
+from time import time
+
+def makeDeepTree(root, numItems, depth):
+    items = []
+    dirs = set()
+    for i in xrange(numItems):
+        d = '/'.join('d%d'%((i/(7**l))%7) for l in xrange(depth))
+        p = '%s/item%d.bin'%(d, i)
+        if d not in dirs:
+            makedirs(join(root, d))
+            dirs.add(d)
+        open(join(root, p), 'w').close()
+        items.append(p)
+    return items
+
+def timed(func, *args):
+    start = time()
+    result = func(*args)
+    return time() - start, result
+
+def main():
+    numItems = int(argv[1]) if len(argv) > 1 else 100000
+    depth = int(argv[2]) if len(argv) > 2 else 6
+    root = mkdtemp(dir=argv[3] if len(argv) > 3 else None)
+    cwd = getcwd()
+    try:
+        items = makeDeepTree(root, numItems, depth)
+        chdir(root)
+        serialTime, serialStats = timed(lambda: {i:fitStats(i) for i in items})
+        for jobs in (4, 16, 64):
+            collectTime, collectedStats = timed(collectStats, items, jobs)
+            assert collectedStats == serialStats
+            print '%d items, depth %d, %2d threads: serial %.3fs, collectStats %.3fs (%.2fx)'%(numItems, depth, jobs, serialTime, collectTime, serialTime/collectTime)
+    finally:
+        chdir(cwd)
+        rmtree(root)
+
+if __name__ == '__main__':
+    main()
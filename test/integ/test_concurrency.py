@@ -0,0 +1,95 @@
+import unittest
+
+from os import environ, pathsep
+from os.path import dirname, realpath, join
+from shutil import rmtree
+from sqlite3 import connect
+from subprocess import Popen, PIPE, check_output
+from sys import executable
+from tempfile import mkdtemp
+
+# Runs many git-fit processes against one repository at the same time, the
+# way git GUIs and IDEs do (firing hooks while they query the status), and
+# checks that none of them fails and that the state fit keeps is intact and
+# consistent with the working tree afterwards.
+
+_packageDir = dirname(dirname(dirname(realpath(__file__))))
+_numItems = 40
+_numStatusRuns = 12
+
+class TestConcurrency(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.env = dict(environ)
+        self.env['PYTHONPATH'] = _packageDir + pathsep + environ.get('PYTHONPATH', '')
+        self.env['GIT_AUTHOR_NAME'] = self.env['GIT_COMMITTER_NAME'] = 'fit'
+        self.env['GIT_AUTHOR_EMAIL'] = self.env['GIT_COMMITTER_EMAIL'] = 'fit@example.com'
+        # The hooks call git-fit by name
+        self.env['PATH'] = _packageDir + pathsep + environ['PATH']
+        self.git('init', '-q', '.')
+        self.git('commit', '-q', '--allow-empty', '-m', 'init')
+        self.fit()
+        open(join(self.dir, '.gitattributes'), 'w').write('*.bin fit\n')
+        self.git('add', '.gitattributes')
+        self.writeItems('one')
+        self.fit('save')
+        self.git('commit', '-q', '-m', 'one')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def git(self, *args):
+        return check_output(('git',) + args, cwd=self.dir, env=self.env, stderr=PIPE)
+
+    def fit(self, *args):
+        return check_output((executable, join(_packageDir, 'git-fit')) + args, cwd=self.dir, env=self.env)
+
+    def writeItems(self, version, items=range(_numItems)):
+        for i in items:
+            open(join(self.dir, 'item%d.bin'%i), 'wb').write('%s %d \0\n'%(version, i) * 100)
+
+    # Starts all of the given git-fit commands at once, and checks that they
+    # all succeed
+    def runAll(self, commands):
+        procs = [Popen((executable, join(_packageDir, 'git-fit')) + c, cwd=self.dir, env=self.env, stdout=PIPE, stderr=PIPE) for c in commands]
+        for c,p in zip(commands, procs):
+            out, err = p.communicate()
+            self.assertEqual(0, p.returncode, 'git-fit %s failed:\n%s%s'%(' '.join(c), out, err))
+            self.assertFalse('Traceback' in out + err, 'git-fit %s failed:\n%s%s'%(' '.join(c), out, err))
+
+    def assertIntact(self):
+        fitDir = join(self.dir, '.git', 'fit')
+        for db in [join(fitDir, 'stat'), join(fitDir, 'cache', 'index')]:
+            conn = connect(db)
+            self.assertEqual('ok', conn.execute('PRAGMA integrity_check').fetchone()[0])
+            conn.close()
+        # The saved state matches the working tree
+        status = self.fit()
+        self.assertFalse('.bin' in status, status)
+        self.assertTrue(self.fit('cache', 'verify').splitlines()[-1].startswith('The cache is OK'))
+
+    def testSavesAndStatus(self):
+        self.writeItems('two', range(0, _numItems, 2))
+        # Each save reads the .fit file, adds its own items and writes it
+        # back, none of them may be lost
+        self.runAll([('save', 'item%d.bin'%i) for i in range(0, _numItems, 2)] + [()] * _numStatusRuns)
+        self.assertIntact()
+        self.writeItems('three', range(1, _numItems, 2))
+        self.runAll([('save',)] * 4 + [()] * _numStatusRuns)
+        self.assertIntact()
+        self.assertEqual(1, len(self.git('status', '--porcelain', '.fit').splitlines()))
+
+        self.git('commit', '-q', '-m', 'two')
+        self.runAll([('put', '-s')] * 2 + [()] * _numStatusRuns)
+        self.assertIntact()
+
+    def testCheckoutHooksAndStatus(self):
+        self.writeItems('two', range(0, _numItems, 2))
+        self.fit('save')
+        self.git('commit', '-q', '-m', 'two')
+        old, new = self.git('rev-parse', 'HEAD', 'HEAD~').split()
+        # Fires the post-checkout hook once
+        self.git('checkout', '-q', new)
+        self.runAll([('--git=post-checkout', '--git-head-change', old, new, '1')] * 4 + [('restore',)] * 2 + [()] * _numStatusRuns)
+        self.assertIntact()
+        self.assertEqual('one 0 \0\n' * 100, open(join(self.dir, 'item0.bin'), 'rb').read())
@@ -0,0 +1,167 @@
+import unittest
+
+import fitlib
+from fitlib import cache, config, objects
+from fitlib.asyncstore import AsyncStore
+from fitlib.hashing import gitBlobHash
+from functools import partial
+from heapq import heappush, heappop
+from os import makedirs, getcwd, chdir
+from os.path import join
+from Queue import Queue, Empty
+from shutil import rmtree
+from subprocess import Popen as popen
+from tempfile import mkdtemp
+from threading import Lock, Thread, local
+from time import time
+
+# An in-memory asynchronous data store, with an event loop of its own that
+# completes each transfer a while after it was started, keeping track of how
+# many were in flight at once
+class Store(fitlib.DataStore):
+    asynchronous = True
+    objects = {}
+    failing = set()
+    instances = []
+
+    def __init__(self, progress):
+        self.instances.append(self)
+        self.lock = Lock()
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.requests = Queue()
+        self.loop = Thread(target=self._run)
+        self.loop.daemon = True
+        self.loop.start()
+
+    def _run(self):
+        pending = []
+        while True:
+            try:
+                request = self.requests.get(timeout=max(0, pending[0][0] - time()) if pending else None)
+                if request == None:
+                    return
+                heappush(pending, (time() + 0.02, id(request), request))
+            except Empty:
+                pass
+            while pending and pending[0][0] <= time():
+                finish = heappop(pending)[2]
+                self.lock.acquire()
+                self.inFlight -= 1
+                self.lock.release()
+                finish()
+
+    def _start(self, finish):
+        self.lock.acquire()
+        self.inFlight += 1
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        self.lock.release()
+        self.requests.put(finish)
+
+    def checkAsync(self, key, done):
+        self._start(lambda: done(key if key in self.objects else None))
+
+    def getAsync(self, key, dst, size, offset, done, progress):
+        if key in self.failing:
+            # Reports first, and fails after
+            done(True)
+            raise IOError('failed')
+        def finish():
+            data = self.objects[key]
+            open(dst, 'wb').write(data[:len(data)/2])
+            progress(len(data)/2, len(data))
+            open(dst, 'ab').write(data[len(data)/2:])
+            done(True)
+        self._start(finish)
+
+    def putAsync(self, src, key, size, done, progress):
+        if key in self.failing:
+            raise IOError('failed')
+        data = open(src, 'rb').read()
+        def finish():
+            self.objects[key] = data
+            done(True)
+        self._start(finish)
+
+    def close(self):
+        self.requests.put(None)
+        self.loop.join()
+
+class TestAsyncStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        popen(['git', 'init', '-q', self.dir]).wait()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        makedirs(fitlib.context.objectsDir)
+        self.savedCwd = getcwd()
+        chdir(self.dir)
+        self.savedConfig = config._values
+        config._values = {'fit.datastore.modulename': __name__, 'fit.transfer.jobs': '2', 'fit.transfer.inflight': '16'}
+        Store.objects = {}
+        Store.failing = set()
+        Store.instances = []
+
+        self.items = []
+        for i in range(40):
+            filePath = 'item%02d'%i
+            open(filePath, 'w').write('item %d'%i)
+            self.items.append((filePath, gitBlobHash(filePath), len('item %d'%i)))
+        cache.insert({h:(s,f) for f,h,s in self.items})
+
+    def tearDown(self):
+        config._values = self.savedConfig
+        chdir(self.savedCwd)
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def testInFlight(self):
+        store = AsyncStore(Store(None), 5, lambda: lambda done, size: None)
+        Store.failing = {'item03'}
+        items = [(f, f, s) for f,h,s in self.items]
+        # The call that raises fails only its own transfer
+        self.assertEqual(set(f for f,h,s in self.items) - {'item03'}, store.putMany(items))
+        self.assertEqual(5, Store.instances[0].maxInFlight)
+        self.assertEqual({'item01':'item01'}, store.checkMany(['item01', 'item03']))
+        self.assertEqual(None, store.check('item03'))
+        self.assertEqual({'copy01'}, store.getMany([('item01', 'copy01', 6)]))
+        self.assertEqual('item 1', open('copy01').read())
+        # Only the first result counts, and the slot is given back once
+        self.assertEqual(True, store.get('item03', 'copy03', 6))
+        self.assertEqual(5, len([store.slots.acquire() for i in range(5)]))
+        store.close()
+
+    def testProgress(self):
+        # Reported from the event loop, to the item of the thread that
+        # started the transfer
+        current = local()
+        reported = []
+        store = AsyncStore(Store(None), 5, lambda: partial(lambda name, done, size: reported.append((name, done)), current.name))
+        Store.objects = {'a': 'aaaa', 'b': 'bbbbbb'}
+        def get(key):
+            current.name = key
+            store.get(key, 'copy' + key, len(Store.objects[key]))
+        threads = [Thread(target=get, args=(k,)) for k in ['a', 'b']]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([('a', 2), ('b', 3)], sorted(reported))
+        store.close()
+
+    def testTransfer(self):
+        fitData = {f:[h,s] for f,h,s in self.items}
+        objects._transfer(objects._put, list(self.items), 100, fitData, [], quiet=True)
+        self.assertEqual(40, len(Store.objects))
+        # Far more in flight than there are threads
+        self.assertEqual(16, Store.instances[0].maxInFlight)
+
+        for filePath,h,s in self.items:
+            open(filePath, 'w').close()
+        cache.delete([h for f,h,s in self.items])
+        successes = []
+        materializer = objects.Materializer()
+        objects._transfer(partial(objects._get, materializer=materializer), list(self.items), 100, fitData, successes, quiet=True)
+        materializer.finish()
+        self.assertEqual(40, len(successes))
+        self.assertEqual('item 39', open('item39').read())
@@ -0,0 +1,70 @@
+import unittest
+
+from fitlib.binary import isBinaryData, classifyFiles
+from json import load
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+class TestIsBinaryData(unittest.TestCase):
+    def testText(self):
+        self.assertFalse(isBinaryData(''))
+        self.assertFalse(isBinaryData('plain ascii\n\twith tabs\r\n'))
+        self.assertFalse(isBinaryData('\x1b[1mbold\x1b[0m'))
+
+    def testNulByte(self):
+        self.assertTrue(isBinaryData('abc\0def'))
+
+    def testControlChars(self):
+        self.assertTrue(isBinaryData('\x01\x02\x03'))
+
+    def testUtf8(self):
+        self.assertFalse(isBinaryData(u'caf\xe9 \u2603'.encode('utf-8')))
+        # a multi-byte sequence cut off at the end of the sniffed data
+        self.assertFalse(isBinaryData(u'\u2603'.encode('utf-8')[:2]))
+
+    def testSingleByteEncodings(self):
+        self.assertFalse(isBinaryData('caf\xe9'))
+        self.assertTrue(isBinaryData('\x89\x9a\x80'))
+
+    def testWideEncodings(self):
+        text = u'caf\xe9 \u2603\r\n'
+        for encoding in ['utf-16', 'utf-16-le', 'utf-16-be', 'utf-32']:
+            self.assertFalse(isBinaryData(text.encode(encoding)), encoding)
+        # cut off in the middle of a character
+        self.assertFalse(isBinaryData(text.encode('utf-16')[:-1]))
+        self.assertTrue(isBinaryData(u'\x01\x02'.encode('utf-16')))
+        self.assertTrue(isBinaryData('\0\0\0\0'))
+
+class TestClassifyFiles(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.memoFile = join(self.dir, 'memo')
+        self.files = {}
+        for i in range(40):
+            p = join(self.dir, 'f%d'%i)
+            f = open(p, 'wb')
+            f.write('\0binary' if i % 2 else 'text')
+            f.close()
+            self.files[p] = 'blob%d'%i
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testClassifyAndMemoise(self):
+        results = classifyFiles(list(self.files), blobIds=self.files, memoFile=self.memoFile)
+        self.assertEqual({p:p[-1] in '13579' for p in self.files}, results)
+        self.assertEqual({b:results[p] for p,b in self.files.iteritems()}, load(open(self.memoFile)))
+
+        # memoised results are used without looking at the files again
+        for p in self.files:
+            open(p, 'w').close()
+        self.assertEqual(results, classifyFiles(list(self.files), blobIds=self.files, memoFile=self.memoFile))
+
+    def testClassifyBlobs(self):
+        # Staged as text, made binary in the working tree since
+        blobs = {b:'text' for b in self.files.itervalues()}
+        results = classifyFiles(list(self.files), blobIds=self.files, memoFile=self.memoFile,
+            readBlob=lambda blobId, size: blobs[blobId][:size])
+        self.assertEqual({p:False for p in self.files}, results)
+        self.assertEqual({b:False for b in blobs}, load(open(self.memoFile)))
@@ -0,0 +1,309 @@
+import unittest
+
+import fitlib
+from fitlib import cache, config
+from hashlib import sha1
+from json import dump
+from multiprocessing import Pool
+from os import makedirs, remove, walk
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+import sqlite3
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        makedirs(fitlib.context.objectsDir)
+        self.files = {}
+        for k in ['aa11', 'bb22', 'cc33']:
+            self.files[k] = join(self.dir, k)
+            open(self.files[k], 'w').write(k*10)
+
+    def tearDown(self):
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def items(self, keys, size=40):
+        return {k:(size, self.files[k]) for k in keys}
+
+    def testInsertCommitEnque(self):
+        inserted, inOther, ls, ms = cache.insert(self.items(['aa11', 'bb22']))
+        self.assertEqual(({'aa11', 'bb22'}, [], 0, 80), (set(inserted), inOther, ls, ms))
+        self.assertTrue(exists(join(fitlib.context.objectsDir, 'aa', '11')))
+
+        self.assertEqual({'aa11': 40}, cache.commit(['aa11', 'cc33']))
+        self.assertEqual({}, cache.commit(['aa11']))
+        self.assertEqual({'aa11'}, cache.getCommittedObjects())
+
+        enqued, fromMap = cache.enque(['aa11'])
+        self.assertEqual(({'aa11': 40}, {'aa11': (40, True)}), (enqued, fromMap))
+        self.assertEqual((40, 40), cache.size())
+        self.assertEqual(set(), cache.getCommittedObjects())
+
+        self.assertEqual({'aa11', 'bb22'}, set(cache.find(k for k in ['aa11', 'bb22', 'cc33'])))
+        self.assertEqual({'bb22'}, set(cache.find(['aa11', 'bb22'], inMap=True)))
+
+    def testInsertInLru(self):
+        cache.insert(self.items(['aa11']))
+        inserted, inOther, ls, ms = cache.insert(self.items(['aa11', 'bb22']), inLru=True)
+        self.assertEqual((['bb22'], ['aa11'], 80, 0), (inserted.keys(), inOther, ls, ms))
+
+    def testDelete(self):
+        cache.insert(self.items(['aa11', 'bb22']))
+        cache.commit(['bb22'])
+        deleted, ls, ms = cache.delete(['aa11', 'bb22'])
+        self.assertEqual(({'aa11': 40}, 0, 40), (deleted, ls, ms))
+        self.assertFalse(exists(join(fitlib.context.objectsDir, 'aa', '11')))
+        self.assertEqual({'bb22': 40}, cache.delete(['bb22'], commits=True)[0])
+
+    def testPrune(self):
+        for k in ['aa11', 'bb22', 'cc33']:
+            cache.insert(self.items([k]), inLru=True)
+        cache.find(['aa11'])
+        self.assertEqual(80, cache.prune(80))
+        self.assertEqual({'aa11', 'cc33'}, set(cache.find(['aa11', 'bb22', 'cc33'])))
+        self.assertFalse(exists(join(fitlib.context.objectsDir, 'bb', '22')))
+
+    def testPruneChunksOfMapObjects(self):
+        # The chunks of an object that hasn't been put don't go, so evicting
+        # objects in the lru part doesn't get the cache any smaller than that
+        base = ''.join(sha1('data%d'%i).digest() for i in xrange(15000))
+        open(self.files['bb22'], 'w').write(base)
+        savedConfig = config._values
+        config._values = {'fit.chunking': 'true', 'fit.chunking.minfilesize': '100000'}
+        try:
+            cache.insert(self.items(['bb22'], size=len(base)))
+        finally:
+            config._values = savedConfig
+        cache.insert(self.items(['aa11']), inLru=True)
+        self.assertEqual(40, cache.prune(40))
+        self.assertEqual({'aa11', 'bb22'}, set(cache.find(['aa11', 'bb22'])))
+        self.assertEqual(0, cache.prune(0))
+
+    def testPruneMissingObjects(self):
+        for k in ['aa11', 'bb22', 'cc33']:
+            cache.insert(self.items([k]), inLru=True)
+        remove(join(fitlib.context.objectsDir, 'aa', '11'))
+        self.assertEqual(40, cache.prune(40))
+        self.assertEqual({'cc33'}, set(cache.find(['aa11', 'bb22', 'cc33'])))
+        # Nothing to evict, nothing changes
+        self.assertEqual(40, cache.prune(40))
+        self.assertEqual((40, 0), cache.size())
+
+    def testEvict(self):
+        savedConfig = config._values
+        config._values = {'fit.cache.maxsize': '100', 'fit.cache.lowwatermark': '50'}
+        try:
+            cache.insert(self.items(['aa11']))
+            self.assertEqual((40, 40), cache.insert(self.items(['bb22']), inLru=True)[2:])
+            self.assertEqual(0, cache.evict())
+            # Past 90 bytes, down to 50 (of which 40 can't be evicted)
+            self.assertEqual((0, 40), cache.insert(self.items(['cc33']), inLru=True)[2:])
+            self.assertEqual({'aa11'}, set(cache.find(['aa11', 'bb22', 'cc33'])))
+
+            config._values['fit.cache.highwatermark'] = '30'
+            self.assertRaises(Exception, cache.evict)
+        finally:
+            config._values = savedConfig
+
+    def testCompression(self):
+        savedConfig = config._values
+        config._values = {'fit.cache.compression': 'zlib', 'fit.cache.compressionskipextensions': '.png'}
+        try:
+            png = join(self.dir, 'image.png')
+            open(png, 'w').write('x'*1000)
+            self.files['dd44'] = png
+            open(self.files['bb22'], 'w').write('random \x8f\x01\x9a')
+            cache.insert(self.items(['aa11', 'bb22', 'dd44'], size=1000))
+        finally:
+            config._values = savedConfig
+
+        found = cache.find(['aa11', 'bb22', 'dd44'])
+        self.assertTrue(cache.isCompressed(found['aa11']))
+        # Skipped by extension, and not getting any smaller
+        self.assertFalse(cache.isCompressed(found['bb22']))
+        self.assertFalse(cache.isCompressed(found['dd44']))
+
+        lruSize, mapSize = cache.size()
+        self.assertTrue(mapSize < 1000 + 11 + 40)
+        out = join(self.dir, 'out')
+        self.assertEqual('zlib', cache.extract(found['aa11'], out))
+        self.assertEqual('aa11'*10, open(out).read())
+
+        cache.enque(['aa11'])
+        self.assertEqual(0, cache.prune(0))
+        self.assertFalse(exists(found['aa11']))
+
+    def testChunks(self):
+        # Random looking, but the same every time, so the chunk boundaries are
+        # too
+        base = ''.join(sha1('data%d'%i).digest() for i in xrange((1 << 20)/20 + 1))[:1 << 20]
+        open(self.files['aa11'], 'w').write(base)
+        open(self.files['bb22'], 'w').write(base[:500000] + 'edit' + base[500000:])
+        savedConfig = config._values
+        config._values = {'fit.chunking': 'true', 'fit.chunking.minfilesize': '100000'}
+        try:
+            cache.insert(self.items(['aa11', 'bb22', 'cc33'], size=1 << 20))
+        finally:
+            config._values = savedConfig
+
+        found = cache.find(['aa11', 'bb22', 'cc33'])
+        self.assertTrue(cache.isChunked(found['aa11']))
+        self.assertFalse(cache.isChunked(found['cc33']))
+        # Most chunks are shared
+        lruSize, mapSize = cache.size()
+        chunkSize = cache._connect(fitlib.context.cacheIndexFile).execute('SELECT sum(size) FROM chunks').fetchone()[0]
+        self.assertTrue(lruSize < (1 << 20) * 1.5)
+        self.assertEqual(chunkSize, lruSize)
+
+        out = join(self.dir, 'out')
+        self.assertEqual('chunks', cache.extract(found['bb22'], out))
+        self.assertEqual(base[:500000] + 'edit' + base[500000:], open(out).read())
+
+        # Chunks go with the last object referring to them
+        cache.delete(['aa11'])
+        cache.extract(found['bb22'], out)
+        self.assertEqual(base[:500000] + 'edit' + base[500000:], open(out).read())
+        cache.delete(['bb22'])
+        self.assertEqual((0, 40), cache.size())
+        self.assertEqual([], [f for d,ds,fs in walk(join(fitlib.context.objectsDir, 'chunks')) for f in fs])
+
+    def testMapChunkSize(self):
+        # A running total of the chunks that objects in the map part refer to
+        base = ''.join(sha1('data%d'%i).digest() for i in xrange((1 << 20)/20 + 1))[:1 << 20]
+        open(self.files['aa11'], 'w').write(base)
+        open(self.files['bb22'], 'w').write(base[:500000] + 'edit' + base[500000:])
+        savedConfig = config._values
+        config._values = {'fit.chunking': 'true', 'fit.chunking.minfilesize': '100000'}
+        try:
+            cache.insert(self.items(['aa11', 'bb22'], size=1 << 20))
+        finally:
+            config._values = savedConfig
+        query = lambda q: cache._connect(fitlib.context.cacheIndexFile).execute(q).fetchone()[0] or 0
+        mapChunkSize = lambda: query("SELECT value FROM meta WHERE key = 'mapChunkSize'")
+        self.assertEqual(query('SELECT sum(size) FROM chunks'), mapChunkSize())
+
+        # Chunks only aa11 refers to can be evicted once it is put
+        cache.enque(['aa11'])
+        self.assertEqual(sum(dict(cache.readRecipe(cache.find(['bb22'])['bb22'])).values()), mapChunkSize())
+        self.assertEqual(0, cache.prune(0))
+        self.assertEqual(mapChunkSize(), query('SELECT sum(size) FROM chunks'))
+
+        cache.delete(['bb22'])
+        self.assertEqual((0, 0), (mapChunkSize(), query('SELECT sum(size) FROM chunks')))
+
+    def useRepo(self, name):
+        fitlib.context._dirs = (join(self.dir, name), join(self.dir, name, '.git'))
+        exists(fitlib.context.fitDir) or makedirs(fitlib.context.fitDir)
+
+    def testSharedCache(self):
+        savedConfig = config._values
+        config._values = {'fit.cache.dir': join(self.dir, 'shared')}
+        try:
+            self.useRepo('a')
+            cache.insert(self.items(['aa11', 'bb22']))
+            cache.commit(['aa11'])
+            self.useRepo('b')
+            self.assertEqual(([], (0, 80)), (cache.insert(self.items(['aa11']))[0].keys(), cache.size()))
+            self.assertEqual(set(), cache.getCommittedObjects())
+            # Still needed by the other repository
+            self.assertEqual({'aa11': 40}, cache.delete(['aa11', 'bb22'])[0])
+            self.assertEqual({'aa11', 'bb22'}, set(cache.find(['aa11', 'bb22'])))
+
+            self.useRepo('a')
+            self.assertEqual({'aa11'}, cache.getCommittedObjects())
+            self.assertEqual({'bb22': 40}, cache.delete(['bb22'])[0])
+            self.assertEqual({'aa11': 40}, cache.delete(['aa11'], commits=True)[0])
+            self.assertEqual((0, 0), cache.size())
+            self.assertFalse(exists(join(self.dir, 'shared', 'objects', 'aa', '11')))
+            self.assertFalse(exists(join(fitlib.context.repoCacheDir, 'index')))
+        finally:
+            config._values = savedConfig
+
+    def testConcurrentInserts(self):
+        keys = ['%040x'%i for i in range(40)]
+        for k in keys:
+            open(join(self.dir, k), 'w').write(k)
+        pool = Pool(4)
+        try:
+            pool.map(_insertAndPrune, [(self.dir, keys[i::2]) for i in range(4)])
+        finally:
+            pool.close()
+            pool.join()
+        objects = cache.listIndex()[0]
+        self.assertEqual(set(keys), set(objects))
+        self.assertEqual((sum(r[3] for r in objects.values() if r[1]), sum(r[3] for r in objects.values() if not r[1])), cache.size())
+        self.assertEqual(40, len([f for d,ds,fs in walk(fitlib.context.objectsDir) for f in fs]))
+
+    def testReadsDontWaitForWriters(self):
+        cache.insert(self.items(['aa11']), inLru=True)
+        writer = sqlite3.connect(fitlib.context.cacheIndexFile)
+        writer.execute('BEGIN IMMEDIATE')
+        savedTimeout = cache._lockTimeout
+        cache._lockTimeout = 0.1
+        try:
+            self.assertEqual(['aa11'], cache.find(['aa11'], update=False).keys())
+            self.assertEqual((40, 0), cache.size())
+            self.assertRaises(sqlite3.OperationalError, cache.find, ['aa11'])
+        finally:
+            cache._lockTimeout = savedTimeout
+            writer.rollback()
+            writer.close()
+
+    def testImportRepoCache(self):
+        self.useRepo('a')
+        savedConfig = config._values
+        # Compressed in the repository's cache, not in the shared one
+        config._values = {'fit.cache.compression': 'zlib'}
+        try:
+            cache.insert(self.items(['aa11', 'bb22']))
+            cache.commit(['aa11'])
+            cache.insert(self.items(['cc33']), inLru=True)
+            self.assertTrue(cache.isCompressed(cache.find(['cc33'])['cc33']))
+            config._values = {'fit.cache.dir': join(self.dir, 'shared')}
+            self.assertEqual((40, 80), cache.size())
+            self.assertEqual({'aa11'}, cache.getCommittedObjects())
+            self.assertEqual({'aa11', 'bb22'}, set(cache.find(['aa11', 'bb22', 'cc33'], inMap=True)))
+            self.assertEqual('cc33'*10, open(cache.find(['cc33'])['cc33']).read())
+            self.assertFalse(exists(join(fitlib.context.repoCacheDir, 'index')))
+            self.assertFalse(exists(join(fitlib.context.repoCacheDir, 'objects')))
+        finally:
+            config._values = savedConfig
+
+    def testConcurrentMigrations(self):
+        f = open(fitlib.context.lruFile, 'w')
+        dump({'lru': {'size': 10, 'count': 3, 'items': {'aa11': [10, 3]}}, 'map': {'size': 0, 'items': {}}}, f)
+        f.close()
+        pool = Pool(4)
+        try:
+            self.assertEqual([(10, 0)]*4, pool.map(_size, [self.dir]*4))
+        finally:
+            pool.close()
+            pool.join()
+
+    def testMigrateLruFile(self):
+        f = open(fitlib.context.lruFile, 'w')
+        dump({'lru': {'size': 10, 'count': 3, 'items': {'aa11': [10, 3]}},
+              'map': {'size': 50, 'items': {'bb22': [20, True], 'cc33': [30, False]}}}, f)
+        f.close()
+
+        self.assertEqual((10, 50), cache.size())
+        self.assertFalse(exists(fitlib.context.lruFile))
+        self.assertEqual({'bb22'}, cache.getCommittedObjects())
+        self.assertEqual({'bb22', 'cc33'}, set(cache.find(['aa11', 'bb22', 'cc33'], inMap=True)))
+
+# Inserts objects into the cache of the given directory, half of them into
+# the lru part, and prunes nothing (a full prune walk under the lock)
+def _insertAndPrune(args):
+    dirPath, keys = args
+    fitlib.context._dirs = (dirPath, join(dirPath, '.git'))
+    for n,k in enumerate(keys):
+        cache.insert({k: (40, join(dirPath, k))}, inLru=n % 2 == 0)
+        cache.prune(1 << 30)
+
+def _size(dirPath):
+    fitlib.context._dirs = (dirPath, join(dirPath, '.git'))
+    return cache.size()
@@ -0,0 +1,38 @@
+import unittest
+
+from fitlib import chunking
+from StringIO import StringIO
+from hashlib import sha1
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+class TestChunking(unittest.TestCase):
+    def testChunks(self):
+        # Random looking, but the same every time, so that where the chunk
+        # boundaries fall is too
+        data = ''.join(sha1('data%d'%i).digest() for i in xrange((3 << 20)/20 + 1))[:3 << 20]
+        chunks = list(chunking.iterChunks(StringIO(data)))
+        self.assertEqual(data, ''.join(chunks))
+        self.assertTrue(len(chunks) > 5)
+        self.assertTrue(all(chunking._minChunkSize <= len(c) <= chunking._maxChunkSize for c in chunks[:-1]))
+
+        # Inserting bytes only changes the chunk they are inserted into
+        edited = data[:1500000] + 'inserted' + data[1500000:]
+        newChunks = [c for c in chunking.iterChunks(StringIO(edited)) if c not in chunks]
+        self.assertEqual(1, len(newChunks))
+
+    def testUniformData(self):
+        chunks = list(chunking.iterChunks(StringIO('\0'*(2 << 20))))
+        self.assertEqual(['\0'*chunking._maxChunkSize]*4, chunks)
+        self.assertEqual([], list(chunking.iterChunks(StringIO(''))))
+
+    def testRecipe(self):
+        tempDir = mkdtemp()
+        try:
+            recipe = [('aa11', 100), ('bb22', 20000)]
+            recipeFile = join(tempDir, 'recipe')
+            chunking.writeRecipe(recipe, recipeFile)
+            self.assertEqual(recipe, chunking.readRecipe(recipeFile))
+        finally:
+            rmtree(tempDir)
@@ -0,0 +1,31 @@
+import unittest
+
+from fitlib import compression
+from os import urandom
+from os.path import join, getsize
+from shutil import rmtree
+from tempfile import mkdtemp
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testRoundTrip(self):
+        # Spans several chunks, one of which decompresses to far more than
+        # a chunk
+        data = '\0'*(5 << 20) + urandom(100000) + 'end'
+        src, packed, out = [join(self.dir, n) for n in ['src', 'packed', 'out']]
+        open(src, 'wb').write(data)
+        size = compression.compressFile('zlib', src, packed)
+        self.assertEqual(getsize(packed), size)
+        self.assertTrue(size < 200000)
+        self.assertEqual(len(data), compression.decompressFile('zlib', packed, out))
+        self.assertEqual(data, open(out, 'rb').read())
+
+    def testIsCompressible(self):
+        skip = compression.getSkipExtensions()
+        self.assertFalse(compression.isCompressible('a/b.PNG', skip))
+        self.assertTrue(compression.isCompressible('a/b.psd', skip))
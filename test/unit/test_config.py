@@ -0,0 +1,35 @@
+import unittest
+
+from fitlib import config
+
+class TestGitConfig(unittest.TestCase):
+    def setUp(self):
+        self.saved = config._values
+        config._values = {
+            'fit.datastore.modulename': 'mystore',
+            'fit.downstream.skipextensions': '.a .dylib',
+            'fit.Sub.Section.flag': 'true',
+            'fit.cache.maxsize': '20G',
+            'fit.cache.minsize': '512',
+            'fit.cache.badsize': '5 MB',
+        }
+
+    def tearDown(self):
+        config._values = self.saved
+
+    def testCaseInsensitiveNames(self):
+        self.assertEqual('mystore', config.gitConfig('fit.datastore.moduleName'))
+        self.assertEqual('.a .dylib', config.gitConfig('FIT.downstream.skipExtensions'))
+
+    def testCaseSensitiveSubsection(self):
+        self.assertEqual('true', config.gitConfig('fit.Sub.Section.FLAG'))
+        self.assertEqual('', config.gitConfig('fit.sub.section.flag'))
+
+    def testMissingKey(self):
+        self.assertEqual('', config.gitConfig('fit.nothing.here'))
+
+    def testSize(self):
+        self.assertEqual(20 << 30, config.gitConfigSize('fit.cache.maxSize'))
+        self.assertEqual(512, config.gitConfigSize('fit.cache.minSize'))
+        self.assertEqual(None, config.gitConfigSize('fit.nothing.here'))
+        self.assertRaises(Exception, config.gitConfigSize, 'fit.cache.badSize')
@@ -0,0 +1,53 @@
+import unittest
+
+from fitlib import filecopy
+from errno import EXDEV
+from os import stat, chmod
+from os.path import join
+from shutil import rmtree
+from stat import S_IWUSR
+from tempfile import mkdtemp
+
+class TestFileCopy(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.src = join(self.dir, 'src')
+        self.dst = join(self.dir, 'dst')
+        open(self.src, 'w').write('x'*100000)
+        self.savedFunctions = dict(filecopy._functions)
+
+    def tearDown(self):
+        filecopy._functions.update(self.savedFunctions)
+        rmtree(self.dir)
+
+    def testCopy(self):
+        for mode in ['auto', 'copy']:
+            copier = filecopy.Copier(mode)
+            strategy = copier.copy(self.src, self.dst)
+            self.assertEqual('x'*100000, open(self.dst).read())
+            self.assertEqual({strategy: 1}, copier.used)
+            self.assertNotEqual(stat(self.src).st_ino, stat(self.dst).st_ino)
+
+    def testFallBack(self):
+        def unsupported(src, dst):
+            raise OSError(EXDEV, 'cross-device')
+        filecopy._functions['reflink'] = unsupported
+        copier = filecopy.Copier()
+        self.assertNotEqual('reflink', copier.copy(self.src, self.dst))
+        self.assertNotIn('reflink', copier.strategies)
+        self.assertEqual('x'*100000, open(self.dst).read())
+
+    def testHardlink(self):
+        copier = filecopy.Copier('hardlink')
+        self.assertEqual('hardlink', copier.copy(self.src, self.dst))
+        self.assertEqual(stat(self.src).st_ino, stat(self.dst).st_ino)
+        self.assertFalse(stat(self.src).st_mode & S_IWUSR)
+
+        # Copying over a hard linked file replaces it rather than writing
+        # through to the file it is linked to
+        other = join(self.dir, 'other')
+        open(other, 'w').write('y')
+        filecopy.copyFile(other, self.dst)
+        self.assertEqual('y', open(self.dst).read())
+        self.assertEqual('x'*100000, open(self.src).read())
+        chmod(self.src, 0644)
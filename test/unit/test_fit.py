@@ -1,2 +1,171 @@
 import unittest
 
+import fitlib
+from fitlib import config
+from gzip import GzipFile as gz
+from fitlib.manifest import encodeManifest
+from json import dump
+from os import close as osclose, remove, makedirs
+from os.path import dirname, join
+from shutil import rmtree
+from StringIO import StringIO
+from subprocess import Popen as popen, PIPE
+from tempfile import mkdtemp, mkstemp
+
+sampleFitText = '''\
+a.png:[1111111111111111111111111111111111111111,10],
+b.png:[2222222222222222222222222222222222222222,20],
+lib:{
+libFoo.so:[3333333333333333333333333333333333333333,30],
+zzz.dll:[5555555555555555555555555555555555555555,50],
+x:{
+y:{
+z.jar:[4444444444444444444444444444444444444444,40]
+}
+}
+},
+res:{
+icon.png:[6666666666666666666666666666666666666666,60]
+}
+'''
+
+sampleFitData = {
+    'a.png': ['1111111111111111111111111111111111111111', 10],
+    'b.png': ['2222222222222222222222222222222222222222', 20],
+    'lib/libFoo.so': ['3333333333333333333333333333333333333333', 30],
+    'lib/x/y/z.jar': ['4444444444444444444444444444444444444444', 40],
+    'lib/zzz.dll': ['5555555555555555555555555555555555555555', 50],
+    'res/icon.png': ['6666666666666666666666666666666666666666', 60],
+}
+
+class _FitFileTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.fitFile = mkstemp()
+        osclose(handle)
+
+    def tearDown(self):
+        remove(self.fitFile)
+
+    def readBytes(self):
+        f = open(self.fitFile, 'rb')
+        data = f.read()
+        f.close()
+        return data
+
+class TestReadFitFile(_FitFileTestCase):
+    def testIterFitItems(self):
+        items = list(fitlib.iterFitItems(StringIO(sampleFitText)))
+        self.assertEqual(len(sampleFitData), len(items))
+        self.assertEqual(sampleFitData, {p:[h,s] for p,h,s in items})
+
+    def testIterFitItemsEmpty(self):
+        self.assertEqual([], list(fitlib.iterFitItems(StringIO(''))))
+
+    def testReadTextFormat(self):
+        f = open(self.fitFile, 'wb')
+        f.write(sampleFitText)
+        f.close()
+        self.assertEqual(sampleFitData, fitlib.readFitFile(self.fitFile))
+
+    def testReadGzipFormat(self):
+        f = gz(self.fitFile, 'wb')
+        dump(sampleFitData, f)
+        f.close()
+        self.assertEqual(sampleFitData, fitlib.readFitFile(self.fitFile))
+
+    def testReadV2Format(self):
+        f = open(self.fitFile, 'wb')
+        f.write(encodeManifest(sampleFitData))
+        f.close()
+        self.assertEqual(sampleFitData, fitlib.readFitFile(self.fitFile))
+
+    def testReadEmptyFile(self):
+        self.assertEqual({}, fitlib.readFitFile(self.fitFile))
+
+class TestWriteFitFile(_FitFileTestCase):
+    def testWriteTextFormat(self):
+        fitlib.writeFitFile(sampleFitData, self.fitFile)
+        self.assertEqual(sampleFitText, self.readBytes())
+
+    def testWriteEmpty(self):
+        fitlib.writeFitFile({}, self.fitFile)
+        self.assertEqual('', self.readBytes())
+
+    def testWriteSingleNestedItem(self):
+        fitlib.writeFitFile({'a/b/c': ['abc', 1]}, self.fitFile)
+        self.assertEqual('a:{\nb:{\nc:[abc,1]\n}\n}\n', self.readBytes())
+
+    def testRoundTrip(self):
+        fitlib.writeFitFile(sampleFitData, self.fitFile)
+        self.assertEqual(sampleFitData, fitlib.readFitFile(self.fitFile))
+
+    def testRoundTripBraceNames(self):
+        fitData = dict(sampleFitData)
+        fitData.update({'}x.bin': ['7777777777777777777777777777777777777777', 70],
+            'lib/},y.bin': ['8888888888888888888888888888888888888888', 80]})
+        fitlib._writeFitData(fitData, self.fitFile)
+        self.assertEqual(fitData, {p:[h,s] for p,h,s in fitlib.iterFitItems(open(self.fitFile))})
+
+class TestComputeHashes(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        popen(['git', 'init', '-q', self.dir]).wait()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        self.savedConfig = config._values
+        config._values = {'fit.hash.jobs': '2'}
+
+    def tearDown(self):
+        config._values = self.savedConfig
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def testConversions(self):
+        open(join(self.dir, '.gitattributes'), 'w').write('*.txt text=auto\n*.id ident\n*.raw -text\n')
+        files = {'crlf.txt': 'a\r\nb\r\n', 'lf.txt': 'a\nb\n', 'x.id': '$Id$\n', 'crlf.raw': 'a\r\nb\r\n', 'c.bin': '\0\r\n'}
+        for name,data in files.iteritems():
+            open(join(self.dir, name), 'wb').write(data)
+        names = sorted(files)
+        self.assertEqual({'crlf.txt', 'lf.txt', 'x.id'}, fitlib.getConvertedPaths(names))
+        p = popen(['git', 'hash-object'] + names, stdout=PIPE, cwd=self.dir)
+        expected = p.communicate()[0].split()
+        self.assertEqual(expected, fitlib.computeHashes(names))
+        # The converted ones differ from the hash of their raw contents
+        self.assertNotEqual(expected[names.index('crlf.txt')], expected[names.index('crlf.raw')])
+        self.assertEqual(expected[names.index('crlf.txt')], fitlib.gitHashData(['a\r\n', 'b\r\n'], 'crlf.txt'))
+
+class TestCollectStats(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.items = []
+        for d in ['a', 'b', 'c/d']:
+            makedirs(join(self.dir, d))
+            for i in xrange(200 if d == 'a' else 50):
+                self.items.append(join(self.dir, d, '%d.bin'%i))
+                open(self.items[-1], 'w').write('x'*i)
+        self.items.append(join(self.dir, 'top.bin'))
+        open(self.items[-1], 'w').write('top')
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testThreaded(self):
+        self.assertTrue(len(self.items) >= fitlib._statThreadingThreshold)
+        self.assertEqual({i:fitlib.fitStats(i) for i in self.items}, fitlib.collectStats(self.items, jobs=4))
+
+    def testMissingFile(self):
+        items = self.items + [join(self.dir, 'b', 'gone.bin')]
+        self.assertRaises(OSError, fitlib.collectStats, items, jobs=1)
+        self.assertRaises(OSError, fitlib.collectStats, items, jobs=4)
+
+    def testStatBatches(self):
+        savedBatchSize = fitlib._statBatchSize
+        fitlib._statBatchSize = 30
+        try:
+            batches = list(fitlib._getStatBatches(self.items))
+        finally:
+            fitlib._statBatchSize = savedBatchSize
+        self.assertEqual(sorted(self.items), sorted(i for b in batches for i in b))
+        # Each batch is of one directory
+        self.assertTrue(all(len(b) <= 30 and len({dirname(i) for i in b}) == 1 for b in batches))
+        self.assertEqual(7 + 2 + 2 + 1, len(batches))
@@ -0,0 +1,39 @@
+import unittest
+
+from fitlib.gitobjects import BatchReader
+from shutil import rmtree
+from subprocess import Popen as popen, PIPE
+from tempfile import mkdtemp
+
+class TestBatchReader(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        popen(['git', 'init', '-q', self.dir]).wait()
+        self.reader = BatchReader(self.dir)
+
+    def tearDown(self):
+        self.reader.close()
+        rmtree(self.dir)
+
+    def writeBlob(self, data):
+        p = popen(['git', 'hash-object', '-w', '--stdin'], stdin=PIPE, stdout=PIPE, cwd=self.dir)
+        return p.communicate(data)[0].strip()
+
+    def testRead(self):
+        blobs = {self.writeBlob(d): d for d in ['', 'abc\n', 'no newline', '\0binary\n\n' * 1000]}
+        for i in xrange(2):
+            for blobId, data in blobs.iteritems():
+                self.assertEqual((blobId, data), self.reader.read(blobId))
+
+    def testReadLimit(self):
+        big, small = self.writeBlob('x' * (3 << 20)), self.writeBlob('abc\n')
+        self.assertEqual((big, 'xxxx'), self.reader.read(big, 4))
+        # The rest was skipped, not left in the way of the next object
+        self.assertEqual((small, 'abc\n'), self.reader.read(small, 1000))
+        self.assertEqual((big, 'x' * (3 << 20)), self.reader.read(big))
+
+    def testMissing(self):
+        self.assertEqual((None, None), self.reader.read('HEAD:.fit'))
+        self.assertEqual((None, None), self.reader.read('a\nb'))
+        blobId = self.writeBlob('x')
+        self.assertEqual((blobId, 'x'), self.reader.read(blobId))
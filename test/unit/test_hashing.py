@@ -0,0 +1,64 @@
+import unittest
+
+from fitlib.hashing import BlobHasher, gitBlobHash, iterBlobHashes
+from multiprocessing import Pool
+from os.path import join
+from shutil import rmtree
+from subprocess import Popen as popen, PIPE
+from tempfile import mkdtemp
+
+def gitHashObject(paths):
+    p = popen(['git', 'hash-object', '--no-filters'] + paths, stdout=PIPE)
+    return p.communicate()[0].split()
+
+class TestBlobHashes(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.paths = []
+        for i,size in enumerate([0, 1, 1000, 3 << 20]):
+            p = join(self.dir, 'f%d'%i)
+            f = open(p, 'wb')
+            f.write(''.join(chr((i+j)%256) for j in xrange(min(size, 4096)))*(size/4096) + 'x'*(size%4096))
+            f.close()
+            self.paths.append(p)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def testGitBlobHash(self):
+        self.assertEqual(gitHashObject(self.paths), [gitBlobHash(p) for p in self.paths])
+
+    def testIterBlobHashesKeepsIndices(self):
+        hashes = dict(iterBlobHashes(self.paths))
+        self.assertEqual(gitHashObject(self.paths), [hashes[i] for i in range(len(self.paths))])
+
+    def testIterBlobHashesWithPool(self):
+        pool = Pool(2)
+        try:
+            hashes = dict(iterBlobHashes(self.paths, pool=pool))
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertEqual(gitHashObject(self.paths), [hashes[i] for i in range(len(self.paths))])
+
+    def testBlobHasher(self):
+        data = open(self.paths[3], 'rb').read()
+        filePath = join(self.dir, 'written')
+        fileOut = open(filePath, 'wb')
+        hasher = BlobHasher(len(data))
+        # Catching up with the file as it is written, in pieces that don't
+        # line up with the reads
+        for i in xrange(0, len(data), 700000):
+            fileOut.write(data[i:i+700000])
+            fileOut.flush()
+            hasher.catchUp(filePath)
+        fileOut.close()
+        hasher.catchUp(filePath)
+        hasher.close()
+        self.assertEqual(gitBlobHash(self.paths[3]), hasher.hexdigest())
+
+        hasher = BlobHasher(len(data))
+        hasher.update(data[:1000])
+        hasher.catchUp(self.paths[3])
+        self.assertEqual(gitBlobHash(self.paths[3]), hasher.hexdigest())
+        hasher.close()
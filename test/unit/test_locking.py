@@ -0,0 +1,66 @@
+import unittest
+
+from fitlib import locking
+from multiprocessing import Process, Queue
+from os import listdir, stat, umask
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# Whether another process could take the lock right away
+def _tryLock(lockFile, exclusive, results):
+    lockIn = open(lockFile, 'a')
+    try:
+        locking.flock(lockIn.fileno(), (locking.LOCK_EX if exclusive else locking.LOCK_SH) | locking.LOCK_NB)
+        results.put(True)
+    except IOError:
+        results.put(False)
+
+@unittest.skipIf(locking.flock == None, 'no flock')
+class TestLocking(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.lockFile = join(self.dir, 'lock')
+
+    def tearDown(self):
+        while locking.isLocked(self.lockFile):
+            locking.release(self.lockFile)
+        rmtree(self.dir)
+
+    def isFree(self, exclusive):
+        results = Queue()
+        p = Process(target=_tryLock, args=(self.lockFile, exclusive, results))
+        p.start()
+        p.join()
+        return results.get()
+
+    def testReadersAndWriters(self):
+        locking.acquire(self.lockFile)
+        self.assertTrue(self.isFree(exclusive=False))
+        self.assertFalse(self.isFree(exclusive=True))
+        # Not taken again, and can't be upgraded
+        locking.acquire(self.lockFile)
+        self.assertRaises(Exception, locking.acquire, self.lockFile, exclusive=True)
+        locking.release(self.lockFile)
+        self.assertTrue(locking.isLocked(self.lockFile))
+        locking.release(self.lockFile)
+        self.assertTrue(self.isFree(exclusive=True))
+
+        locking.acquire(self.lockFile, exclusive=True)
+        locking.acquire(self.lockFile)
+        self.assertFalse(self.isFree(exclusive=False))
+        locking.release(self.lockFile)
+        self.assertFalse(self.isFree(exclusive=False))
+        locking.release(self.lockFile)
+        self.assertTrue(self.isFree(exclusive=False))
+
+    def testWriteFile(self):
+        filePath = join(self.dir, 'state')
+        locking.writeFile(filePath, 'one')
+        locking.writeFile(filePath, 'two')
+        self.assertEqual('two', open(filePath).read())
+        # No temp files are left behind
+        self.assertEqual(['state'], listdir(self.dir))
+        mask = umask(0)
+        umask(mask)
+        self.assertEqual(0666 & ~mask, stat(filePath).st_mode & 0777)
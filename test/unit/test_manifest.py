@@ -0,0 +1,77 @@
+import unittest
+
+from fitlib.manifest import encodeManifest, decodeManifest, isManifestData, Manifest
+from hashlib import sha1
+from os import close as osclose, remove
+from tempfile import mkstemp
+
+sampleFitData = {
+    'a.png': ['1111111111111111111111111111111111111111', 10],
+    'b.png': ['2222222222222222222222222222222222222222', 0],
+    'lib/libFoo.so': ['3333333333333333333333333333333333333333', 300],
+    'lib/x/y/z.jar': ['4444444444444444444444444444444444444444', 1 << 40],
+    'lib/zzz.dll': ['5555555555555555555555555555555555555555', 127],
+    'lib.txt': ['1111111111111111111111111111111111111111', 128],
+    'res/icon.png': ['abcdefabcdefabcdefabcdefabcdefabcdefabcd', 60],
+}
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.data = encodeManifest(sampleFitData)
+
+    def testRoundTrip(self):
+        self.assertTrue(isManifestData(self.data))
+        self.assertEqual(sampleFitData, decodeManifest(self.data))
+        self.assertEqual({}, decodeManifest(encodeManifest({})))
+
+    def testGet(self):
+        m = Manifest(data=self.data)
+        self.assertEqual(len(sampleFitData), len(m))
+        for p,item in sampleFitData.iteritems():
+            self.assertEqual(item, m.get(p))
+        self.assertEqual(None, m.get('lib'))
+        self.assertEqual(None, m.get('zzz'))
+        self.assertEqual(None, m.get(''))
+
+    def testPrefix(self):
+        m = Manifest(data=self.data)
+        self.assertEqual(['lib/libFoo.so', 'lib/x/y/z.jar', 'lib/zzz.dll'], [p for p,h,s in m.iterPrefix('lib/')])
+        self.assertEqual([], list(m.iterPrefix('nothing/')))
+
+    def testFindHash(self):
+        m = Manifest(data=self.data)
+        self.assertEqual(['a.png', 'lib.txt'], sorted(m.findHash('1111111111111111111111111111111111111111')))
+        self.assertEqual(['res/icon.png'], m.findHash('abcdefabcdefabcdefabcdefabcdefabcdefabcd'))
+        self.assertEqual([], m.findHash('0000000000000000000000000000000000000000'))
+
+    def testMappedFile(self):
+        handle, filePath = mkstemp()
+        osclose(handle)
+        try:
+            f = open(filePath, 'wb')
+            f.write(self.data)
+            f.close()
+            m = Manifest(filePath)
+            self.assertEqual(sampleFitData['lib/zzz.dll'], m.get('lib/zzz.dll'))
+            self.assertEqual(sampleFitData, {p:[h,s] for p,h,s in m.items()})
+            m.close()
+        finally:
+            remove(filePath)
+
+    def testManyItems(self):
+        fitData = {}
+        for i in xrange(1000):
+            p = 'd%d/%s/item%d.bin'%(i%3, 'e'*(i%5), i)
+            fitData[p] = [sha1(p if i%10 else 'dup').hexdigest(), i*1000]
+        m = Manifest(data=encodeManifest(fitData))
+        self.assertEqual(fitData, {p:[h,s] for p,h,s in m.items()})
+        for p,item in fitData.iteritems():
+            self.assertEqual(item, m.get(p))
+            self.assertEqual(None, m.get(p + 'x'))
+        for prefix in ['d1/', 'd2/eee/', 'd0/e/item1', 'd3/']:
+            self.assertEqual(sorted(p for p in fitData if p.startswith(prefix)), [p for p,h,s in m.iterPrefix(prefix)])
+        self.assertEqual(100, len(m.findHash(sha1('dup').hexdigest())))
+
+    def testNotSha1(self):
+        self.assertRaises(ValueError, encodeManifest, {'a': ['abc', 1]})
+        self.assertRaises(ValueError, encodeManifest, {'a': ['xyz', 1]})
@@ -0,0 +1,52 @@
+import unittest
+
+import fitlib
+from fitlib.materialize import Materializer
+from fitlib.statdb import StatStore
+from os import makedirs, link, stat, getcwd, chdir
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+class TestMaterialize(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        makedirs(fitlib.context.fitDir)
+        # Materializer paths are relative to the root of the working tree
+        self.savedCwd = getcwd()
+        chdir(self.dir)
+        self.obj = join(self.dir, 'object')
+        open(self.obj, 'w').write('contents')
+
+    def tearDown(self):
+        chdir(self.savedCwd)
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def testMaterialize(self):
+        # Hard linked to the cached object, which must not be written to
+        link(self.obj, join(self.dir, 'a'))
+
+        m = Materializer()
+        m.fromCache(self.obj, 'a', 'aa11')
+        m.fromCache(self.obj, 'd/e/b', 'aa11')
+        download = join(self.dir, 'download')
+        open(download, 'w').write('downloaded')
+        m.fromFile(download, 'c', 'cc33')
+        m.stub('d/stub')
+        self.assertEqual({'a': 'aa11', 'd/e/b': 'aa11', 'c': 'cc33', 'd/stub': 0}, m.finish())
+
+        self.assertEqual('contents', open(join(self.dir, 'a')).read())
+        self.assertEqual('contents', open(join(self.dir, 'd/e/b')).read())
+        self.assertEqual('downloaded', open(join(self.dir, 'c')).read())
+        self.assertEqual('', open(join(self.dir, 'd/stub')).read())
+        self.assertEqual(1, stat(self.obj).st_nlink)
+
+        # The stats stored are those of the files written
+        store = StatStore(fitlib.context.statFile)
+        stats = store.get(['a', 'c', 'd/stub'])
+        store.close()
+        self.assertEqual(('cc33', fitlib.fitStats(join(self.dir, 'c'))), (stats['c'][0], tuple(stats['c'][1])))
+        self.assertEqual(0, stats['d/stub'][0])
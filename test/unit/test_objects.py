@@ -1,2 +1,312 @@
 import unittest
 
+import fitlib
+from fitlib import cache, config, objects
+from fitlib.hashing import gitBlobHash
+from functools import partial
+from hashlib import sha1
+from os import makedirs, getcwd, chdir, listdir, utime
+from os.path import join, exists
+from shutil import rmtree
+from subprocess import Popen as popen, PIPE
+from tempfile import mkdtemp
+from threading import Lock
+from time import sleep, time
+
+# An in-memory data store that takes a while for each call, and keeps track
+# of how many calls were in flight at once
+class Store(fitlib.DataStore):
+    objects = {}
+    failing = set()
+    instances = []
+
+    def __init__(self, progress):
+        self.instances.append(self)
+        self.progress = progress
+        self.lock = Lock()
+        self.inFlight = 0
+        self.maxInFlight = 0
+
+    def _call(self):
+        self.lock.acquire()
+        self.inFlight += 1
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        self.lock.release()
+        sleep(0.02)
+        self.lock.acquire()
+        self.inFlight -= 1
+        self.lock.release()
+
+    def check(self, key):
+        self._call()
+        return key if key in self.objects else None
+
+    def get(self, key, dst, size):
+        self._call()
+        open(dst, 'wb').write(self.objects[key])
+        self.progress(size, size)
+        return True
+
+    def put(self, src, key, size):
+        self._call()
+        if key in self.failing:
+            raise IOError('failed')
+        self.objects[key] = open(src, 'rb').read()
+        self.progress(size, size)
+        return True
+
+# The same, with the batch methods as well, counting the calls made
+class BatchStore(Store):
+    def __init__(self, progress):
+        Store.__init__(self, progress)
+        self.calls = []
+
+    def check(self, key):
+        self.calls.append('check')
+        return Store.check(self, key)
+
+    def checkMany(self, keys):
+        self.calls.append('checkMany')
+        return {k:k for k in keys if k in self.objects}
+
+    def getMany(self, items):
+        self.calls.append('getMany')
+        return {dst for key,dst,size in items if Store.get(self, key, dst, size)}
+
+    def putMany(self, items):
+        self.calls.append('putMany')
+        return {key for src,key,size in items if key not in self.failing and Store.put(self, src, key, size)}
+
+# The same, able to continue downloads, breaking off the first download of
+# each object half way
+class ResumableStore(Store):
+    resumable = True
+
+    def __init__(self, progress):
+        Store.__init__(self, progress)
+        self.interrupted = set()
+        self.offsets = []
+
+    def get(self, key, dst, size, offset=0):
+        self.offsets.append(offset)
+        data = self.objects[key]
+        if key not in self.interrupted:
+            self.interrupted.add(key)
+            open(dst, 'wb').write(data[:len(data)/2])
+            raise IOError('interrupted')
+        out = open(dst, 'r+b' if offset else 'wb')
+        out.seek(offset)
+        out.write(data[offset:])
+        out.close()
+        return True
+
+# The same, writing downloads in two halves, reporting the progress after each,
+# and getting the first download of each object wrong
+class CorruptingStore(Store):
+    def __init__(self, progress):
+        Store.__init__(self, progress)
+        self.corrupted = set()
+
+    def get(self, key, dst, size):
+        data = self.objects[key]
+        if key not in self.corrupted:
+            self.corrupted.add(key)
+            data = data.upper()
+        out = open(dst, 'wb')
+        for part in [data[:len(data)/2], data[len(data)/2:]]:
+            out.write(part)
+            out.flush()
+            self.progress(out.tell(), size)
+        out.close()
+        return True
+
+class TestObjects(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        popen(['git', 'init', '-q', self.dir]).wait()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        makedirs(fitlib.context.objectsDir)
+        self.savedCwd = getcwd()
+        chdir(self.dir)
+        self.savedConfig = config._values
+        config._values = {'fit.transfer.jobs': '4'}
+        Store.objects = {}
+        Store.failing = set()
+
+        self.items = []
+        for i in range(12):
+            filePath = 'item%02d'%i
+            open(filePath, 'w').write('item %d'%i)
+            self.items.append((filePath, gitBlobHash(filePath), len('item %d'%i)))
+        cache.insert({h:(s,f) for f,h,s in self.items})
+
+    def tearDown(self):
+        config._values = self.savedConfig
+        chdir(self.savedCwd)
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def key(self, objHash):
+        return '%s/%s'%(objHash[:2], objHash[2:])
+
+    def testPutAndGet(self):
+        store = Store(lambda done, size: None)
+        Store.failing = {self.key(self.items[3][1])}
+        successes, failures = [], []
+        pp = objects._ConcurrentProgressPrinter()
+        pp.setTotalSize(sum(s for f,h,s in self.items))
+        objects._put(list(self.items), store, pp, successes, failures, 4)
+        pp.done()
+        self.assertEqual((12, []), (pp.items_done, pp.in_flight))
+        self.assertEqual(4, store.maxInFlight)
+        # In the order of the items, whatever order they were done in
+        self.assertEqual(self.items[:3] + self.items[4:], successes)
+        self.assertEqual([self.items[3][0]], failures)
+        self.assertEqual(11, len(Store.objects))
+
+        # Stubs of the files are filled in again
+        for filePath,h,s in self.items:
+            open(filePath, 'w').close()
+        cache.delete([h for f,h,s in self.items])
+        store = Store(lambda done, size: None)
+        successes, failures = [], []
+        materializer = objects.Materializer()
+        objects._get(list(self.items), store, objects._QuietProgressPrinter(), successes, failures, 4, materializer)
+        materializer.finish()
+        self.assertEqual([self.items[3][0]], failures)
+        self.assertEqual('item 5', open('item05').read())
+
+    def testBatches(self):
+        store = BatchStore(lambda done, size: None)
+        Store.failing = {self.key(self.items[3][1])}
+        Store.objects[self.key(self.items[5][1])] = 'item 5'
+        successes, failures = [], []
+        objects._put(list(self.items), store, objects._QuietProgressPrinter(), successes, failures, 4)
+        # The objects and their recipes checked in one call, the 11 not in
+        # the store put in another
+        self.assertEqual(['checkMany', 'putMany'], store.calls)
+        self.assertEqual(sorted(self.items[:3] + self.items[4:]), sorted(successes))
+        self.assertEqual([self.items[3][0]], failures)
+
+        for filePath,h,s in self.items:
+            open(filePath, 'w').close()
+        cache.delete([h for f,h,s in self.items])
+        store = BatchStore(lambda done, size: None)
+        successes, failures = [], []
+        materializer = objects.Materializer()
+        objects._get(list(self.items), store, objects._QuietProgressPrinter(), successes, failures, 4, materializer)
+        materializer.finish()
+        # The one missing object is looked for as a chunked one
+        self.assertEqual(['checkMany', 'checkMany', 'getMany'], store.calls)
+        self.assertEqual([self.items[3][0]], failures)
+        self.assertEqual('item 5', open('item05').read())
+
+    def get(self, items, store):
+        successes, failures = [], []
+        materializer = objects.Materializer()
+        objects._get(list(items), store, objects._QuietProgressPrinter(), successes, failures, 1, materializer)
+        materializer.finish()
+        return failures
+
+    def testResume(self):
+        # Not continued within the same get
+        config._values['fit.transfer.retries'] = '0'
+        objects._put(list(self.items), Store(lambda done, size: None), objects._QuietProgressPrinter(), [], [], 4)
+        for filePath,h,s in self.items:
+            open(filePath, 'w').close()
+        cache.delete([h for f,h,s in self.items])
+        # Another path with the same object as item00, which isn't downloaded
+        # to the same partial file
+        open('copy00', 'w').close()
+        items = self.items + [('copy00', self.items[0][1], self.items[0][2])]
+
+        # Nothing is kept if the store can't continue
+        store = ResumableStore(lambda done, size: None)
+        store.resumable = False
+        self.assertEqual([f for f,h,s in self.items], self.get(items, store))
+        self.assertEqual([], listdir(fitlib.context.tempDir))
+
+        store = ResumableStore(lambda done, size: None)
+        self.assertEqual([f for f,h,s in self.items], self.get(items, store))
+        self.assertEqual(sorted(h + '.part' for f,h,s in self.items), sorted(listdir(fitlib.context.tempDir)))
+        store.offsets = []
+        self.assertEqual([], self.get(items, store))
+        self.assertEqual([3] * 12 + [0], store.offsets)
+        self.assertEqual(['item 0', 'item 0', 'item 11'], [open(f).read() for f in ['item00', 'copy00', 'item11']])
+        self.assertEqual([], listdir(fitlib.context.tempDir))
+
+    def testVerify(self):
+        objects._put(list(self.items), Store(lambda done, size: None), objects._QuietProgressPrinter(), [], [], 4)
+        rehashed = []
+        objects.gitBlobHash = lambda filePath: rehashed.append(filePath) or gitBlobHash(filePath)
+        try:
+            for retries,failed in [('0', 12), ('2', 0)]:
+                config._values['fit.transfer.retries'] = retries
+                for filePath,h,s in self.items:
+                    open(filePath, 'w').close()
+                cache.delete([h for f,h,s in self.items])
+                store = CorruptingStore(partial(objects._threadProgress, objects._QuietProgressPrinter()))
+                self.assertEqual(failed, len(self.get(self.items, store)))
+                self.assertEqual([], listdir(fitlib.context.tempDir))
+        finally:
+            objects.gitBlobHash = gitBlobHash
+        self.assertEqual(['item 5', 'item 11'], [open(f).read() for f in ['item05', 'item11']])
+        self.assertEqual(12, len(cache.find(h for f,h,s in self.items)))
+        # Only the corrupt downloads are hashed again, the others are checked
+        # as they come in
+        self.assertEqual(24, len(rehashed))
+
+    def testVerifyConverted(self):
+        # Ids of files git converts are those of their converted contents
+        open('.gitattributes', 'w').write('*.txt text=auto\n')
+        open('crlf.txt', 'wb').write('a\r\nb\r\n')
+        objHash = popen(['git', 'hash-object', 'crlf.txt'], stdout=PIPE).communicate()[0].strip()
+        self.assertNotEqual(gitBlobHash('crlf.txt'), objHash)
+        Store.objects[self.key(objHash)] = 'a\r\nb\r\n'
+        open('crlf.txt', 'w').close()
+        for s in [Store(lambda done, size: None), BatchStore(lambda done, size: None)]:
+            self.assertEqual([], self.get([('crlf.txt', objHash, 6)], s))
+            self.assertEqual('a\r\nb\r\n', open('crlf.txt', 'rb').read())
+
+    def testChunked(self):
+        config._values.update({'fit.chunking': 'true', 'fit.chunking.minfilesize': '100000'})
+        data = ''.join(sha1('data%d'%i).digest() for i in xrange(15000))
+        open('big', 'wb').write(data)
+        item = ('big', gitBlobHash('big'), len(data))
+        cache.insert({item[1]: (item[2], 'big')})
+        objects._put([item], Store(lambda done, size: None), objects._QuietProgressPrinter(), [], [], 1)
+        self.assertTrue(self.key(item[1]) + '.chunks' in Store.objects)
+
+        open('big', 'w').close()
+        cache.delete([item[1]])
+        store = Store(lambda done, size: None)
+        sizes = {}
+        store.get = lambda key, dst, size: sizes.update({key: size}) or Store.get(store, key, dst, size)
+        self.assertEqual([], self.get([item], store))
+        self.assertEqual(data, open('big', 'rb').read())
+        # The recipe isn't the size of the object
+        self.assertEqual(None, sizes[self.key(item[1]) + '.chunks'])
+
+    def testStaleTempFiles(self):
+        makedirs(fitlib.context.tempDir)
+        for f in ['old.part', 'new.part', 'tmpold']:
+            open(join(fitlib.context.tempDir, f), 'w').close()
+        for f in ['old.part', 'tmpold']:
+            utime(join(fitlib.context.tempDir, f), (time() - objects._staleAge - 60,) * 2)
+        objects._get([], Store(lambda done, size: None), objects._QuietProgressPrinter(), [], [], 4, objects.Materializer())
+        self.assertEqual(['new.part'], listdir(fitlib.context.tempDir))
+
+    def testThreadSafeOptOut(self):
+        config._values['fit.datastore.modulename'] = __name__
+        fitData = {f:[h,s] for f,h,s in self.items}
+        try:
+            for threadSafe,jobs in [(True, 4), (False, 1)]:
+                Store.threadSafe = threadSafe
+                Store.objects = {}
+                Store.instances = []
+                objects._transfer(objects._put, list(self.items), 100, fitData, [], quiet=True)
+                self.assertEqual(12, len(Store.objects))
+                self.assertEqual(jobs, Store.instances[0].maxInFlight)
+        finally:
+            Store.threadSafe = True
@@ -0,0 +1,76 @@
+import unittest
+
+from fitlib.statdb import StatStore
+from json import dump
+from os import close as osclose, remove
+from os.path import exists
+from tempfile import mkstemp
+
+class TestStatStore(unittest.TestCase):
+    def setUp(self):
+        handle, self.statFile = mkstemp()
+        osclose(handle)
+
+    def tearDown(self):
+        remove(self.statFile)
+
+    def testUpdateAndGet(self):
+        store = StatStore(self.statFile)
+        store.update([('a', ('aaa', (1, 1.5, 2.5, 10))), ('b/c', ('bbb', (2, 3.25, 4.0, 11)))])
+        store.close()
+
+        store = StatStore(self.statFile)
+        self.assertEqual({'a': ('aaa', (1, 1.5, 2.5, 10))}, store.get(['a', 'missing']))
+        self.assertEqual(2, len(store.items()))
+        store.close()
+
+    def testDelete(self):
+        store = StatStore(self.statFile)
+        store.update([('a', ('aaa', (1, 1.5, 2.5, 10))), ('b', (0, (0, 1.0, 1.0, 12)))])
+        store.delete(['a'])
+        self.assertEqual({'b': (0, (0, 1.0, 1.0, 12))}, store.items())
+        store.close()
+
+    def testPrune(self):
+        store = StatStore(self.statFile)
+        store.update((p, ('h', (1, 1.0, 1.0, 1))) for p in ['a', 'b', 'c'])
+        store.prune(['a', 'c', 'new'])
+        self.assertEqual({'a', 'c'}, store.getPaths())
+        store.close()
+
+    def testManyPaths(self):
+        stats = {'p%d'%i: ('h%d'%i, (i, 1.0, 2.0, i)) for i in xrange(2000)}
+        store = StatStore(self.statFile)
+        store.update(stats.iteritems())
+        self.assertEqual(stats, store.get(stats))
+        store.close()
+
+    def testGetPathsUnder(self):
+        store = StatStore(self.statFile)
+        store.update((p, ('h', (1, 1.0, 1.0, 1))) for p in ['a', 'a/b', 'a/b/c', 'a0', 'a.b', 'ab/c'])
+        self.assertEqual({'a/b', 'a/b/c'}, store.getPaths(under='a'))
+        self.assertEqual(6, len(store.getPaths()))
+        store.close()
+
+    def testTrackedAndMeta(self):
+        store = StatStore(self.statFile)
+        store.setTracked(['a', 'b'])
+        store.updateTracked(['c'], ['a'])
+        store.setMeta('token', 'x:1')
+        store.close()
+
+        store = StatStore(self.statFile)
+        self.assertEqual({'b', 'c'}, store.getTracked())
+        self.assertEqual('x:1', store.getMeta('token'))
+        self.assertEqual(None, store.getMeta('missing'))
+        store.close()
+
+    def testMigrateJsonStatFile(self):
+        f = open(self.statFile, 'w')
+        dump({'a': ['aaa', [1, 1.5, 2.5, 10]]}, f)
+        f.close()
+
+        store = StatStore(self.statFile)
+        self.assertEqual({'a': ('aaa', (1, 1.5, 2.5, 10))}, store.items())
+        store.close()
+        self.assertFalse(exists(self.statFile + '.migrating'))
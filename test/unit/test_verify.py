@@ -0,0 +1,117 @@
+import unittest
+
+import fitlib
+from fitlib import cache, config, writeFitFile
+from fitlib.hashing import gitBlobHash
+from fitlib.verify import verifyCache
+from os import makedirs, remove, urandom
+from os.path import exists, join
+from shutil import rmtree
+from subprocess import Popen as popen, PIPE
+from tempfile import mkdtemp
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.savedDirs = fitlib.context._dirs
+        fitlib.context._dirs = (self.dir, join(self.dir, '.git'))
+        makedirs(fitlib.context.objectsDir)
+        self.savedConfig = config._values
+        self.savedGracePeriod = cache._orphanGracePeriod
+        # Files written by the test are old enough to be orphaned
+        cache._orphanGracePeriod = 0
+        config._values = {'fit.hash.jobs': '2', 'fit.cache.compression': 'zlib',
+            'fit.chunking': 'true', 'fit.chunking.minfilesize': '100000'}
+
+        self.keys = {}
+        for name,data in [('plain', 'x'*100), ('packed', 'y'*1000), ('chunked', urandom(300000)), ('other', 'z'*500)]:
+            filePath = join(self.dir, name)
+            open(filePath, 'wb').write(data)
+            self.keys[name] = gitBlobHash(filePath)
+            cache.insert({self.keys[name]: (len(data), filePath)}, inLru=name != 'other')
+        self.paths = cache.find(self.keys.values(), update=False)
+
+    def tearDown(self):
+        config._values = self.savedConfig
+        cache._orphanGracePeriod = self.savedGracePeriod
+        fitlib.context._dirs = self.savedDirs
+        rmtree(self.dir)
+
+    def name(self, key):
+        return self.paths[key][len(fitlib.context.objectsDir)+1:]
+
+    def testClean(self):
+        self.assertTrue(cache.isCompressed(self.paths[self.keys['packed']]))
+        self.assertTrue(cache.isChunked(self.paths[self.keys['chunked']]))
+        self.assertEqual({'missing': [], 'corrupt': [], 'orphan': []}, verifyCache(quiet=True))
+        self.assertFalse(exists(join(fitlib.context.cacheDir, 'verify-checkpoint')))
+
+    def testConverted(self):
+        # Keyed by the ids git gives them: one under a path with the ident
+        # attribute, and one with its line endings normalized, under no path
+        popen(['git', 'init', '-q', self.dir]).wait()
+        open(join(self.dir, '.gitattributes'), 'w').write('*.id ident\n')
+        keys = {}
+        for name,data in [('x.id', '$Id: 1234 $\n'), ('crlf.txt', 'a\r\nb\r\n' * 100)]:
+            filePath = join(self.dir, name)
+            open(filePath, 'wb').write(data)
+            keys[name] = popen(['git', 'hash-object', '--path', name, '--stdin'], stdin=PIPE, stdout=PIPE,
+                cwd=self.dir).communicate(data.replace('\r\n', '\n'))[0].strip()
+            self.assertNotEqual(gitBlobHash(filePath), keys[name])
+            cache.insert({keys[name]: (len(data), filePath)})
+        writeFitFile({'x.id': [keys['x.id'], 12]}, join(self.dir, '.fit'))
+        self.assertEqual({'missing': [], 'corrupt': [], 'orphan': []}, verifyCache(repair=True, quiet=True))
+        self.assertEqual(2, len(cache.find(keys.values(), update=False)))
+
+    def testRepair(self):
+        plain, packed, chunked, other = [self.keys[n] for n in ['plain', 'packed', 'chunked', 'other']]
+        open(self.paths[plain], 'wb').write('x'*99 + 'y')
+        remove(self.paths[other])
+        chunk = cache.readRecipe(self.paths[chunked])[0][0]
+        remove(join(fitlib.context.objectsDir, 'chunks', chunk[:2], chunk[2:]))
+        orphan = join(fitlib.context.objectsDir, 'ab', 'cdef')
+        makedirs(join(fitlib.context.objectsDir, 'ab'))
+        open(orphan, 'w').write('left behind')
+
+        expected = {
+            'missing': ['chunks/%s/%s'%(chunk[:2], chunk[2:]), self.name(other)],
+            'corrupt': sorted([self.name(plain), self.name(chunked)]),
+            'orphan': ['ab/cdef'],
+        }
+        self.assertEqual(expected, verifyCache(quiet=True))
+        self.assertEqual(4, len(cache.find(self.keys.values(), update=False)))
+
+        self.assertEqual(expected, verifyCache(repair=True, quiet=True))
+        self.assertEqual([packed], cache.find(self.keys.values(), update=False).keys())
+        self.assertFalse(exists(orphan))
+        # The chunks of the dropped object went with it, the totals are
+        # those of what is left
+        self.assertEqual([], cache.listIndex()[1].keys())
+        self.assertEqual((cache.listIndex()[0][packed][3], 0), cache.size())
+        self.assertEqual({'missing': [], 'corrupt': [], 'orphan': []}, verifyCache(quiet=True))
+
+    def testRecentOrphans(self):
+        orphan = join(fitlib.context.objectsDir, 'ab', 'cdef')
+        makedirs(join(fitlib.context.objectsDir, 'ab'))
+        open(orphan, 'w').write('being inserted')
+        cache._orphanGracePeriod = 3600
+        self.assertEqual([], verifyCache(quiet=True)['orphan'])
+
+        # Found orphaned, but indexed (or recent) by the time it is repaired
+        cache._orphanGracePeriod = 0
+        plain = self.paths[self.keys['plain']]
+        self.assertEqual([orphan], cache.repair([], [], [orphan, plain]))
+        self.assertTrue(exists(plain))
+        self.assertFalse(exists(orphan))
+        open(orphan, 'w').write('being inserted')
+        cache._orphanGracePeriod = 3600
+        self.assertEqual([], cache.repair([], [], [orphan]))
+        self.assertTrue(exists(orphan))
+
+    def testResume(self):
+        plain = self.keys['plain']
+        open(self.paths[plain], 'wb').write('corrupt')
+        # An interrupted verify found it fine, which is not looked at again
+        open(join(fitlib.context.cacheDir, 'verify-checkpoint'), 'w').write('%s 1\n%s'%(self.name(plain), self.name(self.keys['packed'])))
+        self.assertEqual([], verifyCache(quiet=True)['corrupt'])
+        self.assertEqual([self.name(plain)], verifyCache(quiet=True)['corrupt'])
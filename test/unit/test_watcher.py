@@ -0,0 +1,87 @@
+import unittest
+
+from fitlib import watcher
+from fitlib.watcher import _Watcher, WatcherChanges
+from os import makedirs, mkdir, rename
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.rootDir = mkdtemp()
+        mkdir(join(self.rootDir, '.git'))
+        makedirs(join(self.rootDir, 'a', 'b'))
+        self.watcher = _Watcher(self.rootDir, join(self.rootDir, '.git'))
+        self.token = self.watcher.token()
+
+    def tearDown(self):
+        self.watcher.close()
+        rmtree(self.rootDir)
+
+    def write(self, p):
+        open(join(self.rootDir, p), 'w').write('x')
+
+    def changes(self):
+        self.assertTrue(self.watcher.drain())
+        return set(self.watcher.changesSince(self.token))
+
+    def testFiles(self):
+        self.write('a/b/f.bin')
+        self.write('top.bin')
+        self.assertEqual({('f', 'a/b/f.bin'), ('f', 'top.bin')}, self.changes())
+
+        self.token = self.watcher.token()
+        self.assertEqual(set(), self.changes())
+
+    def testNewDirectory(self):
+        makedirs(join(self.rootDir, 'a', 'new'))
+        self.changes()
+        self.write('a/new/f.bin')
+        self.assertEqual({('d', 'a/new'), ('f', 'a/new/f.bin')}, self.changes())
+
+    def testMovedDirectory(self):
+        self.write('a/b/f.bin')
+        self.changes()
+        self.token = self.watcher.token()
+        rename(join(self.rootDir, 'a', 'b'), join(self.rootDir, 'c'))
+        self.assertEqual({('d', 'a/b'), ('d', 'c'), ('f', 'c/f.bin')}, self.changes())
+
+    def testGitDirectory(self):
+        self.write('.git/index')
+        self.write('.git/HEAD')
+        self.assertEqual({('g', 'index')}, self.changes())
+
+    def testForgetsOldChanges(self):
+        savedMaxChanges = watcher._maxChanges
+        watcher._maxChanges = 4
+        try:
+            tokens = []
+            for i in range(6):
+                tokens.append(self.watcher.token())
+                self.write('f%d.bin'%i)
+                self.write('top.bin')
+                self.assertTrue(self.watcher.drain())
+            self.assertTrue(len(self.watcher.changed) <= 4)
+            self.assertEqual(None, self.watcher.changesSince(tokens[0]))
+            self.assertEqual({('f', 'f4.bin'), ('f', 'f5.bin'), ('f', 'top.bin')}, set(self.watcher.changesSince(tokens[4])))
+            self.assertEqual([], self.watcher.changesSince(self.watcher.token()))
+        finally:
+            watcher._maxChanges = savedMaxChanges
+
+    def testForeignToken(self):
+        self.assertEqual(None, self.watcher.changesSince('other:0'))
+        self.assertEqual(None, self.watcher.changesSince('-'))
+
+class TestWatcherChanges(unittest.TestCase):
+    def testIsChanged(self):
+        changes = WatcherChanges('t', ['fa/f.bin', 'dx/y', 'gindex'])
+        self.assertFalse(changes.reset)
+        self.assertEqual({'index'}, changes.gitFiles)
+        self.assertTrue(changes.isChanged('a/f.bin'))
+        self.assertTrue(changes.isChanged('x/y/z/f.bin'))
+        self.assertFalse(changes.isChanged('x/y.bin'))
+        self.assertFalse(changes.isChanged('a/g.bin'))
+
+    def testReset(self):
+        self.assertTrue(WatcherChanges('t', None).reset)